@@ -0,0 +1,131 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Benchmarks the state memory and update step time of the `ADADP` optimizer
+against its flat-vector variant `FlatADADP` for parameter trees with varying
+numbers and sizes of leaves.
+
+Results are written in the same format as `bench_svi.py` and can be compared
+across commits with `compare.py`.
+"""
+
+import os
+
+# allow benchmarks to find dppp without installing
+import sys
+sys.path.append(os.path.dirname(sys.path[0]))
+####
+
+import argparse
+import json
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+from jax.random import PRNGKey
+
+from dppp.optimizers import ADADP, FlatADADP
+
+from bench_util import time_compiled, peak_memory, write_results
+
+OPTIMIZERS = {
+    'adadp': ADADP,
+    'flat_adadp': FlatADADP,
+}
+
+def tree_bytes(tree):
+    """ Returns the total number of bytes of all arrays in a jax tree. """
+    return int(sum(
+        np.size(leaf) * jnp.result_type(leaf).itemsize
+        for leaf in jax.tree_leaves(tree)
+    ))
+
+def run_benchmark(spec):
+    """ Runs a single benchmark specified by a dictionary with keys 'config'
+    (with 'num_leaves' and 'leaf_size'), 'method' and 'num_repeats'.
+
+    :return: dictionary of the specification and the measurements
+    """
+    num_leaves, leaf_size = spec['config']['num_leaves'], spec['config']['leaf_size']
+    params_rng, grad_rng = jax.random.split(PRNGKey(0))
+    params = {
+        'p{}'.format(i): jax.random.normal(rng, (leaf_size,))
+        for i, rng in enumerate(jax.random.split(params_rng, num_leaves))
+    }
+    gradient = jax.tree_map(
+        lambda x: jax.random.normal(grad_rng, jnp.shape(x)), params
+    )
+
+    optimizer = OPTIMIZERS[spec['method']](1e-3, tol=1.)
+    opt_state = optimizer.init(params)
+    update = jax.jit(optimizer.update)
+
+    def carry(args, outputs):
+        return (args[0], outputs)
+
+    timing = time_compiled(
+        update, (gradient, opt_state), num_repeats=spec['num_repeats'], carry=carry
+    )
+    peak_bytes, memory_source = peak_memory()
+
+    result = dict(spec)
+    result.update(timing)
+    result.update({
+        'num_params': num_leaves * leaf_size,
+        'state_bytes': tree_bytes(opt_state),
+        'peak_memory_bytes': peak_bytes,
+        'memory_source': memory_source,
+    })
+    return result
+
+def make_specs(args):
+    return [
+        {
+            'case': 'adadp',
+            'config': {'num_leaves': num_leaves, 'leaf_size': leaf_size},
+            'method': method, 'batch_size': None,
+            'num_repeats': args.num_repeats
+        }
+        for num_leaves in args.num_leaves
+        for leaf_size in args.leaf_sizes
+        for method in args.methods
+    ]
+
+def format_result(result):
+    return "{config} {method}: step {step:.3f} ms, compile {compile:.2f} s, state {state:.2f} MB".format(
+        config=json.dumps(result['config'], sort_keys=True), method=result['method'],
+        step=result['step_time_s']['median'] * 1e3,
+        compile=result['compile_time_s'],
+        state=result['state_bytes'] / 2**20
+    )
+
+def main(args):
+    results = []
+    for spec in make_specs(args):
+        result = run_benchmark(spec)
+        print(format_result(result))
+        results.append(result)
+
+    write_results(args.output, results)
+    print("wrote {} results to {}".format(len(results), args.output))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmarks the ADADP optimizer against its flat-vector variant")
+    parser.add_argument('-o', '--output', default='bench_adadp.json', type=str, help='path of the JSON results file')
+    parser.add_argument('--methods', nargs='+', default=list(OPTIMIZERS), choices=list(OPTIMIZERS), help='optimizer implementations to benchmark')
+    parser.add_argument('--num-leaves', nargs='+', default=[1, 10, 100], type=int, help='numbers of leaves in the parameter tree')
+    parser.add_argument('--leaf-sizes', nargs='+', default=[10, 10000, 1000000], type=int, help='numbers of parameters per leaf')
+    parser.add_argument('--num-repeats', default=20, type=int, help='number of timed update steps per benchmark')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,148 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Benchmarks compile time and step time of per-example gradients of the
+`GaussianMixture` log-likelihood for varying numbers of components.
+
+The `loop` method evaluates every component separately (as `log_prob` did
+before it was vectorized) and serves as a reference for the `vectorized`
+implementation of `GaussianMixture.log_prob`; the `chunked` method evaluates
+components in chunks of `--component-chunk-size`.
+
+Results are written in the same format as `bench_svi.py` and can be compared
+across commits with `compare.py`.
+"""
+
+import os
+
+# allow benchmarks to find dppp without installing
+import sys
+sys.path.append(os.path.dirname(sys.path[0]))
+####
+
+import argparse
+import functools
+import json
+
+import jax
+import jax.numpy as jnp
+from jax.random import PRNGKey
+from jax.scipy.special import logsumexp
+import numpyro.distributions as dist
+
+from dppp.gmm import GaussianMixture
+
+from bench_util import time_compiled, peak_memory, write_results
+
+def loop_log_prob(locs, scales, pis, value):
+    log_phis = jnp.array([
+        dist.Normal(loc, scale).log_prob(value).sum(-1)
+        for loc, scale
+        in zip(locs, scales)
+    ]).T
+    return logsumexp(jnp.log(pis) + log_phis, axis=-1)
+
+def vectorized_log_prob(locs, scales, pis, value, component_chunk_size=None):
+    return GaussianMixture(
+        locs, scales, pis, component_chunk_size=component_chunk_size
+    ).log_prob(value)
+
+METHODS = {
+    'loop': loop_log_prob,
+    'vectorized': vectorized_log_prob,
+    'chunked': vectorized_log_prob,
+}
+
+def run_benchmark(spec):
+    """ Runs a single benchmark specified by a dictionary with keys 'config'
+    (with 'num_components', 'dim' and 'component_chunk_size'), 'method',
+    'batch_size' and 'num_repeats'.
+
+    :return: dictionary of the specification and the measurements
+    """
+    k, d = spec['config']['num_components'], spec['config']['dim']
+    params_rng, data_rng = jax.random.split(PRNGKey(0))
+    params = (
+        jax.random.normal(params_rng, (k, d)), jnp.ones((k, d)), jnp.ones(k) / k
+    )
+    x = jax.random.normal(data_rng, (spec['batch_size'], d))
+
+    log_prob = METHODS[spec['method']]
+    if spec['method'] == 'chunked':
+        log_prob = functools.partial(
+            log_prob, component_chunk_size=spec['config']['component_chunk_size']
+        )
+    def per_example_grads(params, x):
+        return jax.vmap(
+            jax.grad(lambda params, x: log_prob(*params, x)), in_axes=(None, 0)
+        )(params, x)
+
+    timing = time_compiled(
+        jax.jit(per_example_grads), (params, x), num_repeats=spec['num_repeats']
+    )
+    peak_bytes, memory_source = peak_memory()
+
+    result = dict(spec)
+    result.update(timing)
+    result.update({
+        'peak_memory_bytes': peak_bytes,
+        'memory_source': memory_source,
+    })
+    return result
+
+def make_specs(args):
+    return [
+        {
+            'case': 'gmm',
+            'config': {
+                'num_components': k, 'dim': args.dim,
+                'component_chunk_size': args.component_chunk_size
+            },
+            'method': method, 'batch_size': batch_size,
+            'num_repeats': args.num_repeats
+        }
+        for k in args.num_components
+        for batch_size in args.batch_sizes
+        for method in args.methods
+    ]
+
+def format_result(result):
+    return "{config} {method} (batch {batch_size}): step {step:.3f} ms, compile {compile:.2f} s".format(
+        config=json.dumps(result['config'], sort_keys=True), method=result['method'],
+        batch_size=result['batch_size'],
+        step=result['step_time_s']['median'] * 1e3,
+        compile=result['compile_time_s']
+    )
+
+def main(args):
+    results = []
+    for spec in make_specs(args):
+        result = run_benchmark(spec)
+        print(format_result(result))
+        results.append(result)
+
+    write_results(args.output, results)
+    print("wrote {} results to {}".format(len(results), args.output))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmarks the GaussianMixture log-likelihood for varying numbers of components")
+    parser.add_argument('-o', '--output', default='bench_gmm.json', type=str, help='path of the JSON results file')
+    parser.add_argument('--methods', nargs='+', default=list(METHODS), choices=list(METHODS), help='log_prob implementations to benchmark')
+    parser.add_argument('--num-components', nargs='+', default=[2, 10, 100, 1000], type=int, help='numbers of mixture components')
+    parser.add_argument('--dim', default=10, type=int, help='dimension of the data')
+    parser.add_argument('--component-chunk-size', default=100, type=int, help='number of components per chunk for the chunked method')
+    parser.add_argument('--batch-sizes', nargs='+', default=[128], type=int, help='numbers of examples per step')
+    parser.add_argument('--num-repeats', default=20, type=int, help='number of timed steps per benchmark')
+    args = parser.parse_args()
+    main(args)
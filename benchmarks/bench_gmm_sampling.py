@@ -0,0 +1,130 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Benchmarks the throughput (samples per second) of sampling from a
+`GaussianMixture` with the different `categorical_sampling` methods, for
+varying numbers of components, sample sizes and batches of mixture
+parameters.
+
+Results are written in the same format as `bench_svi.py` and can be compared
+across commits with `compare.py`.
+"""
+
+import os
+
+# allow benchmarks to find dppp without installing
+import sys
+sys.path.append(os.path.dirname(sys.path[0]))
+####
+
+import argparse
+import json
+
+import jax
+import jax.numpy as jnp
+from jax.random import PRNGKey
+
+from dppp.gmm import GaussianMixture
+
+from bench_util import time_compiled, peak_memory, write_results
+
+METHODS = {
+    'categorical': None,
+    'gumbel': 'gumbel',
+    'inverse_cdf': 'inverse_cdf',
+    'alias': 'alias',
+}
+
+def run_benchmark(spec):
+    """ Runs a single benchmark specified by a dictionary with keys 'config'
+    (with 'num_components', 'dim', 'num_samples' and 'num_batch'), 'method'
+    and 'num_repeats'.
+
+    :return: dictionary of the specification and the measurements
+    """
+    config = spec['config']
+    k, d, n, b = config['num_components'], config['dim'], config['num_samples'], config['num_batch']
+    locs_rng, pis_rng = jax.random.split(PRNGKey(0))
+    locs = jax.random.normal(locs_rng, (b, k, d))
+    scales = jnp.ones((b, k, d))
+    pis = jax.nn.softmax(jax.random.normal(pis_rng, (b, k)), axis=-1)
+    categorical_sampling = METHODS[spec['method']]
+
+    @jax.jit
+    def sample(rng_key, locs, scales, pis):
+        mix = GaussianMixture(locs, scales, pis, categorical_sampling=categorical_sampling)
+        return mix.sample(rng_key, sample_shape=(n,))
+
+    def carry(args, outputs):
+        return (jax.random.split(args[0])[0],) + tuple(args[1:])
+
+    timing = time_compiled(
+        sample, (PRNGKey(1), locs, scales, pis), num_repeats=spec['num_repeats'], carry=carry
+    )
+    peak_bytes, memory_source = peak_memory()
+
+    result = dict(spec)
+    result.update(timing)
+    result.update({
+        'samples_per_second': n * b / timing['step_time_s']['median'],
+        'peak_memory_bytes': peak_bytes,
+        'memory_source': memory_source,
+    })
+    return result
+
+def make_specs(args):
+    return [
+        {
+            'case': 'gmm_sampling',
+            'config': {
+                'num_components': k, 'dim': args.dim, 'num_samples': n,
+                'num_batch': args.num_batch
+            },
+            'method': method, 'batch_size': None,
+            'num_repeats': args.num_repeats
+        }
+        for k in args.num_components
+        for n in args.num_samples
+        for method in args.methods
+    ]
+
+def format_result(result):
+    return "{config} {method}: {throughput:.3g} samples/s, step {step:.3f} ms, compile {compile:.2f} s".format(
+        config=json.dumps(result['config'], sort_keys=True), method=result['method'],
+        throughput=result['samples_per_second'],
+        step=result['step_time_s']['median'] * 1e3,
+        compile=result['compile_time_s']
+    )
+
+def main(args):
+    results = []
+    for spec in make_specs(args):
+        result = run_benchmark(spec)
+        print(format_result(result))
+        results.append(result)
+
+    write_results(args.output, results)
+    print("wrote {} results to {}".format(len(results), args.output))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmarks sampling from GaussianMixture")
+    parser.add_argument('-o', '--output', default='bench_gmm_sampling.json', type=str, help='path of the JSON results file')
+    parser.add_argument('--methods', nargs='+', default=list(METHODS), choices=list(METHODS), help='categorical sampling methods to benchmark')
+    parser.add_argument('--num-components', nargs='+', default=[2, 100, 10000], type=int, help='numbers of mixture components')
+    parser.add_argument('--num-samples', nargs='+', default=[1000, 1000000], type=int, help='numbers of samples per call')
+    parser.add_argument('--num-batch', default=1, type=int, help='number of batched mixtures, e.g., stacked posterior draws')
+    parser.add_argument('--dim', default=10, type=int, help='dimension of the data')
+    parser.add_argument('--num-repeats', default=10, type=int, help='number of timed calls per benchmark')
+    args = parser.parse_args()
+    main(args)
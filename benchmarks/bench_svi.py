@@ -0,0 +1,193 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Benchmarks the update step of `TunableSVI` and `DPSVI` against the
+non-private numpyro `SVI` for synthetic models of varying size and the
+example models.
+
+Measures compile time, steady-state step time and peak memory and writes
+results to a JSON file that can be compared across commits with
+`compare.py`, e.g.:
+
+    python benchmarks/bench_svi.py -o before.json
+    git checkout <other commit>
+    python benchmarks/bench_svi.py -o after.json
+    python benchmarks/compare.py before.json after.json
+"""
+
+import os
+
+# allow benchmarks to find dppp without installing
+import sys
+sys.path.append(os.path.dirname(sys.path[0]))
+####
+
+import argparse
+import json
+import multiprocessing
+
+import jax
+import jax.numpy as jnp
+from jax.random import PRNGKey
+
+import numpyro.optim as optimizers
+from numpyro.infer import SVI, Trace_ELBO as ELBO
+
+from dppp.svi import TunableSVI, DPSVI
+
+from bench_util import time_compiled, peak_memory, count_params, write_results
+from models import make_synthetic_case, make_logistic_regression_case, \
+    make_gmm_case, make_vae_case
+
+CASE_FACTORIES = {
+    'synthetic': make_synthetic_case,
+    'logistic_regression': make_logistic_regression_case,
+    'gmm': make_gmm_case,
+    'vae': make_vae_case,
+}
+
+METHODS = ('numpyro', 'tunable', 'dpsvi', 'dpsvi_bfloat16', 'dpsvi_float16', 'dpsvi_remat')
+
+# dtypes of per-example gradients for the reduced precision DPSVI methods
+PER_EXAMPLE_GRAD_DTYPES = {
+    'dpsvi_bfloat16': jnp.bfloat16,
+    'dpsvi_float16': jnp.float16,
+}
+
+def make_svi(method, case, num_obs_total):
+    optimizer = optimizers.Adam(1e-3)
+    static_kwargs = dict(case.static_kwargs)
+    if method == 'numpyro':
+        return SVI(case.model, case.guide, optimizer, ELBO(),
+            num_obs_total=num_obs_total, **static_kwargs
+        )
+    elif method == 'tunable':
+        return TunableSVI(case.model, case.guide, optimizer, ELBO(),
+            num_obs_total=num_obs_total, **static_kwargs
+        )
+    elif method == 'dpsvi' or method in PER_EXAMPLE_GRAD_DTYPES:
+        return DPSVI(case.model, case.guide, optimizer, ELBO(),
+            clipping_threshold=1., dp_scale=1., num_obs_total=num_obs_total,
+            per_example_grad_dtype=PER_EXAMPLE_GRAD_DTYPES.get(method),
+            **static_kwargs
+        )
+    elif method == 'dpsvi_remat':
+        return DPSVI(case.model, case.guide, optimizer, ELBO(),
+            clipping_threshold=1., dp_scale=1., num_obs_total=num_obs_total,
+            remat_policy='full', **static_kwargs
+        )
+    raise ValueError("unknown method {}".format(method))
+
+def run_benchmark(spec):
+    """ Runs a single benchmark specified by a dictionary with keys 'case',
+    'config' (arguments for the case factory), 'method', 'batch_size',
+    'num_obs_total' and 'num_repeats'.
+
+    :return: dictionary of the specification and the measurements
+    """
+    case = CASE_FACTORIES[spec['case']](**spec['config'])
+    data_rng, init_rng = jax.random.split(PRNGKey(0))
+    batch = case.make_batch(data_rng, spec['batch_size'])
+
+    svi = make_svi(spec['method'], case, spec['num_obs_total'])
+    svi_state = svi.init(init_rng, *batch)
+    update = jax.jit(svi.update)
+
+    def carry(args, outputs):
+        svi_state, _ = outputs
+        return (svi_state,) + args[1:]
+
+    timing = time_compiled(
+        update, (svi_state,) + batch, num_repeats=spec['num_repeats'], carry=carry
+    )
+    peak_bytes, memory_source = peak_memory()
+
+    result = dict(spec)
+    result.update(timing)
+    result.update({
+        'num_params': count_params(svi.get_params(svi_state)),
+        'peak_memory_bytes': peak_bytes,
+        'memory_source': memory_source,
+    })
+    return result
+
+def make_specs(args):
+    configs = []
+    if 'synthetic' in args.suites:
+        for num_params in args.param_counts:
+            for num_sites in args.num_sites:
+                if num_sites <= num_params and num_params % num_sites == 0:
+                    configs.append(('synthetic', {'num_params': num_params, 'num_sites': num_sites}))
+    if 'examples' in args.suites:
+        configs.append(('logistic_regression', {}))
+        configs.append(('gmm', {}))
+        configs.append(('vae', {}))
+
+    return [
+        {
+            'case': case, 'config': config, 'method': method,
+            'batch_size': batch_size, 'num_obs_total': args.num_obs_total,
+            'num_repeats': args.num_repeats
+        }
+        for case, config in configs
+        for batch_size in args.batch_sizes
+        for method in args.methods
+    ]
+
+def format_result(result):
+    return "{case} {config} batch_size={batch_size} {method}: step {step:.3f} ms, compile {compile:.2f} s, peak {memory:.1f} MB ({source})".format(
+        case=result['case'], config=json.dumps(result['config'], sort_keys=True),
+        batch_size=result['batch_size'], method=result['method'],
+        step=result['step_time_s']['median'] * 1e3,
+        compile=result['compile_time_s'],
+        memory=result['peak_memory_bytes'] / 2**20,
+        source=result['memory_source']
+    )
+
+def main(args):
+    specs = make_specs(args)
+
+    if args.isolate:
+        # run every benchmark in a fresh process so that compilation caches
+        #   and peak memory measurements do not carry over between them
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes=1, maxtasksperchild=1) as pool:
+            results_iter = pool.imap(run_benchmark, specs)
+            results = []
+            for result in results_iter:
+                print(format_result(result))
+                results.append(result)
+    else:
+        results = []
+        for spec in specs:
+            result = run_benchmark(spec)
+            print(format_result(result))
+            results.append(result)
+
+    write_results(args.output, results)
+    print("wrote {} results to {}".format(len(results), args.output))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmarks the update step of TunableSVI and DPSVI")
+    parser.add_argument('-o', '--output', default='bench_svi.json', type=str, help='path of the JSON results file')
+    parser.add_argument('--suites', nargs='+', default=['synthetic', 'examples'], choices=['synthetic', 'examples'], help='benchmark suites to run')
+    parser.add_argument('--methods', nargs='+', default=['numpyro', 'tunable', 'dpsvi'], choices=METHODS, help='SVI implementations to benchmark')
+    parser.add_argument('--param-counts', nargs='+', default=[10, 1000, 100000], type=int, help='numbers of parameters for the synthetic suite')
+    parser.add_argument('--num-sites', nargs='+', default=[1, 10, 100], type=int, help='numbers of sample sites for the synthetic suite')
+    parser.add_argument('--batch-sizes', nargs='+', default=[16, 128, 1024], type=int, help='batch sizes')
+    parser.add_argument('--num-obs-total', default=10000, type=int, help='total number of observations for minibatch scaling')
+    parser.add_argument('--num-repeats', default=20, type=int, help='number of timed update steps per benchmark')
+    parser.add_argument('--no-isolate', dest='isolate', action='store_false', help='run all benchmarks in this process')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,159 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Utilities for timing jax computations and recording benchmark results.
+"""
+
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import jax
+
+__all__ = [
+    'block_until_ready', 'time_compiled', 'peak_memory', 'count_params',
+    'get_metadata', 'write_results', 'read_results'
+]
+
+RESULTS_FORMAT_VERSION = 1
+
+def block_until_ready(tree):
+    """ Waits for all arrays in a jax tree to be computed. """
+    for leaf in jax.tree_leaves(tree):
+        if hasattr(leaf, 'block_until_ready'):
+            leaf.block_until_ready()
+    return tree
+
+def time_compiled(fn, args, num_repeats=20, num_warmup=2, carry=None):
+    """ Measures compile time and steady-state execution time of a jitted
+    function.
+
+    The first call includes tracing and compilation. Its duration is reported
+    as compile time; all timings block until results are ready.
+
+    :param fn: The jitted function.
+    :param args: Tuple of arguments for `fn`.
+    :param num_repeats: Number of timed calls after warm-up.
+    :param num_warmup: Number of untimed calls after the first call.
+    :param carry: Optional function `(args, outputs) -> args` that produces
+        arguments for the next call from the previous outputs, e.g., to
+        feed back an updated training state.
+    :return: dict with 'compile_time_s' and summary statistics of the step
+        times in 'step_time_s'.
+    """
+    def call(args):
+        outputs = block_until_ready(fn(*args))
+        return carry(args, outputs) if carry is not None else args
+
+    start = time.perf_counter()
+    args = call(args)
+    compile_time = time.perf_counter() - start
+
+    for _ in range(num_warmup):
+        args = call(args)
+
+    times = []
+    for _ in range(num_repeats):
+        start = time.perf_counter()
+        args = call(args)
+        times.append(time.perf_counter() - start)
+    times = np.array(times)
+
+    return {
+        'compile_time_s': compile_time,
+        'step_time_s': {
+            'median': float(np.median(times)),
+            'min': float(np.min(times)),
+            'mean': float(np.mean(times)),
+            'std': float(np.std(times)),
+            'num_repeats': int(num_repeats),
+        }
+    }
+
+def peak_memory():
+    """ Returns the peak memory usage of the benchmark in bytes.
+
+    Uses the device allocator statistics if the backend provides them (GPU)
+    and the peak resident set size of the process otherwise. The latter never
+    decreases, so cases should run in separate processes for meaningful
+    numbers (see `bench_svi.py --isolate`).
+
+    :return: tuple of the peak memory in bytes and the source of the value
+    """
+    device = jax.devices()[0]
+    if hasattr(device, 'memory_stats'):
+        stats = device.memory_stats()
+        if stats is not None and 'peak_bytes_in_use' in stats:
+            return int(stats['peak_bytes_in_use']), 'device'
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        max_rss *= 1024 # linux reports kilobytes
+    return int(max_rss), 'process_rss'
+
+def count_params(params):
+    """ Returns the total number of scalar parameters in a jax tree. """
+    return int(sum(np.size(leaf) for leaf in jax.tree_leaves(params)))
+
+def _git_revision():
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        revision = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=repo_dir, stderr=subprocess.DEVNULL
+        ).decode().strip()
+        dirty = subprocess.call(
+            ['git', 'diff', '--quiet', 'HEAD'], cwd=repo_dir, stderr=subprocess.DEVNULL
+        ) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return revision, dirty
+
+def get_metadata():
+    """ Collects information about the environment a benchmark runs in. """
+    import numpyro
+    revision, dirty = _git_revision()
+    return {
+        'format_version': RESULTS_FORMAT_VERSION,
+        'git_revision': revision,
+        'git_dirty': dirty,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'jax': jax.__version__,
+        'numpyro': numpyro.__version__,
+        'backend': jax.lib.xla_bridge.get_backend().platform,
+        'device': str(jax.devices()[0]),
+        'host': platform.node(),
+    }
+
+def write_results(path, results, metadata=None):
+    """ Writes benchmark results together with environment metadata to a JSON
+    file.
+    """
+    if metadata is None:
+        metadata = get_metadata()
+    with open(path, 'w') as f:
+        json.dump({'metadata': metadata, 'results': results}, f, indent=2)
+
+def read_results(path):
+    """ Reads benchmark results written by `write_results`.
+
+    :return: tuple of metadata and list of results
+    """
+    with open(path, 'r') as f:
+        contents = json.load(f)
+    return contents['metadata'], contents['results']
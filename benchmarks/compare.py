@@ -0,0 +1,84 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Compares two benchmark result files and reports regressions.
+
+Exits with a non-zero status if the median step time of any benchmark
+increased by more than the given threshold.
+"""
+
+import argparse
+import json
+import sys
+
+from bench_util import read_results
+
+def result_key(result):
+    return (
+        result['case'], json.dumps(result['config'], sort_keys=True),
+        result['batch_size'], result['method']
+    )
+
+def ratio(new, old):
+    if old == 0:
+        return float('inf') if new > 0 else 1.
+    return new / old
+
+def main(args):
+    base_metadata, base_results = read_results(args.baseline)
+    new_metadata, new_results = read_results(args.new)
+    print("baseline: {} ({})".format(base_metadata['git_revision'], base_metadata['timestamp']))
+    print("new:      {} ({})".format(new_metadata['git_revision'], new_metadata['timestamp']))
+    if base_metadata['device'] != new_metadata['device']:
+        print("warning: results were obtained on different devices ({} vs {})".format(
+            base_metadata['device'], new_metadata['device']
+        ))
+
+    base_results = {result_key(result): result for result in base_results}
+
+    regressions = 0
+    print("{:<60} {:>10} {:>10} {:>8} {:>8} {:>8}".format(
+        'benchmark', 'base [ms]', 'new [ms]', 'step', 'compile', 'memory'
+    ))
+    for result in new_results:
+        key = result_key(result)
+        if key not in base_results:
+            continue
+        base = base_results[key]
+
+        step_ratio = ratio(result['step_time_s']['median'], base['step_time_s']['median'])
+        compile_ratio = ratio(result['compile_time_s'], base['compile_time_s'])
+        memory_ratio = ratio(result['peak_memory_bytes'], base['peak_memory_bytes'])
+
+        is_regression = step_ratio > 1. + args.threshold
+        regressions += is_regression
+        print("{:<60} {:>10.3f} {:>10.3f} {:>7.2f}x {:>7.2f}x {:>7.2f}x{}".format(
+            "{} {} bs={} {}".format(*key),
+            base['step_time_s']['median'] * 1e3, result['step_time_s']['median'] * 1e3,
+            step_ratio, compile_ratio, memory_ratio,
+            " REGRESSION" if is_regression else ""
+        ))
+
+    if regressions > 0:
+        print("{} benchmarks regressed by more than {:.0%}".format(regressions, args.threshold))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="compares two benchmark result files")
+    parser.add_argument('baseline', type=str, help='results of the baseline commit')
+    parser.add_argument('new', type=str, help='results of the commit to compare')
+    parser.add_argument('--threshold', default=.1, type=float, help='relative increase in step time considered a regression')
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,188 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Models used in the benchmarks.
+
+The logistic regression, Gaussian mixture and VAE models mirror those in
+`examples/` but are defined here to avoid the side effects of importing the
+example scripts (data set downloads, result directories, platform selection).
+"""
+
+from collections import namedtuple
+
+import jax
+import jax.numpy as jnp
+from jax.experimental import stax
+
+import numpyro
+import numpyro.distributions as dist
+from numpyro.primitives import sample, param
+
+from dppp.minibatch import minibatch
+from dppp.gmm import GaussianMixture
+
+BenchmarkCase = namedtuple(
+    'BenchmarkCase', ['name', 'model', 'guide', 'make_batch', 'static_kwargs']
+)
+BenchmarkCase.__doc__ = """ A model to benchmark.
+
+:param name: Name of the case.
+:param model: The model function.
+:param guide: The guide function.
+:param make_batch: Function `(rng_key, batch_size)` returning a tuple of
+    arguments for a batch of data.
+:param static_kwargs: Static keyword arguments for model and guide.
+"""
+
+
+## synthetic linear regression with configurable parameter and site counts
+
+def make_synthetic_case(num_params, num_sites=1):
+    """ Creates a linear regression case whose `num_params` weights are split
+    evenly over `num_sites` sample sites.
+    """
+    if num_params % num_sites != 0:
+        raise ValueError("num_params must be divisible by num_sites")
+    site_size = num_params // num_sites
+    site_names = ['w{}'.format(i) for i in range(num_sites)]
+
+    def model(X, y=None, num_obs_total=None):
+        batch_size = jnp.shape(X)[0]
+        w = jnp.concatenate([
+            sample(name, dist.Normal(jnp.zeros(site_size), 1.))
+            for name in site_names
+        ])
+        with minibatch(batch_size, num_obs_total=num_obs_total):
+            return sample('obs', dist.Normal(X.dot(w), 1.), obs=y)
+
+    def guide(X, y=None, num_obs_total=None):
+        for name in site_names:
+            loc = param('{}_loc'.format(name), jnp.zeros(site_size))
+            std_log = param('{}_std_log'.format(name), jnp.zeros(site_size))
+            sample(name, dist.Normal(loc, jnp.exp(std_log)))
+
+    def make_batch(rng_key, batch_size):
+        X_key, y_key = jax.random.split(rng_key)
+        X = jax.random.normal(X_key, (batch_size, num_params))
+        y = jax.random.normal(y_key, (batch_size,))
+        return X, y
+
+    return BenchmarkCase(
+        'synthetic', model, guide, make_batch, dict()
+    )
+
+
+## logistic regression (examples/logistic_regression.py)
+
+def make_logistic_regression_case(d=10):
+    def model(batch_X, batch_y=None, num_obs_total=None):
+        batch_size, d = jnp.shape(batch_X)
+        z_w = sample('w', dist.Normal(jnp.zeros((d,)), jnp.ones((d,))))
+        z_intercept = sample('intercept', dist.Normal(0, 1))
+        logits = batch_X.dot(z_w) + z_intercept
+        with minibatch(batch_size, num_obs_total=num_obs_total):
+            return sample('obs', dist.Bernoulli(logits=logits), obs=batch_y)
+
+    def guide(batch_X, batch_y=None, num_obs_total=None):
+        d = jnp.shape(batch_X)[1]
+        z_w_loc = param("w_loc", jnp.zeros((d,)))
+        z_w_std = jnp.exp(param("w_std_log", jnp.zeros((d,))))
+        sample('w', dist.Normal(z_w_loc, z_w_std))
+        z_intercept_loc = param("intercept_loc", 0.)
+        z_intercept_std = jnp.exp(param("intercept_std_log", 0.))
+        sample('intercept', dist.Normal(z_intercept_loc, z_intercept_std))
+
+    def make_batch(rng_key, batch_size):
+        X_key, y_key = jax.random.split(rng_key)
+        X = jax.random.normal(X_key, (batch_size, d))
+        y = jax.random.bernoulli(y_key, .5, (batch_size,)).astype(jnp.float32)
+        return X, y
+
+    return BenchmarkCase(
+        'logistic_regression', model, guide, make_batch, dict()
+    )
+
+
+## Gaussian mixture model (examples/gaussian_mixture_model.py)
+
+def make_gmm_case(k=3, d=2):
+    def model(obs, k, num_obs_total=None):
+        batch_size, d = jnp.shape(obs)
+        pis = sample('pis', dist.Dirichlet(jnp.ones(k)))
+        mus = sample('mus', dist.Normal(jnp.zeros((k, d)), 10.))
+        sigs = sample('sigs', dist.InverseGamma(1., 1.), sample_shape=jnp.shape(mus))
+        with minibatch(batch_size, num_obs_total=num_obs_total):
+            return sample('obs', GaussianMixture(mus, sigs, pis), obs=obs, sample_shape=(batch_size,))
+
+    def guide(obs, k, num_obs_total=None):
+        _, d = jnp.shape(obs)
+        alpha = jnp.exp(param('alpha_log', jnp.zeros(k)))
+        sample('pis', dist.Dirichlet(alpha))
+        mus_loc = param('mus_loc', jnp.zeros((k, d)))
+        mus = sample('mus', dist.Normal(mus_loc, 1.))
+        sample('sigs', dist.InverseGamma(1., 1.), obs=jnp.ones_like(mus))
+
+    def make_batch(rng_key, batch_size):
+        return (jax.random.normal(rng_key, (batch_size, d)),)
+
+    return BenchmarkCase(
+        'gmm', model, guide, make_batch, dict(k=k)
+    )
+
+
+## variational autoencoder (examples/vae.py)
+
+def make_vae_case(z_dim=50, hidden_dim=400, image_shape=(28, 28)):
+    def encoder(hidden_dim, z_dim):
+        return stax.serial(
+            stax.Dense(hidden_dim, W_init=stax.randn()), stax.Softplus,
+            stax.FanOut(2),
+            stax.parallel(stax.Dense(z_dim, W_init=stax.randn()),
+                          stax.serial(stax.Dense(z_dim, W_init=stax.randn()), stax.Exp)),
+        )
+
+    def decoder(hidden_dim, out_dim):
+        return stax.serial(
+            stax.Dense(hidden_dim, W_init=stax.randn()), stax.Softplus,
+            stax.Dense(out_dim, W_init=stax.randn()), stax.Sigmoid,
+        )
+
+    def model(batch, z_dim, hidden_dim, num_obs_total=None):
+        batch_size = jnp.shape(batch)[0]
+        batch = jnp.reshape(batch, (batch_size, -1))
+        out_dim = jnp.shape(batch)[1]
+
+        decode = numpyro.module('decoder', decoder(hidden_dim, out_dim), (batch_size, z_dim))
+        with minibatch(batch_size, num_obs_total=num_obs_total):
+            z = sample('z', dist.Normal(jnp.zeros((z_dim,)), jnp.ones((z_dim,))))
+            img_loc = decode(z)
+            return sample('obs', dist.Bernoulli(img_loc), obs=batch)
+
+    def guide(batch, z_dim, hidden_dim, num_obs_total=None):
+        batch_size = jnp.shape(batch)[0]
+        batch = jnp.reshape(batch, (batch_size, -1))
+        out_dim = jnp.shape(batch)[1]
+
+        encode = numpyro.module('encoder', encoder(hidden_dim, z_dim), (batch_size, out_dim))
+        with minibatch(batch_size, num_obs_total=num_obs_total):
+            z_loc, z_std = encode(batch)
+            return sample('z', dist.Normal(z_loc, z_std))
+
+    def make_batch(rng_key, batch_size):
+        batch = jax.random.bernoulli(rng_key, .5, (batch_size, *image_shape))
+        return (batch.astype(jnp.float32),)
+
+    return BenchmarkCase(
+        'vae', model, guide, make_batch, dict(z_dim=z_dim, hidden_dim=hidden_dim)
+    )
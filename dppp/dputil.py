@@ -14,10 +14,604 @@
 
 from fourier_accountant.compute_eps import get_epsilon_S, get_epsilon_R
 import numpy as np
+import warnings
+import threading
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, CancelledError
+
+__all__ = [
+    'approximate_sigma', 'approximate_sigma_remove_relation',
+    'compute_rdp_subsampled_gaussian', 'rdp_to_epsilon', 'get_epsilon_rdp',
+    'approximate_sigma_rdp', 'AccountantGrid', 'get_truncation_limit',
+    'get_max_grid_size', 'get_epsilon_adaptive', 'PrivacyPhase',
+    'get_epsilon_for_phases', 'get_epsilon_at_step', 'AccountingService'
+]
+
+DEFAULT_RDP_ORDERS = np.concatenate((
+    np.arange(2, 33), np.arange(36, 65, 4),
+    np.array([80, 96, 112, 128, 160, 192, 224, 256, 384, 512])
+))
+
+def _log_factorials(n):
+    """ Returns an array containing log(k!) for k = 0, ..., n. """
+    return np.concatenate(([0.], np.cumsum(np.log(np.arange(1, n + 1)))))
+
+def compute_rdp_subsampled_gaussian(q, sigma, num_iter, orders=DEFAULT_RDP_ORDERS):
+    """ Computes the Rényi differential privacy (RDP) of the composition of
+    `num_iter` iterations of the subsampled Gaussian mechanism.
+
+    Uses the closed form bound of Mironov et al. for integer orders and the
+    add/remove neighbourhood relation with Poisson subsampling. Evaluation
+    is vectorized over all orders and (arrays of) sigma at once.
+
+    Reference:
+    I. Mironov, K. Talwar, L. Zhang: Rényi Differential Privacy of the Sampled
+    Gaussian Mechanism (https://arxiv.org/abs/1908.10530).
 
-__all__ = ['approximate_sigma', 'approximate_sigma_remove_relation']
+    :param q: The subsampling ratio.
+    :param sigma: The noise scale relative to the sensitivity; a scalar or an
+        array of arbitrary shape.
+    :param num_iter: The number of batch iterations.
+    :param orders: Integer RDP orders (greater than 1) at which to evaluate.
+    :return: Array of shape `np.shape(sigma) + (len(orders),)` holding the
+        RDP epsilon for each sigma and order.
+    """
+    orders = np.asarray(orders)
+    if not np.issubdtype(orders.dtype, np.integer) or np.any(orders < 2):
+        raise ValueError("RDP orders must be integers greater than 1")
+    if q <= 0 or q > 1:
+        raise ValueError("q must be in (0, 1]")
+    sigma = np.asarray(sigma, dtype=np.float64)
+    if np.any(sigma <= 0):
+        raise ValueError("sigma must be positive")
+
+    max_order = int(np.max(orders))
+    log_fact = _log_factorials(max_order)
+
+    alpha = orders.reshape(-1, 1)        # shape (num_orders, 1)
+    k = np.arange(max_order + 1)         # shape (max_order + 1,)
+    valid = k <= alpha
+
+    # log of binom(alpha, k) (1-q)^(alpha-k) q^k, masked to k <= alpha;
+    # terms with alpha - k == 0 are handled separately to allow q == 1
+    alpha_minus_k = np.where(valid, alpha - k, 0)
+    log_coefs = log_fact[alpha] - log_fact[k] - log_fact[alpha_minus_k]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_coefs += np.where(alpha_minus_k > 0, alpha_minus_k * np.log1p(-q), 0.)
+    log_coefs += k * np.log(q)
+    log_coefs = np.where(valid, log_coefs, -np.inf)
+
+    # broadcast over sigma: shape (*sigma.shape, num_orders, max_order + 1)
+    inv_two_var = 1. / (2. * sigma[..., np.newaxis, np.newaxis] ** 2)
+    log_terms = log_coefs + (k * k - k) * inv_two_var
+
+    # numerically stable logsumexp over k
+    max_terms = np.max(log_terms, axis=-1, keepdims=True)
+    log_a = np.log(np.sum(np.exp(log_terms - max_terms), axis=-1)) + max_terms[..., 0]
+
+    return num_iter * log_a / (orders - 1)
+
+def rdp_to_epsilon(orders, rdp, delta):
+    """ Converts Rényi differential privacy guarantees to an (epsilon, delta)
+    guarantee, selecting the best order.
+
+    Uses the conversion of Canonne, Kamath and Steinke, which is tighter than
+    the classical `rdp + log(1/delta)/(alpha-1)`.
+
+    :param orders: The RDP orders at which `rdp` was evaluated.
+    :param rdp: Array of RDP epsilon values; the last axis corresponds to `orders`.
+    :param delta: The target delta privacy parameter.
+    :return: Tuple (epsilon, order) of arrays of the shape of `rdp` without
+        the last axis.
+    """
+    if delta <= 0 or delta >= 1:
+        raise ValueError("delta must be in (0, 1)")
+    orders = np.asarray(orders, dtype=np.float64)
+    eps = rdp + np.log1p(-1. / orders) - (np.log(delta) + np.log(orders)) / (orders - 1)
+    best = np.argmin(eps, axis=-1)
+    eps = np.maximum(0., np.take_along_axis(eps, best[..., np.newaxis], axis=-1)[..., 0])
+    return eps, orders[best]
+
+def get_epsilon_rdp(target_delta, sigma, q, num_iter, orders=DEFAULT_RDP_ORDERS):
+    """ Computes an upper bound on epsilon for the subsampled Gaussian mechanism
+    via Rényi differential privacy for the add/remove relation.
+
+    This is considerably faster but less tight than the Fourier accountant
+    and is vectorized over `sigma`.
+
+    :param target_delta: The delta privacy parameter.
+    :param sigma: The noise scale relative to the sensitivity; a scalar or an
+        array of arbitrary shape.
+    :param q: The subsampling ratio.
+    :param num_iter: The number of batch iterations.
+    :param orders: Integer RDP orders (greater than 1) to optimize over.
+    :return: Epsilon for each value of `sigma`.
+    """
+    rdp = compute_rdp_subsampled_gaussian(q, sigma, num_iter, orders)
+    eps, _ = rdp_to_epsilon(orders, rdp, target_delta)
+    return eps
+
+def approximate_sigma_rdp(target_eps, delta, q, num_iter, sensitivity=1.,
+        orders=DEFAULT_RDP_ORDERS, num_candidates=64, num_refinements=3):
+    """ Approximates the smallest sigma for which the RDP bound on epsilon does
+    not exceed a target privacy epsilon.
+
+    Evaluates the (vectorized) RDP accountant on a logarithmic grid of
+    candidate values for sigma and iteratively refines the grid in the
+    interval bracketing `target_eps`.
+
+    :param target_eps: The desired target epsilon.
+    :param delta: The delta privacy parameter.
+    :param q: The subsampling ratio.
+    :param num_iter: The number of batch iterations.
+    :param sensitivity: Sensitivity of the mechanism relative to the clipping
+        threshold; the noise scale enters the accountant as `sigma/sensitivity`.
+    :param orders: Integer RDP orders (greater than 1) to optimize over.
+    :param num_candidates: Number of candidate values for sigma per refinement.
+    :param num_refinements: Number of grid refinements.
+    :return: Tuple consisting of
+        1) the determined value for sigma
+        2) the corresponding RDP epsilon (upper bound)
+    """
+    assert(target_eps > 0)
+    lower, upper = 1e-2, 1e4
+    for _ in range(num_refinements):
+        sigmas = np.geomspace(lower, upper, num_candidates)
+        eps = get_epsilon_rdp(delta, sigmas / sensitivity, q, num_iter, orders)
+        admissible = np.nonzero(eps <= target_eps)[0]
+        if len(admissible) == 0:
+            raise RuntimeError("Could not find sigma for target epsilon in [{}, {}]".format(lower, upper))
+        idx = admissible[0]
+        upper = sigmas[idx]
+        if idx == 0:
+            break
+        lower = sigmas[idx - 1]
+
+    return upper, get_epsilon_rdp(delta, upper / sensitivity, q, num_iter, orders)
+
+AccountantGrid = namedtuple(
+    'AccountantGrid', ['L', 'nx', 'truncation_error', 'discretization_error']
+)
+AccountantGrid.__doc__ = """ Discretisation of the privacy loss distribution
+used by the Fourier Accountant and error bounds for it.
+
+:param L: Limit of the evaluation window [-L, L].
+:param nx: Number of grid points.
+:param truncation_error: Upper bound on the probability mass of the privacy
+    loss distribution outside of [-L, L], i.e., on the error in delta
+    incurred by truncation.
+:param discretization_error: Estimated absolute error in epsilon due to the
+    finite number of grid points.
+"""
+
+DEFAULT_ACCOUNTANT_MEMORY = 2**30 # bytes
+
+# upper bound on the working memory required per grid point by the
+# fourier_accountant package, which keeps ~8 complex128 arrays of size nx alive
+_ACCOUNTANT_BYTES_PER_GRID_POINT = 128
+
+# the fourier_accountant package evaluates exp on [-L, L], which overflows
+# in double precision for larger L
+_MAX_TRUNCATION_LIMIT = float(np.log(np.finfo(np.float64).max))
+
+_GRID_POINTS_PER_STEP_LOSS = 16
+
+def _get_rdp_epsilon_bound(delta, sigma, q, num_iter, sensitivity):
+    """ Returns the (loose) conversion min_alpha D_alpha + log(1/delta)/(alpha-1)
+    of the RDP D_alpha of the composed mechanism to epsilon. """
+    orders = DEFAULT_RDP_ORDERS
+    rdp = _compute_rdp_for_phases(sigma, q, num_iter, sensitivity, orders)
+    return float(np.min(rdp + np.log(1. / delta) / (orders - 1)))
+
+def get_truncation_limit(delta_tol, sigma, q, num_iter, sensitivity=1.):
+    """ Determines the evaluation window [-L, L] for the Fourier Accountant
+    such that the probability mass of the privacy loss distribution outside of
+    it is at most `delta_tol`.
+
+    The upper tail is bounded by the Chernoff bound
+    P(loss > L) <= exp((alpha-1)*(D_alpha(P||Q) - L)) given by the RDP of the
+    composed mechanism. The lower tail is bounded analogously by
+    P(loss < -L) <= exp((alpha-1)*(D_alpha(Q||P) - L)), and for the subsampled
+    Gaussian mechanism D_alpha(Q||P) <= D_alpha(P||Q) (Mironov et al., 2019,
+    "Rényi Differential Privacy of the Sampled Gaussian Mechanism"), so the
+    same bound holds for both tails. L is therefore the RDP epsilon for
+    `delta_tol / 2`.
+
+    :param delta_tol: Tolerated probability mass outside of [-L, L].
+    :param sigma: The noise scale relative to the clipping threshold; a scalar
+        or an array of per-phase values (see `PrivacyPhase`).
+    :param q: The subsampling ratio; a scalar or an array of per-phase values.
+    :param num_iter: The number of batch iterations; a scalar or an array of
+        per-phase values.
+    :param sensitivity: Sensitivity of the mechanism relative to the clipping
+        threshold.
+    :return: The limit L.
+    """
+    # each of the two tails may hold up to half of the tolerated mass
+    return _get_rdp_epsilon_bound(delta_tol / 2, sigma, q, num_iter, sensitivity)
+
+def get_max_grid_size(max_memory):
+    """ Returns the largest number of grid points (a power of two) for which
+    the Fourier Accountant stays within a memory budget of `max_memory` bytes.
+    """
+    max_nx = max_memory // _ACCOUNTANT_BYTES_PER_GRID_POINT
+    if max_nx < 2:
+        raise ValueError("Memory budget is too small for the Fourier Accountant")
+    return 2 ** int(np.floor(np.log2(max_nx)))
+
+def _get_min_grid_size(L, sigma, q, sensitivity):
+    """ Returns the smallest number of grid points (a power of two) for which
+    the spacing on [-L, L] resolves the privacy loss distribution of a single
+    iteration, whose width is of the order of q*sensitivity/sigma, with
+    `_GRID_POINTS_PER_STEP_LOSS` points. """
+    width = np.min(q * sensitivity / sigma)
+    return 2 ** int(np.ceil(np.log2(2 * L * _GRID_POINTS_PER_STEP_LOSS / width)))
+
+def get_epsilon_adaptive(target_delta, sigma, q, num_iter, relation='R',
+        eps_tol=1e-3, max_memory=DEFAULT_ACCOUNTANT_MEMORY,
+        truncation_rtol=1e-3, initial_nx=None, target_eps=None):
+    """ Computes epsilon using the Fourier Accountant with a discretisation of
+    the privacy loss distribution chosen adaptively from error estimates.
+
+    The evaluation window [-L, L] is chosen such that the truncated
+    probability mass is at most `truncation_rtol * target_delta` (see
+    `get_truncation_limit`). The number of grid points is then doubled,
+    starting from `initial_nx` (by default the coarsest grid resolving the
+    privacy loss of a single iteration), until epsilon changes by less than `eps_tol`
+    in two consecutive doublings and does not exceed the (looser) RDP bound,
+    or the grid would exceed `max_memory`. The larger of the two last changes
+    serves as the estimate of the discretisation error.
+
+    Compared to a fixed grid, this avoids needlessly fine grids if epsilon
+    converges quickly (e.g., for small epsilon) and increases resolution for
+    long compositions.
+
+    If L is too large for the accountant or the finest grid within
+    `max_memory` does not resolve the privacy loss of a single iteration or
+    has a spacing 2L/nx larger than `eps_tol`, a `ValueError` is raised
+    without evaluating any grid.
+
+    :param target_delta: The delta privacy parameter.
+    :param sigma: The noise scale relative to the clipping threshold; a scalar
+        or an array of per-phase values (see `PrivacyPhase`).
+    :param q: The subsampling ratio; a scalar or an array of per-phase values.
+    :param num_iter: The number of batch iterations; a scalar or an array of
+        per-phase values.
+    :param relation: 'R' for the add/remove relation or 'S' for the
+        substitute relation.
+    :param eps_tol: Tolerance for the estimated discretisation error in epsilon.
+    :param max_memory: Memory budget in bytes for a single accountant evaluation.
+    :param truncation_rtol: Tolerated truncated probability mass relative to
+        `target_delta`.
+    :param initial_nx: Number of grid points for the first evaluation.
+        Optional, defaults to the coarsest grid that resolves the privacy
+        loss of a single iteration.
+    :param target_eps: Optional. If given, refinement also stops as soon as
+        epsilon differs from `target_eps` by more than the estimated error,
+        i.e., it is known on which side of `target_eps` epsilon lies. Sigma
+        searches use this to evaluate values of sigma far from the target
+        only coarsely.
+    :return: Tuple consisting of
+        1) epsilon
+        2) the `AccountantGrid` used to obtain it and its error bounds
+    """
+    if relation == 'R':
+        accountant_fn, sensitivity = get_epsilon_R, 1.
+    elif relation == 'S':
+        # substitution can change the sum of clipped gradients by twice the
+        #   clipping threshold, so truncation is bounded using a sensitivity of 2
+        accountant_fn, sensitivity = get_epsilon_S, 2.
+    else:
+        raise ValueError("relation must be either 'R' or 'S'")
+
+    sigma, q, num_iter = _as_phase_arrays(sigma, q, num_iter)
+    truncation_error = truncation_rtol * target_delta
+    L = max(get_truncation_limit(truncation_error, sigma, q, num_iter, sensitivity), 1.)
+    max_nx = get_max_grid_size(max_memory)
+    # coarser grids do not resolve the privacy loss of a single iteration,
+    #   which may make the accountant's Newton iteration for epsilon cycle
+    #   indefinitely
+    min_nx = _get_min_grid_size(L, sigma, q, sensitivity)
+    if initial_nx is None:
+        initial_nx = min_nx
+    nx = min(initial_nx, max_nx)
+
+    # for small sigma, L grows rapidly; instead of evaluating every grid up
+    #   to the memory budget only to fail for all of them, we fail right away
+    if L > _MAX_TRUNCATION_LIMIT:
+        raise ValueError(
+            "Privacy loss distribution is too wide for the Fourier Accountant "
+            "(L={}); sigma is likely chosen too small".format(L)
+        )
+    if min_nx > max_nx:
+        raise ValueError(
+            "Grid spacing {} of the finest grid within the memory budget "
+            "cannot resolve the privacy loss of a single iteration (L={}); "
+            "sigma is likely chosen too small, or max_memory must be "
+            "increased".format(2 * L / max_nx, L)
+        )
+    if 2 * L / max_nx > eps_tol:
+        raise ValueError(
+            "Grid spacing {} of the finest grid within the memory budget "
+            "cannot resolve epsilon to the tolerance {} (L={}); sigma is likely "
+            "chosen too small, or max_memory must be increased".format(
+                2 * L / max_nx, eps_tol, L
+            )
+        )
+
+    def compute_eps(nx):
+        return accountant_fn(target_delta, sigma, q, ncomp=num_iter, nx=nx, L=L)
+
+    # the RDP epsilon for target_delta upper bounds the true epsilon; a grid
+    #   resulting in a larger value has not resolved the distribution yet
+    rdp_eps = _get_rdp_epsilon_bound(target_delta, sigma, q, num_iter, sensitivity)
+    def is_plausible(eps):
+        return eps <= rdp_eps + eps_tol
+
+    # coarse grids may be numerically unstable, in which case we treat the
+    #   result as nan and continue refining
+    eps = _try_compute_eps(compute_eps, nx)
+    # a single small difference can be due to the results of two grids
+    #   oscillating around each other, so we require two consecutive
+    #   doublings to agree
+    differences = [np.inf, np.inf]
+    error = np.inf
+    def is_accurate(eps, error):
+        return error <= eps_tol or \
+            (target_eps is not None and abs(eps - target_eps) > error)
+
+    while not (is_accurate(eps, error) and is_plausible(eps)) and 2 * nx <= max_nx:
+        nx *= 2
+        new_eps = _try_compute_eps(compute_eps, nx)
+        difference = abs(new_eps - eps)
+        if np.isnan(difference):
+            difference = np.inf
+        differences = [differences[-1], difference]
+        error = max(differences)
+        eps = new_eps
+
+    if np.isnan(eps):
+        # the finest grid failed as well; re-raise the accountant's error
+        eps = compute_eps(nx)
+    if not is_accurate(eps, error):
+        warnings.warn(
+            "Fourier Accountant did not reach the error tolerance {} within "
+            "the memory budget; estimated error is {}".format(eps_tol, error)
+        )
+    elif not is_plausible(eps):
+        warnings.warn(
+            "Fourier Accountant result {} exceeds the RDP bound {}; the finest "
+            "grid within the memory budget is too coarse".format(eps, rdp_eps)
+        )
 
-def get_bracketing_bounds(compute_eps_fn, target_eps, maxeval, initial_sigma = 1.):
+    return eps, AccountantGrid(L, nx, truncation_error, error)
+
+def _try_compute_eps(compute_eps, nx):
+    try:
+        return compute_eps(nx)
+    except ValueError:
+        return np.nan
+
+PrivacyPhase = namedtuple('PrivacyPhase', ['sigma', 'q', 'num_iter'])
+PrivacyPhase.__doc__ = """ A phase of training with constant privacy parameters.
+
+Training schedules in which, e.g., the batch size or noise level change over
+time are described by a sequence of phases, which are composed by
+`get_epsilon_for_phases`.
+
+:param sigma: The noise scale relative to the clipping threshold.
+:param q: The subsampling ratio.
+:param num_iter: The number of batch iterations.
+"""
+
+def _as_phase_arrays(sigma, q, num_iter):
+    """ Returns sigma, q and num_iter as one-dimensional arrays of matching
+    length, as expected by the `fourier_accountant` package.
+    """
+    sigma, q, num_iter = np.broadcast_arrays(
+        np.atleast_1d(np.asarray(sigma, dtype=np.float64)),
+        np.atleast_1d(np.asarray(q, dtype=np.float64)),
+        np.atleast_1d(np.asarray(num_iter).astype(np.int64))
+    )
+    if sigma.ndim != 1:
+        raise ValueError("sigma, q and num_iter must be scalars or one-dimensional arrays")
+    return sigma, q, num_iter
+
+def _compute_rdp_for_phases(sigma, q, num_iter, sensitivity, orders):
+    """ Computes the RDP of the composition of all given phases, which is
+    the sum of the RDP of the individual phases.
+    """
+    return sum(
+        compute_rdp_subsampled_gaussian(q_i, sigma_i / sensitivity, num_iter_i, orders)
+        for sigma_i, q_i, num_iter_i in zip(*_as_phase_arrays(sigma, q, num_iter))
+    )
+
+def get_epsilon_for_phases(target_delta, phases, relation='R', method='fourier',
+        eps_tol=1e-3, max_memory=DEFAULT_ACCOUNTANT_MEMORY):
+    """ Computes the privacy epsilon for a training schedule consisting of
+    several phases with different noise scales and subsampling ratios.
+
+    With the Fourier Accountant, the characteristic function of each phase's
+    privacy loss distribution is raised to the phase's number of iterations
+    and the results are multiplied, so each phase is evaluated exactly once
+    and the composition remains tight. With the RDP accountant, the RDP of
+    the phases is summed before conversion to epsilon.
+
+    :param target_delta: The delta privacy parameter.
+    :param phases: Sequence of `PrivacyPhase` instances or (sigma, q, num_iter)
+        tuples, in any order.
+    :param relation: 'R' for the add/remove relation or 'S' for the
+        substitute relation.
+    :param method: The privacy accountant to use: 'fourier' for the (tight)
+        Fourier Accountant or 'rdp' for the (fast but looser) Rényi DP accountant.
+    :param eps_tol: Tolerance for the estimated discretisation error in epsilon
+        of the Fourier Accountant (see `get_epsilon_adaptive`).
+    :param max_memory: Memory budget in bytes for the Fourier Accountant.
+    :return: Epsilon for the composition of all phases.
+    """
+    phases = [PrivacyPhase(*phase) for phase in phases]
+    if len(phases) == 0:
+        raise ValueError("At least one phase must be given")
+    sigma, q, num_iter = (np.array(values) for values in zip(*phases))
+
+    if method == 'fourier':
+        eps, _ = get_epsilon_adaptive(
+            target_delta, sigma, q, num_iter, relation=relation,
+            eps_tol=eps_tol, max_memory=max_memory
+        )
+    elif method == 'rdp':
+        if relation == 'R':
+            sensitivity = 1.
+        elif relation == 'S':
+            sensitivity = 2.
+        else:
+            raise ValueError("relation must be either 'R' or 'S'")
+        orders = DEFAULT_RDP_ORDERS
+        rdp = _compute_rdp_for_phases(sigma, q, num_iter, sensitivity, orders)
+        eps, _ = rdp_to_epsilon(orders, rdp, target_delta)
+    else:
+        raise ValueError("method must be either 'fourier' or 'rdp'")
+    return eps
+
+def get_epsilon_at_step(num_iter, target_delta, sigma, q, previous_phases=(), method='fourier'):
+    """ Computes the privacy epsilon after `num_iter` iterations of the current
+    training phase, following the given previous phases.
+
+    Intended to be bound with `functools.partial` to obtain an epsilon function
+    of the step count for `AccountingService`.
+
+    :param num_iter: The number of batch iterations in the current phase.
+    :param target_delta: The delta privacy parameter.
+    :param sigma: The noise scale of the current phase relative to the
+        clipping threshold.
+    :param q: The subsampling ratio of the current phase.
+    :param previous_phases: Sequence of `PrivacyPhase` instances that preceded
+        the current phase.
+    :param method: The privacy accountant to use, 'fourier' or 'rdp'.
+    :return: Epsilon; 0 if no iterations have been performed.
+    """
+    phases = tuple(previous_phases) + (PrivacyPhase(sigma, q, num_iter),)
+    phases = tuple(phase for phase in phases if phase.num_iter > 0)
+    if len(phases) == 0:
+        return 0.
+    return get_epsilon_for_phases(target_delta, phases, method=method)
+
+class AccountingService(object):
+    """ Computes privacy epsilon for the step count of an ongoing training in
+    the background.
+
+    Requests return immediately with a `concurrent.futures.Future`, so that
+    monitoring privacy does not stall the training loop. Requests for a step
+    that has already been requested return the existing future instead of
+    triggering a new computation. Requests that failed are forgotten, so
+    that they are computed again when requested again, and requests that
+    have not started yet are cancelled when a later step is requested.
+
+    Example:
+
+    >>> with svi.accounting_service(1e-5, q) as accounting:
+    >>>     for i in range(num_iter):
+    >>>         svi_state, loss = update(svi_state, ...)
+    >>>         if i % 100 == 0:
+    >>>             accounting.request(i + 1)
+    >>>             print(accounting.get_latest())
+
+    :param compute_eps_fn: Function mapping a number of iterations to epsilon,
+        e.g., `get_epsilon_at_step` with all other arguments bound. Must be
+        picklable if `use_processes` is True.
+    :param max_workers: The maximum number of concurrent computations.
+    :param use_processes: If True, computations run in separate (spawned)
+        processes, which avoids contention for the interpreter lock with the
+        training loop; otherwise they run in background threads.
+    """
+
+    def __init__(self, compute_eps_fn, max_workers=1, use_processes=False):
+        self._compute_eps_fn = compute_eps_fn
+        if use_processes:
+            # forking a process that already runs jax threads can deadlock
+            self._executor = ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')
+            )
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = dict()
+        # reentrant since done callbacks of completed futures run immediately
+        self._lock = threading.RLock()
+
+    def _forget_if_failed(self, num_iter, future):
+        with self._lock:
+            if self._futures.get(num_iter) is future and \
+                    (future.cancelled() or future.exception() is not None):
+                del self._futures[num_iter]
+
+    def request(self, num_iter):
+        """ Requests epsilon after `num_iter` iterations.
+
+        Pending requests for fewer iterations that have not started yet are
+        cancelled.
+
+        :param num_iter: The number of iterations.
+        :return: A future resolving to the epsilon value.
+        """
+        num_iter = int(num_iter)
+        with self._lock:
+            # cancelled futures are removed by their done callback
+            for earlier_num_iter, earlier_future in list(self._futures.items()):
+                if earlier_num_iter < num_iter:
+                    earlier_future.cancel()
+
+            future = self._futures.get(num_iter)
+            if future is None:
+                future = self._executor.submit(self._compute_eps_fn, num_iter)
+                self._futures[num_iter] = future
+                future.add_done_callback(
+                    lambda future: self._forget_if_failed(num_iter, future)
+                )
+            return future
+
+    def get_epsilon(self, num_iter, timeout=None):
+        """ Returns epsilon after `num_iter` iterations, blocking until it is
+        available.
+        """
+        while True:
+            try:
+                return self.request(num_iter).result(timeout)
+            except CancelledError:
+                # superseded by a request for a later step before it started
+                continue
+
+    def get_latest(self):
+        """ Returns the result for the largest number of iterations for which
+        epsilon has already been computed, without blocking.
+
+        :return: Tuple (num_iter, epsilon) or None if no result is available yet.
+        """
+        with self._lock:
+            done = [
+                num_iter for num_iter, future in self._futures.items()
+                if future.done() and not future.cancelled() and future.exception() is None
+            ]
+            if len(done) == 0:
+                return None
+            num_iter = max(done)
+            return num_iter, self._futures[num_iter].result()
+
+    def shutdown(self, wait=True):
+        """ Shuts down the background workers.
+
+        :param wait: If True, blocks until all pending requests are completed.
+        """
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(wait=exc_type is None)
+        return False
+
+def get_bracketing_bounds(compute_eps_fn, target_eps, maxeval, initial_sigma = 1., check_stability=True):
     """ Determines rough upper and lower bounds for sigma around a target privacy
     epsilon value.
 
@@ -26,6 +620,9 @@ def get_bracketing_bounds(compute_eps_fn, target_eps, maxeval, initial_sigma = 1
     :param target_eps: Desired target epsilon.
     :param maxeval: Maximum number of evaluations of `compute_eps_fn`.
     :param initial_sigma: Initial guess for sigma.
+    :param check_stability: If True, every initial evaluation is repeated with
+        doubled precision to ensure that the obtained value is reliable. Can
+        be disabled if `compute_eps_fn` controls its numerical error itself.
     :return: Tuple (bounds, bound_eps, num_evals) where
         1) bounds is a tuple containing a lower and upper bound to the
             sigma resulting in `target_eps`.
@@ -45,6 +642,8 @@ def get_bracketing_bounds(compute_eps_fn, target_eps, maxeval, initial_sigma = 1
         try:
             num_evals += 1
             eps = compute_eps_fn(sig, precision=1.)
+            if not check_stability:
+                break
 
             # we want to make sure we got a reliable value.
             # we double the precision of the evaluation function and are
@@ -72,7 +671,7 @@ def get_bracketing_bounds(compute_eps_fn, target_eps, maxeval, initial_sigma = 1
                     eps = compute_eps_fn(sig)
                     break
                 except ValueError:
-                    sig = np.mean(sig, sig_1)
+                    sig = (sig + sig_1) / 2
 
                 if num_evals >= maxeval:
                     raise RuntimeError("Could not establish bounds in given evaluation limit")
@@ -87,7 +686,7 @@ def get_bracketing_bounds(compute_eps_fn, target_eps, maxeval, initial_sigma = 1
                     eps = compute_eps_fn(sig)
                     break
                 except ValueError:
-                    sig = np.mean(sig, sig_1)
+                    sig = (sig + sig_1) / 2
 
                 if num_evals >= maxeval:
                     raise RuntimeError("Could not establish bounds in given evaluation limit")
@@ -125,7 +724,7 @@ def update_bounds(sig, eps, target_eps, bounds, bound_eps, consecutive_updates):
 
     return bounds, bound_eps, consecutive_updates
 
-def _approximate_sigma(compute_eps_fn, target_eps, q, tol=1e-4, force_smaller=False, maxeval=10):
+def _approximate_sigma(compute_eps_fn, target_eps, q, tol=1e-4, force_smaller=False, maxeval=10, initial_sigma=None, check_stability=True):
     """ Approximates the sigma corresponding to a target privacy epsilon.
 
     Uses a bracketing approach where an initial rough estimate of lower and upper
@@ -145,14 +744,22 @@ def _approximate_sigma(compute_eps_fn, target_eps, q, tol=1e-4, force_smaller=Fa
         function aborts the search for sigma after `maxeval` function evaluations
         were made and returns the current best estimate. In that case, `tol`
         is violated but `force_smaller` is still adhered to.
+    :param initial_sigma: Initial guess for sigma. Optional, defaults to `100*q`.
+    :param check_stability: Whether to verify initial evaluations of
+        `compute_eps_fn` with doubled precision (see `get_bracketing_bounds`).
     :return: Tuple consisting of
         1) the determined value for sigma
         2) the corresponding espilon
         3) the number of function evaluations made
     """
 
-    initial_sigma = 1. / (0.01/q)
-    bounds, bound_eps, num_evals = get_bracketing_bounds(compute_eps_fn, target_eps, maxeval, initial_sigma=initial_sigma)
+    if initial_sigma is None:
+        initial_sigma = 1. / (0.01/q)
+    bounds, bound_eps, num_evals = get_bracketing_bounds(
+        compute_eps_fn, target_eps, maxeval, initial_sigma=initial_sigma,
+        check_stability=check_stability
+    )
+    new_sig = bounds[1]
     eps = bound_eps[1]
     consecutive_updates = [0,0]
     # scale = 1.
@@ -182,7 +789,8 @@ def _approximate_sigma(compute_eps_fn, target_eps, q, tol=1e-4, force_smaller=Fa
         # that number exceeds a certain value.
         MAX_CONSECUTIVE_UPDATES = 2
         if (consecutive_updates[0] > MAX_CONSECUTIVE_UPDATES or
-            consecutive_updates[1] > MAX_CONSECUTIVE_UPDATES) and num_evals < maxeval:
+            consecutive_updates[1] > MAX_CONSECUTIVE_UPDATES) and num_evals < maxeval \
+            and abs(target_eps - eps) > tol:
 
             # In this case, the optimal sigma is very close to the often
             # updated bound and thus evaluating at the midpoint of the interval
@@ -195,6 +803,12 @@ def _approximate_sigma(compute_eps_fn, target_eps, q, tol=1e-4, force_smaller=Fa
                 new_sig, eps, target_eps, bounds, bound_eps, consecutive_updates
             )
 
+    if abs(target_eps - eps) > tol:
+        # the search was aborted due to maxeval; return the closest estimate
+        idx = np.argmin(np.abs(bound_eps - target_eps))
+        new_sig = bounds[idx]
+        eps = bound_eps[idx]
+
     if force_smaller and eps > target_eps:
         idx = bound_eps < target_eps
         new_sig = bounds[idx][0]
@@ -204,7 +818,34 @@ def _approximate_sigma(compute_eps_fn, target_eps, q, tol=1e-4, force_smaller=Fa
 
     return new_sig, eps, num_evals
 
-def approximate_sigma(target_eps, delta, q, num_iter, tol=1e-4, force_smaller=False, maxeval=10):
+def _approximate_sigma_with_method(compute_eps_fn, target_eps, delta, q,
+        num_iter, tol, force_smaller, maxeval, method, rdp_sensitivity):
+    """ Dispatches sigma approximation to the selected calibration method.
+
+    See `approximate_sigma` for the parameters.
+    """
+    if method == 'fourier':
+        return _approximate_sigma(
+            compute_eps_fn, target_eps, q, tol, force_smaller, maxeval,
+            check_stability=False
+        )
+    elif method == 'rdp':
+        sigma, _ = approximate_sigma_rdp(
+            target_eps, delta, q, num_iter, sensitivity=rdp_sensitivity
+        )
+        eps = compute_eps_fn(sigma)
+        if eps <= target_eps:
+            return sigma, eps, 1
+        sigma, eps, num_evals = _approximate_sigma(
+            compute_eps_fn, target_eps, q, tol, force_smaller, maxeval - 1,
+            initial_sigma=sigma, check_stability=False
+        )
+        return sigma, eps, num_evals + 1
+    else:
+        raise ValueError("method must be either 'fourier' or 'rdp'")
+
+def approximate_sigma(target_eps, delta, q, num_iter, tol=1e-4, force_smaller=False, maxeval=10, method='fourier',
+        accountant_tol=None, max_memory=DEFAULT_ACCOUNTANT_MEMORY):
     """ Approximates the sigma corresponding to a target privacy epsilon using
     the Fourier Accountant for the substitute relation.
 
@@ -228,19 +869,45 @@ def approximate_sigma(target_eps, delta, q, num_iter, tol=1e-4, force_smaller=Fa
         function aborts the search for sigma after `maxeval` function evaluations
         were made and returns the current best estimate. In that case, `tol`
         is violated but `force_smaller` is still adhered to.
+    :param method: Either 'fourier' or 'rdp'. With 'rdp', sigma is calibrated
+        using the fast RDP accountant and the result is confirmed by a single
+        evaluation of the Fourier Accountant. Since the RDP bound is not
+        tight, the returned sigma may be larger than necessary and `tol` is
+        not enforced. If confirmation fails, falls back to 'fourier'
+        with the RDP result as initial guess.
+    :param accountant_tol: Tolerance for the estimated discretisation error
+        of each Fourier Accountant evaluation (see `get_epsilon_adaptive`).
+        Optional, defaults to `tol/10` so that discretisation errors do not
+        dominate the tolerance of the search. Only evaluations close to
+        `target_eps` are refined to this tolerance; others are refined only
+        until it is known on which side of `target_eps` they lie (see
+        `get_epsilon_adaptive`). Smaller tolerances require finer grids; for
+        long compositions with small q, an evaluation near `target_eps` may
+        take seconds.
+    :param max_memory: Memory budget in bytes for each Fourier Accountant
+        evaluation.
     :return: Tuple consisting of
         1) the determined value for sigma
         2) the corresponding espilon
         3) the number of function evaluations made
     """
-    L = max(20, target_eps*2)
-    compute_eps = lambda sigma, precision=1: get_epsilon_S(
-        delta, sigma, q, ncomp=num_iter, L=L*precision, nx=1e6*(L*precision)/20
+    if accountant_tol is None:
+        accountant_tol = tol / 10
+    compute_eps = lambda sigma, precision=1: get_epsilon_adaptive(
+        delta, sigma, q, num_iter, relation='S',
+        eps_tol=accountant_tol/precision, max_memory=max_memory,
+        target_eps=target_eps
+    )[0]
+
+    # substitution can change the sum of clipped gradients by twice the
+    #   clipping threshold, so the RDP search uses a sensitivity of 2
+    return _approximate_sigma_with_method(
+        compute_eps, target_eps, delta, q, num_iter, tol, force_smaller,
+        maxeval, method, rdp_sensitivity=2.
     )
 
-    return _approximate_sigma(compute_eps, target_eps, q, tol, force_smaller, maxeval)
-
-def approximate_sigma_remove_relation(target_eps, delta, q, num_iter, tol=1e-4, force_smaller=False, maxeval=10):
+def approximate_sigma_remove_relation(target_eps, delta, q, num_iter, tol=1e-4, force_smaller=False, maxeval=10, method='fourier',
+        accountant_tol=None, max_memory=DEFAULT_ACCOUNTANT_MEMORY):
     """ Approximates the sigma corresponding to a target privacy epsilon using
     the Fourier Accountant for the add/remove relation.
 
@@ -264,18 +931,41 @@ def approximate_sigma_remove_relation(target_eps, delta, q, num_iter, tol=1e-4,
         function aborts the search for sigma after `maxeval` function evaluations
         were made and returns the current best estimate. In that case, `tol`
         is violated but `force_smaller` is still adhered to.
+    :param method: Either 'fourier' or 'rdp'. With 'rdp', sigma is calibrated
+        using the fast RDP accountant and the result is confirmed by a single
+        evaluation of the Fourier Accountant. Since the RDP bound is not
+        tight, the returned sigma may be larger than necessary and `tol` is
+        not enforced. If confirmation fails, falls back to 'fourier'
+        with the RDP result as initial guess.
+    :param accountant_tol: Tolerance for the estimated discretisation error
+        of each Fourier Accountant evaluation (see `get_epsilon_adaptive`).
+        Optional, defaults to `tol/10` so that discretisation errors do not
+        dominate the tolerance of the search. Only evaluations close to
+        `target_eps` are refined to this tolerance; others are refined only
+        until it is known on which side of `target_eps` they lie (see
+        `get_epsilon_adaptive`). Smaller tolerances require finer grids; for
+        long compositions with small q, an evaluation near `target_eps` may
+        take seconds.
+    :param max_memory: Memory budget in bytes for each Fourier Accountant
+        evaluation.
     :return: Tuple consisting of
         1) the determined value for sigma
         2) the corresponding espilon
         3) the number of function evaluations made
     """
-    L = max(20, target_eps*2)
-    compute_eps = lambda sigma, precision=1: get_epsilon_R(
-        delta, sigma, q, ncomp=num_iter, L=L*precision, nx=1e6*(L*precision)/20
+    if accountant_tol is None:
+        accountant_tol = tol / 10
+    compute_eps = lambda sigma, precision=1: get_epsilon_adaptive(
+        delta, sigma, q, num_iter, relation='R',
+        eps_tol=accountant_tol/precision, max_memory=max_memory,
+        target_eps=target_eps
+    )[0]
+
+    return _approximate_sigma_with_method(
+        compute_eps, target_eps, delta, q, num_iter, tol, force_smaller,
+        maxeval, method, rdp_sensitivity=1.
     )
 
-    return _approximate_sigma(compute_eps, target_eps, q, tol, force_smaller, maxeval)
-
 # import scipy.optimize
 # def _approximate_sigma(compute_eps_fn, target_eps, tol=1e-4, force_smaller=False, maxiter=10):
 #     cache = {}
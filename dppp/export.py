@@ -0,0 +1,204 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Export of fitted posterior predictive distributions for sampling without
+jax and numpyro (see `dppp.standalone_sampler`).
+
+The exported artifact is a single `.npz` file holding the parameters of the
+distribution at every sample site of guide and model, in sampling order. A
+distribution parameter is either a constant (e.g., computed from the fitted
+guide parameters) or the value sampled at an earlier site.
+
+Supported are sites with Normal, Dirichlet and `GaussianMixture`
+distributions (possibly expanded or with event dimensions) as well as
+observed sites in the guide. Parameters must either be independent of the
+random draws or be passed on unchanged from an earlier site, i.e., the model
+may not transform sampled values before using them as parameters.
+
+Example:
+
+>>> export_posterior_predictive('posterior.npz', model, (1,), guide, (1,), params)
+
+and, in a process without jax,
+
+>>> from dppp.standalone_sampler import ExportedSampler
+>>> samples = ExportedSampler.load('posterior.npz').sample(1000, seed=0)
+"""
+
+import json
+
+import jax
+import numpy as np
+
+import numpyro.distributions as dist
+from numpyro.handlers import seed, trace, substitute
+
+from dppp.gmm import GaussianMixture
+from dppp.standalone_sampler import FORMAT_VERSION, SPEC_KEY, ExportedSampler
+
+__all__ = ['export_posterior_predictive']
+
+_WRAPPERS = tuple(
+    getattr(dist, name) for name in ('Independent', 'ExpandedDistribution')
+    if hasattr(dist, name)
+)
+
+def _trace_posterior_predictive(rng_key, model, model_args, guide, guide_args, params):
+    """ Returns the sample sites of guide and model in sampling order for a
+    single posterior predictive draw. Latent sites of the model are taken
+    from the guide. """
+    model_rng_key, guide_rng_key = jax.random.split(rng_key)
+    guide_trace = trace(seed(substitute(guide, data=params), guide_rng_key)).get_trace(*guide_args)
+    guide_samples = {
+        name: site['value'] for name, site in guide_trace.items() if site['type'] == 'sample'
+    }
+
+    model_params = dict(**params)
+    model_params.update(guide_samples)
+    model_trace = trace(
+        seed(substitute(model, data=model_params), model_rng_key)
+    ).get_trace(*model_args)
+
+    sites = [site for site in guide_trace.values() if site['type'] == 'sample']
+    sites += [
+        site for name, site in model_trace.items()
+        if site['type'] == 'sample' and name not in guide_samples
+    ]
+    return sites
+
+def _describe_distribution(site):
+    """ Returns the family, parameters, parameter shapes for a single draw
+    and shape of a single sample of the distribution at a sample site. """
+    fn = site['fn']
+    if site['is_observed']:
+        dist_shape = np.shape(site['value'])
+        return 'delta', {'value': site['value']}, {'value': dist_shape}, dist_shape
+    dist_shape = tuple(fn.batch_shape) + tuple(fn.event_shape)
+
+    base = fn
+    while isinstance(base, _WRAPPERS):
+        base = base.base_dist
+
+    if isinstance(base, dist.Normal):
+        return 'normal', {'loc': base.loc, 'scale': base.scale}, \
+            {'loc': dist_shape, 'scale': dist_shape}, dist_shape
+    if isinstance(base, dist.Dirichlet):
+        return 'dirichlet', {'concentration': base.concentration}, \
+            {'concentration': dist_shape}, dist_shape
+    if isinstance(base, GaussianMixture):
+        batch_shape = tuple(fn.batch_shape)
+        num_components = np.shape(base._pis)[-1]
+        component_shape = batch_shape + (num_components,) + tuple(fn.event_shape)
+        return 'gaussian_mixture', \
+            {'locs': base._locs, 'scales': base._scales, 'pis': base._pis}, \
+            {'locs': component_shape, 'scales': component_shape,
+                'pis': batch_shape + (num_components,)}, dist_shape
+    raise ValueError("Cannot export site '{}' with unsupported distribution {}".format(
+        site['name'], type(base).__name__
+    ))
+
+def _strip_leading_ones(shape):
+    shape = tuple(shape)
+    while len(shape) > 0 and shape[0] == 1:
+        shape = shape[1:]
+    return shape
+
+def _same(a, b):
+    """ Compares arrays, ignoring leading singleton dimensions added by
+    distributions to broadcast their parameters. """
+    return _strip_leading_ones(np.shape(a)) == _strip_leading_ones(np.shape(b)) \
+        and np.array_equal(np.reshape(a, -1), np.reshape(b, -1))
+
+def export_posterior_predictive(path, model, model_args, guide, guide_args, params, rng_key=None):
+    """ Exports the posterior predictive distribution given by model, guide
+    and fitted guide parameters for sampling with
+    `dppp.standalone_sampler.ExportedSampler`.
+
+    The model is traced with fixed arguments, i.e., the exported sampler
+    always produces as many observations per draw as the model does for
+    `model_args`.
+
+    :param path: File to write the artifact to (`.npz`).
+    :param model: Function representing the model using numpyro distributions
+        and the `sample` primitive
+    :param model_args: Arguments to the model function
+    :param guide: Function representing the variational distribution (the guide)
+        using numpyro distributions as well as the `sample` and `param` primitives
+    :param guide_args: Arguments to the guide function
+    :param params: A dictionary providing values for the parameters
+        designated by call to `param` in the guide
+    :param rng_key: Jax PRNG key used to trace guide and model.
+    :return: The exported specification of the sample sites.
+    """
+    if rng_key is None:
+        rng_key = jax.random.PRNGKey(0)
+
+    # parameters that depend on random draws are identified by comparing two
+    #   traces with different keys
+    sites, other_sites = (
+        _trace_posterior_predictive(key, model, model_args, guide, guide_args, params)
+        for key in jax.random.split(rng_key)
+    )
+
+    arrays = dict()
+    spec_sites = []
+    previous = []
+    for site, other_site in zip(sites, other_sites):
+        name = site['name']
+        family, site_params, param_shapes, dist_shape = _describe_distribution(site)
+        other_params = _describe_distribution(other_site)[1]
+        sample_shape = np.shape(site['value'])[:np.ndim(site['value']) - len(dist_shape)]
+
+        spec_params = dict()
+        for param_name, value in site_params.items():
+            value, other_value = np.asarray(value), np.asarray(other_params[param_name])
+            if _same(value, other_value):
+                key = '{}.{}'.format(name, param_name)
+                arrays[key] = value
+                reference = {'array': key}
+            else:
+                matches = [
+                    previous_name for previous_name, (previous_value, other_previous_value)
+                    in previous
+                    if _same(value, previous_value) and _same(other_value, other_previous_value)
+                ]
+                if len(matches) == 0:
+                    raise ValueError(
+                        "Cannot export site '{}': parameter '{}' depends on random draws "
+                        "but is not the value of an earlier sample site".format(name, param_name)
+                    )
+                reference = {'site': matches[-1]}
+            reference['shape'] = list(param_shapes[param_name])
+            spec_params[param_name] = reference
+
+        spec_site = {
+            'name': name,
+            'family': family,
+            'sample_shape': list(sample_shape),
+            'shape': list(dist_shape),
+            'params': spec_params,
+        }
+        if family == 'gaussian_mixture':
+            spec_site['event_ndim'] = len(site['fn'].event_shape)
+        spec_sites.append(spec_site)
+        previous.append((name, (np.asarray(site['value']), np.asarray(other_site['value']))))
+
+    spec = {'format_version': FORMAT_VERSION, 'sites': spec_sites}
+    # validates the specification
+    ExportedSampler(spec, arrays)
+
+    arrays[SPEC_KEY] = np.array(json.dumps(spec))
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+    return spec
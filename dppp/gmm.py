@@ -12,12 +12,89 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+
+import numpy as np
 import jax
 import jax.numpy as jnp
 from jax.scipy.special import logsumexp
+from jax.tree_util import register_pytree_node
 import numpyro.distributions as dist
 
+from dppp.util import checkpoint
+
+CATEGORICAL_SAMPLING = (None, 'gumbel', 'inverse_cdf', 'alias')
+
+def _alias_table(pis):
+    """ Builds the table of Walker's alias method for sampling from a
+    categorical distribution with probabilities pis (a single vector of
+    K entries), using Vose's construction in K steps.
+
+    :return: tuple of acceptance probabilities and alias indices, both of
+        shape (K,)
+    """
+    k = jnp.shape(pis)[-1]
+    scaled = pis * k / jnp.sum(pis)
+    is_small = scaled < 1.
+    # stacks of the indices of entries below and above the average
+    small = jnp.argsort(jnp.where(is_small, 0, 1))
+    large = jnp.argsort(jnp.where(is_small, 1, 0))
+    num_small = jnp.sum(is_small)
+
+    def has_pairs(state):
+        num_small, num_large = state[-2:]
+        return (num_small > 0) & (num_large > 0)
+
+    def pair_small_with_large(state):
+        scaled, prob, alias, small, large, num_small, num_large = state
+        s, l = small[num_small - 1], large[num_large - 1]
+        prob = prob.at[s].set(scaled[s])
+        alias = alias.at[s].set(l)
+        remaining = scaled[l] + scaled[s] - 1.
+        scaled = scaled.at[l].set(remaining)
+        # s is popped from the small stack; if l falls below the average,
+        #   it moves from the large stack to the position of s
+        small = small.at[num_small - 1].set(l)
+        becomes_small = remaining < 1.
+        num_small = jnp.where(becomes_small, num_small, num_small - 1)
+        num_large = jnp.where(becomes_small, num_large - 1, num_large)
+        return scaled, prob, alias, small, large, num_small, num_large
+
+    # entries left on either stack (due to rounding) are always accepted
+    init = (
+        scaled, jnp.ones_like(scaled), jnp.arange(k), small, large,
+        num_small, k - num_small
+    )
+    _, prob, alias, _, _, _, _ = jax.lax.while_loop(has_pairs, pair_small_with_large, init)
+    return prob, alias
+
 class GaussianMixture(dist.Distribution):
+    """ Mixture of Gaussian distributions with diagonal covariances.
+
+    Parameters may carry batch dimensions, e.g., for stacked posterior
+    draws, in front of the component axis.
+
+    :param locs: Locations of the components, of shape
+        (*batch_shape, K, *event_shape).
+    :param scales: Scales of the components, of shape
+        (*batch_shape, K, *event_shape).
+    :param pis: Mixture weights of the components, of shape (*batch_shape, K).
+    :param component_chunk_size: If given, the log-density is evaluated for
+        chunks of this many components at a time, combining the chunks with
+        a streaming logsumexp. Memory for intermediate values (also when
+        differentiating) then scales with the chunk size instead of the
+        number of components; results agree up to floating point rounding.
+    :param categorical_sampling: How components are drawn when sampling:
+        None to use numpyro's `Categorical`, 'gumbel' for the Gumbel-max
+        trick, 'inverse_cdf' for a binary search in the cumulative weights
+        or 'alias' for Walker's alias method. The latter two do not
+        require memory or time proportional to K per sample and are
+        preferable for many components and samples. The alias table is
+        built in K sequential steps on every call to `sample`, which pays
+        off only for many samples per call.
+    :param event_ndim: Number of event dimensions. Defaults to the number
+        of dimensions of locs beyond those of pis.
+    """
     arg_constraints = {
         '_locs': dist.constraints.real,
         '_scales': dist.constraints.positive,
@@ -25,23 +102,251 @@ class GaussianMixture(dist.Distribution):
     }
     support = dist.constraints.real
 
-    def __init__(self, locs=0., scales=1., pis=1.0, validate_args=None):
+    def __init__(self, locs=0., scales=1., pis=1.0, validate_args=None,
+            component_chunk_size=None, categorical_sampling=None, event_ndim=None):
         self._locs, self._scales, self._pis = locs, scales, pis
-        event_shape = jnp.shape(locs[0])
+        if component_chunk_size is not None and component_chunk_size < 1:
+            raise ValueError("component_chunk_size must be positive")
+        if categorical_sampling not in CATEGORICAL_SAMPLING:
+            raise ValueError("categorical_sampling must be one of {}".format(CATEGORICAL_SAMPLING))
+        self.component_chunk_size = component_chunk_size
+        self.categorical_sampling = categorical_sampling
+
+        if event_ndim is None:
+            event_ndim = max(jnp.ndim(locs) - max(jnp.ndim(pis), 1), 0)
+        def split_shape(shape):
+            shape = tuple(shape)
+            num_batch_dims = max(len(shape) - event_ndim - 1, 0)
+            return shape[:num_batch_dims], shape[len(shape) - event_ndim:] if event_ndim > 0 else ()
+        locs_batch_shape, locs_event_shape = split_shape(jnp.shape(locs))
+        scales_batch_shape, scales_event_shape = split_shape(jnp.shape(scales))
+        batch_shape = jax.lax.broadcast_shapes(
+            locs_batch_shape, scales_batch_shape, tuple(jnp.shape(pis)[:-1])
+        )
+        event_shape = jax.lax.broadcast_shapes(locs_event_shape, scales_event_shape)
         super(GaussianMixture, self).__init__(
+            batch_shape=batch_shape, event_shape=event_shape, validate_args=validate_args
+        )
+
+    @property
+    def num_components(self):
+        return jnp.shape(self._pis)[-1]
+
+    def _component_log_probs(self, value, locs, scales, log_pis):
+        """ Returns the log-densities of value under the given components,
+        weighted by log_pis, with the component axis last. """
+        event_ndim = len(self.event_shape)
+        # all components are evaluated at once by broadcasting over a
+        #   component axis in front of the event dimensions
+        value = jnp.expand_dims(value, -(event_ndim + 1))
+        log_phis = dist.Normal(locs, scales).log_prob(value)
+        log_phis = jnp.sum(log_phis, axis=tuple(range(-event_ndim, 0)))
+        return log_pis + log_phis
+
+    def _broadcast_components(self, x):
+        """ Broadcasts a parameter of the components to shape
+        (*batch_shape, K, *event_shape). """
+        return jnp.broadcast_to(
+            x, self.batch_shape + (self.num_components,) + self.event_shape
+        )
+
+    def _chunked_log_prob(self, value):
+        num_components = self.num_components
+        chunk_size = self.component_chunk_size
+        num_chunks = -(-num_components // chunk_size)
+        num_padding = num_chunks * chunk_size - num_components
+        component_axis = -(len(self.event_shape) + 1)
+
+        # chunks are split along the leading axis
+        locs = jnp.moveaxis(self._broadcast_components(self._locs), component_axis, 0)
+        scales = jnp.moveaxis(self._broadcast_components(self._scales), component_axis, 0)
+        log_pis = jnp.moveaxis(
+            jnp.broadcast_to(jnp.log(self._pis), self.batch_shape + (num_components,)), -1, 0
+        )
+        # padding components have zero weight and do not affect the result
+        def pad_and_split(x, padding_value):
+            x = jnp.concatenate(
+                (x, jnp.full((num_padding,) + jnp.shape(x)[1:], padding_value, jnp.result_type(x)))
+            )
+            return jnp.reshape(x, (num_chunks, chunk_size) + jnp.shape(x)[1:])
+        chunks = (
+            pad_and_split(locs, 0.), pad_and_split(scales, 1.),
+            pad_and_split(log_pis, -jnp.inf)
+        )
+
+        batch_shape = jax.lax.broadcast_shapes(
+            tuple(jnp.shape(value)[:jnp.ndim(value) - len(self.event_shape)]), self.batch_shape
+        )
+        dtype = jnp.result_type(value, locs, scales, log_pis)
+        init = (
+            jnp.full(batch_shape, -jnp.inf, dtype), jnp.zeros(batch_shape, dtype)
+        )
+
+        # intermediate values of a chunk are recomputed in the backward pass
+        #   instead of being stored for all chunks
+        @checkpoint
+        def accumulate(carry, chunk):
+            max_so_far, sum_so_far = carry
+            locs, scales, log_pis = chunk
+            log_probs = self._component_log_probs(
+                value, jnp.moveaxis(locs, 0, component_axis),
+                jnp.moveaxis(scales, 0, component_axis), jnp.moveaxis(log_pis, 0, -1)
+            )
+            # the result does not depend on the shift; as in logsumexp, it is
+            #   excluded from differentiation
+            new_max = jax.lax.stop_gradient(
+                jnp.maximum(max_so_far, jnp.max(log_probs, axis=-1))
+            )
+            # the carried maximum stays -inf as long as all components had
+            #   zero weight, so that the sum of such chunks is discarded
+            #   once a component with positive weight is encountered;
+            #   replacing it by a finite value only serves as a local shift
+            shift = _finite_or_zero(new_max)
+            rescaling = jnp.where(
+                jnp.isfinite(max_so_far), jnp.exp(max_so_far - shift), 0.
+            )
+            sum_so_far = sum_so_far * rescaling \
+                + jnp.sum(jnp.exp(log_probs - shift[..., jnp.newaxis]), axis=-1)
+            return (new_max, sum_so_far), None
+
+        (max_value, sum_value), _ = jax.lax.scan(accumulate, init, chunks)
+        return _finite_or_zero(max_value) + jnp.log(sum_value)
+
+    def component_log_prob(self, value):
+        """ Returns the joint log-densities of value and each component,
+        i.e., the log-density under the component plus the log of its
+        mixture weight, with the component axis last. """
+        return self._component_log_probs(
+            value, self._locs, self._scales, jnp.log(self._pis)
+        )
+
+    def log_prob(self, value):
+        if self._validate_args:
+            self._validate_sample(value)
+        if self.component_chunk_size is not None \
+                and self.component_chunk_size < self.num_components:
+            return self._chunked_log_prob(value)
+        return logsumexp(self.component_log_prob(value), axis=-1)
+
+    def _batch_offsets(self, shape):
+        """ Returns the offsets of the batch elements in arrays of shape
+        (prod(batch_shape) * K, ...), broadcast to shape. """
+        num_batch = int(np.prod(self.batch_shape))
+        offsets = jnp.reshape(jnp.arange(num_batch) * self.num_components, self.batch_shape)
+        return jnp.broadcast_to(offsets, shape)
+
+    def _gather_components(self, x, z):
+        """ Selects the parameters of the components z from x, of shape
+        (*batch_shape, K, *event_shape), without broadcasting x over the
+        sample shape. """
+        x = jnp.reshape(self._broadcast_components(x), (-1,) + self.event_shape)
+        return x[self._batch_offsets(jnp.shape(z)) + z]
+
+    def _sample_components(self, key, sample_shape):
+        shape = tuple(sample_shape) + self.batch_shape
+        if self.categorical_sampling is None:
+            return dist.Categorical(self._pis).sample(key, sample_shape)
+        if self.categorical_sampling == 'gumbel':
+            return jax.random.categorical(key, jnp.log(self._pis), shape=shape)
+
+        num_components = self.num_components
+        pis = jnp.reshape(
+            jnp.broadcast_to(self._pis, self.batch_shape + (num_components,)), (-1, num_components)
+        )
+        offsets = self._batch_offsets(shape)
+        if self.categorical_sampling == 'inverse_cdf':
+            cdf = jnp.cumsum(pis, axis=-1)
+            cdf = jnp.reshape(cdf / cdf[:, -1:], (-1,))
+            u = jax.random.uniform(key, shape)
+            # binary search for the first component with cdf > u
+            def bisect(_, bounds):
+                lower, upper = bounds
+                mid = (lower + upper) // 2
+                is_above = cdf[offsets + mid] > u
+                return jnp.where(is_above, lower, mid + 1), jnp.where(is_above, mid, upper)
+            num_steps = int(np.ceil(np.log2(num_components))) if num_components > 1 else 0
+            lower, _ = jax.lax.fori_loop(
+                0, num_steps, bisect,
+                (jnp.zeros(shape, jnp.int32), jnp.full(shape, num_components - 1, jnp.int32))
+            )
+            return lower
+
+        prob, alias = jax.vmap(_alias_table)(pis)
+        prob, alias = jnp.reshape(prob, (-1,)), jnp.reshape(alias, (-1,))
+        column_key, coin_key = jax.random.split(key)
+        column = jax.random.randint(column_key, shape, 0, num_components)
+        is_accepted = jax.random.uniform(coin_key, shape) < prob[offsets + column]
+        return jnp.where(is_accepted, column, alias[offsets + column])
+
+    def sample(self, key, sample_shape=()):
+        return self.sample_with_intermediates(key, sample_shape)[0]
+
+    def sample_with_intermediates(self, key, sample_shape=()):
+        vals_rng_key, pis_rng_key = jax.random.split(key, 2)
+        z = self._sample_components(pis_rng_key, sample_shape)
+        locs = self._gather_components(self._locs, z)
+        scales = self._gather_components(self._scales, z)
+        vals = dist.Normal(locs, scales).sample(vals_rng_key)
+        return vals, [z]
+
+class MultivariateGaussianMixture(dist.Distribution):
+    """ Mixture of Gaussian distributions with full covariance matrices.
+
+    The components are stored as batched Cholesky factors of their
+    covariance matrices, so that the log-density of all components is
+    evaluated with a single batched triangular solve.
+
+    :param locs: Locations of the components, of shape (K, d).
+    :param scale_trils: Lower-triangular Cholesky factors of the component
+        covariance matrices, of shape (K, d, d).
+    :param pis: Mixture weights of the components.
+    :param covariance_matrices: Covariance matrices of the components, of
+        shape (K, d, d), as an alternative to `scale_trils`.
+    """
+    arg_constraints = {
+        '_locs': dist.constraints.real,
+        '_scale_trils': dist.constraints.lower_cholesky,
+        '_pis' : dist.constraints.simplex
+    }
+    support = dist.constraints.real
+
+    def __init__(self, locs, scale_trils=None, pis=1.0, covariance_matrices=None, validate_args=None):
+        if (scale_trils is None) == (covariance_matrices is None):
+            raise ValueError("Exactly one of scale_trils and covariance_matrices must be given")
+        if scale_trils is None:
+            scale_trils = jnp.linalg.cholesky(covariance_matrices)
+        self._locs, self._scale_trils, self._pis = locs, scale_trils, pis
+        event_shape = jnp.shape(locs)[-1:]
+        super(MultivariateGaussianMixture, self).__init__(
             event_shape=event_shape, validate_args=validate_args
         )
 
+    def component_log_prob(self, value):
+        """ Returns the joint log-densities of value and each component,
+        i.e., the log-density under the component plus the log of its
+        mixture weight, with the component axis last. """
+        num_components, d = jnp.shape(self._locs)
+        diff = jnp.expand_dims(value, -2) - self._locs
+        batch_shape = jnp.shape(diff)[:-2]
+
+        # all values are solved for at once as columns of the right-hand side,
+        #   so that the Cholesky factors are not broadcast over the batch
+        diff = jnp.transpose(jnp.reshape(diff, (-1, num_components, d)), (1, 2, 0))
+        y = jax.scipy.linalg.solve_triangular(self._scale_trils, diff, lower=True)
+        mahalanobis = jnp.reshape(
+            jnp.transpose(jnp.sum(y**2, axis=-2)), batch_shape + (num_components,)
+        )
+
+        half_log_det = jnp.sum(
+            jnp.log(jnp.diagonal(self._scale_trils, axis1=-2, axis2=-1)), axis=-1
+        )
+        log_phis = -.5 * mahalanobis - half_log_det - .5 * d * jnp.log(2 * jnp.pi)
+        return jnp.log(self._pis) + log_phis
+
     def log_prob(self, value):
         if self._validate_args:
             self._validate_sample(value)
-        log_pis = jnp.log(self._pis)
-        log_phis = jnp.array([
-            dist.Normal(loc, scale).log_prob(value).sum(-1)
-            for loc, scale
-            in zip(self._locs, self._scales)
-        ]).T
-        return logsumexp(log_pis + log_phis, axis=-1)
+        return logsumexp(self.component_log_prob(value), axis=-1)
 
     def sample(self, key, sample_shape=()):
         return self.sample_with_intermediates(key, sample_shape)[0]
@@ -49,5 +354,178 @@ class GaussianMixture(dist.Distribution):
     def sample_with_intermediates(self, key, sample_shape=()):
         vals_rng_key, pis_rng_key = jax.random.split(key, 2)
         z = dist.Categorical(self._pis).sample(pis_rng_key, sample_shape)
-        vals = dist.Normal(self._locs[z], self._scales[z]).sample(vals_rng_key)
+        eps = jax.random.normal(vals_rng_key, jnp.shape(z) + self.event_shape)
+        vals = self._locs[z] + jnp.einsum('...ij,...j->...i', self._scale_trils[z], eps)
         return vals, [z]
+
+class LowRankGaussianMixture(MultivariateGaussianMixture):
+    """ Mixture of Gaussian distributions with low-rank-plus-diagonal
+    covariance matrices `cov_factors @ cov_factors.T + diag(cov_diags)`.
+
+    :param locs: Locations of the components, of shape (K, d).
+    :param cov_factors: Low-rank factors of the component covariance
+        matrices, of shape (K, d, r).
+    :param cov_diags: Diagonal parts of the component covariance matrices,
+        of shape (K, d).
+    :param pis: Mixture weights of the components.
+    """
+    arg_constraints = {
+        '_locs': dist.constraints.real,
+        '_cov_factors': dist.constraints.real,
+        '_cov_diags': dist.constraints.positive,
+        '_pis' : dist.constraints.simplex
+    }
+
+    def __init__(self, locs, cov_factors, cov_diags, pis=1.0, validate_args=None):
+        self._cov_factors, self._cov_diags = cov_factors, cov_diags
+        covariance_matrices = jnp.matmul(cov_factors, jnp.swapaxes(cov_factors, -1, -2)) \
+            + jnp.expand_dims(cov_diags, -1) * jnp.eye(jnp.shape(cov_diags)[-1])
+        super(LowRankGaussianMixture, self).__init__(
+            locs, pis=pis, covariance_matrices=covariance_matrices,
+            validate_args=validate_args
+        )
+
+def _register_mixture(cls, array_attributes):
+    """ Registers a mixture distribution as a jax pytree with the given
+    attributes as leaves, so that it can be passed to jitted functions. """
+    def flatten(mixture):
+        children = tuple(getattr(mixture, name) for name in array_attributes)
+        aux = tuple(sorted(
+            (name, value) for name, value in vars(mixture).items()
+            if name not in array_attributes
+        ))
+        return children, aux
+
+    def unflatten(aux, children):
+        mixture = cls.__new__(cls)
+        vars(mixture).update(aux)
+        vars(mixture).update(zip(array_attributes, children))
+        return mixture
+
+    register_pytree_node(cls, flatten, unflatten)
+
+_register_mixture(GaussianMixture, ('_locs', '_scales', '_pis'))
+_register_mixture(MultivariateGaussianMixture, ('_locs', '_scale_trils', '_pis'))
+_register_mixture(
+    LowRankGaussianMixture,
+    ('_locs', '_scale_trils', '_pis', '_cov_factors', '_cov_diags')
+)
+
+def _finite_or_zero(x):
+    return jnp.where(jnp.isfinite(x), x, 0.)
+
+def _split_into_chunks(x, chunk_size, padding_value):
+    """ Pads the leading axis of x to a multiple of chunk_size and splits it
+    into chunks along a new leading axis. """
+    n = jnp.shape(x)[0]
+    num_chunks = -(-n // chunk_size)
+    padding = jnp.full(
+        (num_chunks * chunk_size - n,) + jnp.shape(x)[1:], padding_value, jnp.result_type(x)
+    )
+    x = jnp.concatenate((x, padding))
+    return jnp.reshape(x, (num_chunks, chunk_size) + jnp.shape(x)[1:])
+
+def _map_chunks(fn, x, chunk_size):
+    """ Applies fn to chunks of chunk_size rows of x in a `lax.scan` and
+    concatenates the results. """
+    n = jnp.shape(x)[0]
+    chunk_size = min(chunk_size, n)
+    chunks = _split_into_chunks(x, chunk_size, 0)
+    _, results = jax.lax.scan(lambda carry, chunk: (carry, fn(chunk)), (), chunks)
+    return jnp.reshape(results, (-1,) + jnp.shape(results)[2:])[:n]
+
+@functools.partial(jax.jit, static_argnums=(2,))
+def _responsibilities(mixture, x, chunk_size):
+    return _map_chunks(
+        lambda chunk: jax.nn.softmax(mixture.component_log_prob(chunk), axis=-1),
+        x, chunk_size
+    )
+
+def responsibilities(mixture, x, chunk_size=4096):
+    """ Computes the posterior probabilities of the mixture components for
+    each data point.
+
+    Data points are processed in chunks, so that memory for intermediate
+    values scales with the chunk size instead of the size of the data set.
+
+    :param mixture: The mixture distribution, e.g., `GaussianMixture`.
+    :param x: Data points of shape (N, *event_shape).
+    :param chunk_size: Number of data points processed at once.
+    :return: Array of shape (N, K) of component probabilities.
+    """
+    return _responsibilities(mixture, x, chunk_size)
+
+@functools.partial(jax.jit, static_argnums=(2,))
+def _assign(mixture, x, chunk_size):
+    return _map_chunks(
+        lambda chunk: jnp.argmax(mixture.component_log_prob(chunk), axis=-1),
+        x, chunk_size
+    )
+
+def assign(mixture, x, chunk_size=4096):
+    """ Assigns each data point to its most probable mixture component.
+
+    :param mixture: The mixture distribution, e.g., `GaussianMixture`.
+    :param x: Data points of shape (N, *event_shape).
+    :param chunk_size: Number of data points processed at once.
+    :return: Integer array of shape (N,) of component indices.
+    """
+    return _assign(mixture, x, chunk_size)
+
+@functools.partial(jax.jit, static_argnums=(2,))
+def _log_likelihood(mixture, x, chunk_size):
+    n = jnp.shape(x)[0]
+    chunk_size = min(chunk_size, n)
+    chunks = _split_into_chunks(x, chunk_size, 0)
+    masks = _split_into_chunks(jnp.ones(n, dtype=bool), chunk_size, False)
+
+    def accumulate(total, chunk_and_mask):
+        chunk, mask = chunk_and_mask
+        return total + jnp.sum(jnp.where(mask, mixture.log_prob(chunk), 0.)), None
+
+    total, _ = jax.lax.scan(accumulate, jnp.zeros((), jnp.result_type(x, float)), (chunks, masks))
+    return total
+
+def log_likelihood(mixture, x, chunk_size=4096):
+    """ Computes the total log-likelihood of a (held-out) data set under the
+    mixture.
+
+    :param mixture: The mixture distribution, e.g., `GaussianMixture`.
+    :param x: Data points of shape (N, *event_shape).
+    :param chunk_size: Number of data points processed at once.
+    :return: The sum of the log-densities of all data points.
+    """
+    return _log_likelihood(mixture, x, chunk_size)
+
+@functools.partial(jax.jit, static_argnums=(2, 3))
+def _confusion_matrix(true_assignment, assignment, num_components, chunk_size):
+    chunk_size = min(chunk_size, jnp.shape(assignment)[0])
+    # padding with -1 results in all-zero one-hot encodings
+    chunks = (
+        _split_into_chunks(true_assignment, chunk_size, -1),
+        _split_into_chunks(assignment, chunk_size, -1)
+    )
+
+    def accumulate(counts, chunk):
+        true_one_hot = jax.nn.one_hot(chunk[0], num_components, dtype=jnp.int32)
+        one_hot = jax.nn.one_hot(chunk[1], num_components, dtype=jnp.int32)
+        return counts + jnp.matmul(true_one_hot.T, one_hot), None
+
+    counts, _ = jax.lax.scan(
+        accumulate, jnp.zeros((num_components, num_components), jnp.int32), chunks
+    )
+    return counts
+
+def confusion_matrix(true_assignment, assignment, num_components, chunk_size=65536):
+    """ Counts how often data points from each true component are assigned
+    to each component.
+
+    :param true_assignment: Integer array of shape (N,) of true components.
+    :param assignment: Integer array of shape (N,) of assigned components,
+        e.g., obtained from `assign`.
+    :param num_components: The number of components K.
+    :param chunk_size: Number of data points processed at once.
+    :return: Integer array of shape (K, K) where entry (i, j) is the number
+        of data points of true component i assigned to component j.
+    """
+    return _confusion_matrix(true_assignment, assignment, num_components, chunk_size)
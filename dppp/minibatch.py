@@ -13,6 +13,7 @@
 # limitations under the License.
 
 from dppp.util import is_int_scalar, is_array, example_count, sample_from_array
+from dppp.tracing import count_traces
 from numpyro.handlers import scale
 import jax.numpy as jnp
 import jax
@@ -95,6 +96,7 @@ def subsample_batchify_data(dataset, batch_size=None, q=None, with_replacement=F
         batch_size = q_to_batch_size(q, num_records)
 
     @jax.jit
+    @count_traces('subsample_batchify_data.init')
     def init(rng_key):
         """ Initializes the batchifier for a new epoch.
 
@@ -105,6 +107,7 @@ def subsample_batchify_data(dataset, batch_size=None, q=None, with_replacement=F
         return num_records // batch_size, rng_key
 
     @jax.jit
+    @count_traces('subsample_batchify_data.get_batch')
     def get_batch_with_replacement(i, batchifier_state):
         """ Fetches the next batch for the current epoch.
 
@@ -118,6 +121,7 @@ def subsample_batchify_data(dataset, batch_size=None, q=None, with_replacement=F
         return tuple(jnp.take(a, ret_idx, axis=0) for a in dataset)
 
     @jax.jit
+    @count_traces('subsample_batchify_data.get_batch')
     def get_batch_without_replacement(i, rng_key):
         """ Fetches the next batch for the current epoch.
 
@@ -169,6 +173,7 @@ def split_batchify_data(dataset, batch_size=None, q=None):
         batch_size = q_to_batch_size(q, num_records)
 
     @jax.jit
+    @count_traces('split_batchify_data.init')
     def init(rng_key):
         """ Initializes the batchifier for a new epoch.
 
@@ -180,6 +185,7 @@ def split_batchify_data(dataset, batch_size=None, q=None):
         return num_records // batch_size, jax.random.permutation(rng_key, idxs)
 
     @jax.jit
+    @count_traces('split_batchify_data.get_batch')
     def get_batch(i, idxs):
         """ Fetches the next batch for the current epoch.
 
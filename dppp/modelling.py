@@ -13,8 +13,10 @@
 # limitations under the License.
 
 import jax
+import jax.numpy as jnp
 from numpyro.handlers import seed, trace, substitute, Messenger
 from dppp.util import unvectorize_shape_2d
+from dppp.tracing import count_traces
 
 def get_samples_from_trace(trace, with_intermediates=False):
     """ Extracts all sample values from a numpyro trace.
@@ -33,6 +35,7 @@ def get_samples_from_trace(trace, with_intermediates=False):
     }
     return samples
 
+@count_traces('modelling.sample_prior_predictive')
 def sample_prior_predictive(rng_key, model, model_args,
         substitutes=None, with_intermediates=False, **kwargs):
     """ Samples once from the prior predictive distribution.
@@ -65,6 +68,7 @@ def sample_prior_predictive(rng_key, model, model_args,
     t = trace(model).get_trace(*model_args, **kwargs)
     return get_samples_from_trace(t, with_intermediates)
 
+@count_traces('modelling.sample_posterior_predictive')
 def sample_posterior_predictive(rng_key, model, model_args, guide, guide_args,
         params, with_intermediates=False, **kwargs):
     """ Samples once from the posterior predictive distribution.
@@ -111,12 +115,65 @@ def sample_posterior_predictive(rng_key, model, model_args, guide, guide_args,
     guide_samples.update(model_samples)
     return guide_samples
 
-def _sample_a_lot(rng_key, n, single_sample_fn):
+def _pad_to_chunks(rng_keys, chunk_size):
+    """ Pads a stack of rng keys by repeating keys so that it divides into
+    chunks of size `chunk_size`.
+
+    :return: tuple of the padded keys and the number of chunks
+    """
+    n = jnp.shape(rng_keys)[0]
+    num_chunks = -(-n // chunk_size)
+    num_padded = num_chunks * chunk_size - n
+    if num_padded > 0:
+        padding = jnp.tile(rng_keys[:1], (num_padded, 1))
+        rng_keys = jnp.concatenate((rng_keys, padding))
+    return rng_keys, num_chunks
+
+def _sample_a_lot(rng_key, n, single_sample_fn, chunk_size=None):
+    """ Draws n samples using `single_sample_fn`, vectorized over chunks of
+    `chunk_size` samples at a time if given and over all samples otherwise.
+
+    Samples are the same regardless of `chunk_size`.
+    """
     rng_keys = jax.random.split(rng_key, n)
-    return jax.vmap(single_sample_fn)(rng_keys)
+    if chunk_size is None or chunk_size >= n:
+        return jax.vmap(single_sample_fn)(rng_keys)
+
+    rng_keys, num_chunks = _pad_to_chunks(rng_keys, chunk_size)
+    rng_keys = jnp.reshape(rng_keys, (num_chunks, chunk_size) + jnp.shape(rng_keys)[1:])
+    # lax.map evaluates chunks sequentially, so only intermediate values of
+    #   a single chunk are alive at any time
+    samples = jax.lax.map(jax.vmap(single_sample_fn), rng_keys)
+    return jax.tree_map(
+        lambda x: jnp.reshape(x, (num_chunks * chunk_size,) + jnp.shape(x)[2:])[:n],
+        samples
+    )
+
+def _stream_a_lot(rng_key, n, single_sample_fn, chunk_size):
+    """ Generator yielding n samples using `single_sample_fn` in chunks of
+    `chunk_size` samples, each of which is sampled by a vectorized jitted
+    function. The last chunk may be smaller.
 
+    The concatenated chunks equal the samples of `_sample_a_lot` for the same
+    arguments.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+    rng_keys = jax.random.split(rng_key, n)
+    # pad to full chunks so that the jitted function is compiled only once
+    rng_keys, num_chunks = _pad_to_chunks(rng_keys, chunk_size)
+    sample_chunk = jax.jit(jax.vmap(single_sample_fn))
+    for i in range(num_chunks):
+        start = i * chunk_size
+        samples = sample_chunk(rng_keys[start : start + chunk_size])
+        num_valid = min(chunk_size, n - start)
+        if num_valid < chunk_size:
+            samples = jax.tree_map(lambda x: x[:num_valid], samples)
+        yield samples
+
+@count_traces('modelling.sample_multi_prior_predictive')
 def sample_multi_prior_predictive(rng_key, n, model, model_args,
-        substitutes=None, with_intermediates=False, **kwargs):
+        substitutes=None, with_intermediates=False, chunk_size=None, **kwargs):
     """ Samples n times from the prior predictive distribution.
 
     Individual sample sites, as designated by `sample`, can be frozen to
@@ -138,6 +195,9 @@ def sample_multi_prior_predictive(rng_key, n, model, model_args,
         sample sites.
     :param with_intermediates: If True, intermediate(/latent) samples from
         sample site distributions are included in the result.
+    :param chunk_size: If given, samples are drawn in chunks of `chunk_size`
+        draws at a time, which bounds the memory required for intermediate
+        values of the model. Draws are the same as without chunking.
     :param **kwargs: Keyword arguments passed to the model function.
     :return: Dictionary of sampled values associated with the names given
         via `sample()` in the model. If with_intermediates is True,
@@ -148,10 +208,41 @@ def sample_multi_prior_predictive(rng_key, n, model, model_args,
         rng, model, model_args, substitutes=substitutes,
         with_intermediates=with_intermediates, **kwargs
     )
-    return _sample_a_lot(rng_key, n, single_sample_fn)
+    return _sample_a_lot(rng_key, n, single_sample_fn, chunk_size)
+
+def stream_multi_prior_predictive(rng_key, n, model, model_args, chunk_size,
+        substitutes=None, with_intermediates=False, **kwargs):
+    """ Samples n times from the prior predictive distribution and yields
+    the samples in chunks.
+
+    Only a single chunk is kept in memory at a time, allowing to generate
+    more samples than fit into memory at once. The concatenated chunks are
+    identical to the result of `sample_multi_prior_predictive` for the same
+    arguments.
 
+    :param rng_key: Jax PRNG key
+    :param n: Number of draws from the prior predictive.
+    :param model: Function representing the model using numpyro distributions
+        and the `sample` primitive
+    :param model_args: Arguments to the model function
+    :param chunk_size: Number of draws per chunk. The last chunk may be smaller.
+    :param substitutes: An optional dictionary of frozen substitutes for
+        sample sites.
+    :param with_intermediates: If True, intermediate(/latent) samples from
+        sample site distributions are included in the result.
+    :param **kwargs: Keyword arguments passed to the model function.
+    :return: Generator of dictionaries of sampled values for each chunk, as
+        returned by `sample_multi_prior_predictive`.
+    """
+    single_sample_fn = lambda rng: sample_prior_predictive(
+        rng, model, model_args, substitutes=substitutes,
+        with_intermediates=with_intermediates, **kwargs
+    )
+    return _stream_a_lot(rng_key, n, single_sample_fn, chunk_size)
+
+@count_traces('modelling.sample_multi_posterior_predictive')
 def sample_multi_posterior_predictive(rng_key, n, model, model_args, guide,
-        guide_args, params, with_intermediates=False, **kwargs):
+        guide_args, params, with_intermediates=False, chunk_size=None, **kwargs):
     """ Samples n times from the posterior predictive distribution.
 
     Note that if the model function is written in such a way that it returns, e.g.,
@@ -170,6 +261,9 @@ def sample_multi_posterior_predictive(rng_key, n, model, model_args, guide,
         designated by call to `param` in the guide
     :param with_intermediates: If True, intermediate(/latent) samples from
         sample site distributions are included in the result.
+    :param chunk_size: If given, samples are drawn in chunks of `chunk_size`
+        draws at a time, which bounds the memory required for intermediate
+        values of model and guide. Draws are the same as without chunking.
     :param **kwargs: Keyword arguments passed to the model and guide functions.
     :return: Dictionary of sampled values associated with the names given
         via `sample()` in the model. If with_intermediates is True,
@@ -180,7 +274,40 @@ def sample_multi_posterior_predictive(rng_key, n, model, model_args, guide,
         rng, model, model_args, guide, guide_args, params,
         with_intermediates=with_intermediates, **kwargs
     )
-    return _sample_a_lot(rng_key, n, single_sample_fn)
+    return _sample_a_lot(rng_key, n, single_sample_fn, chunk_size)
+
+def stream_multi_posterior_predictive(rng_key, n, model, model_args, guide,
+        guide_args, params, chunk_size, with_intermediates=False, **kwargs):
+    """ Samples n times from the posterior predictive distribution and yields
+    the samples in chunks.
+
+    Only a single chunk is kept in memory at a time, allowing to generate
+    more samples than fit into memory at once. The concatenated chunks are
+    identical to the result of `sample_multi_posterior_predictive` for the
+    same arguments.
+
+    :param rng_key: Jax PRNG key
+    :param n: Number of draws from the posterior predictive.
+    :param model: Function representing the model using numpyro distributions
+        and the `sample` primitive
+    :param model_args: Arguments to the model function
+    :param guide: Function representing the variational distribution (the guide)
+        using numpyro distributions as well as the `sample` and `param` primitives
+    :param guide_args: Arguments to the guide function
+    :param params: A dictionary providing values for the parameters
+        designated by call to `param` in the guide
+    :param chunk_size: Number of draws per chunk. The last chunk may be smaller.
+    :param with_intermediates: If True, intermediate(/latent) samples from
+        sample site distributions are included in the result.
+    :param **kwargs: Keyword arguments passed to the model and guide functions.
+    :return: Generator of dictionaries of sampled values for each chunk, as
+        returned by `sample_multi_posterior_predictive`.
+    """
+    single_sample_fn = lambda rng: sample_posterior_predictive(
+        rng, model, model_args, guide, guide_args, params,
+        with_intermediates=with_intermediates, **kwargs
+    )
+    return _stream_a_lot(rng_key, n, single_sample_fn, chunk_size)
 
 def map_args_obs_to_shape(obs, *args, **kwargs):
     return unvectorize_shape_2d(obs), kwargs, {'obs': obs}
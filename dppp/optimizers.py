@@ -16,7 +16,11 @@ from numpyro.optim import _NumPyroOptim, _add_doc
 from jax.experimental.optimizers import make_schedule
 import jax.numpy as jnp
 import numpy as np
+import jax
 from jax import tree_map, tree_multimap, tree_leaves, lax
+from jax.tree_util import register_pytree_node
+
+from dppp.util import ravel_tree, unravel_tree, ravel_leaves
 
 def adadp(
         step_size=1e-3,
@@ -121,3 +125,294 @@ class ADADP(_NumPyroOptim):
         super(ADADP, self).__init__(
             adadp, step_size, tol, stability_check, alpha_min, alpha_max
         )
+
+
+## flat-vector variant of ADADP
+
+class FlatADADPState(object):
+    """ State of the flat-vector ADADP optimizer.
+
+    :param x: The current parameters as a flat vector.
+    :param lr: The current learning rate.
+    :param x_prev: The parameters before the last even step as a flat vector.
+    :param layout: Static layout to restore the parameter tree from `x`.
+    """
+
+    def __init__(self, x, lr, x_prev, layout):
+        self.x = x
+        self.lr = lr
+        self.x_prev = x_prev
+        self.layout = layout
+
+register_pytree_node(
+    FlatADADPState,
+    lambda state: ((state.x, state.lr, state.x_prev), state.layout),
+    lambda layout, children: FlatADADPState(*children, layout)
+)
+
+def flat_adadp(
+        step_size=1e-3,
+        tol=1.0,
+        stability_check=True,
+        alpha_min=0.9,
+        alpha_max=1.1
+    ):
+    """Construct optimizer triple for a memory-lean variant of the adaptive
+    learning rate optimizer of Koskela and Honkela.
+
+    Produces the same iterates as `adadp` (up to floating point rounding) but
+    keeps the parameters as contiguous flat vectors and stores only the
+    current and previous parameters: the full step needed for the error
+    estimate is recovered in odd steps as 2*x - x_prev, since the half step
+    taken in the even step is exactly half of it. The error estimate and the
+    decision to accept or reject the step are computed in a single pass over
+    the flat vectors.
+
+    Reference:
+    A. Koskela, A. Honkela: Learning Rate Adaptation for Federated and
+    Differentially Private Learning (https://arxiv.org/abs/1809.03832).
+
+    Args:
+    step_size: the initial step size
+    tol: error tolerance for the discretized gradient steps
+    stability_check: settings to True rejects some updates in favor of a more
+        stable algorithm
+    alpha_min: lower multiplitcative bound of learning rate update per step
+    alpha_max: upper multiplitcative bound of learning rate update per step
+
+    Returns:
+        An (init_fun, update_fun, get_params) triple.
+    """
+    init, step, get_params = _flat_adadp_fns(
+        step_size, tol, stability_check, alpha_min, alpha_max
+    )
+    return init, _flat_update(step), get_params
+
+def _flat_adadp_fns(step_size, tol, stability_check, alpha_min, alpha_max):
+    """ Returns init, step and get_params functions of the flat-vector ADADP
+    optimizer, where step takes the gradient as a flat vector. """
+    step_size = make_schedule(step_size)
+    def init(x0):
+        x, layout = ravel_tree(x0)
+        lr = jnp.asarray(step_size(0), dtype=x.dtype)
+        return FlatADADPState(x, lr, x, layout)
+
+    def _update_even_step(args):
+        new_x, state = args
+        return FlatADADPState(new_x, state.lr, state.x, state.layout)
+
+    def _update_odd_step(args):
+        new_x, state = args
+        x_stepped = 2 * state.x - state.x_prev
+
+        err_e = jnp.sqrt(jnp.sum(
+            ((x_stepped - new_x) / jnp.maximum(1., x_stepped)) ** 2
+        ))
+
+        new_lr = state.lr * jnp.minimum(
+            jnp.maximum(jnp.sqrt(tol/err_e), alpha_min), alpha_max
+        )
+        new_x = jnp.where(
+            jnp.logical_and(stability_check, err_e > tol), state.x_prev, new_x
+        )
+        return FlatADADPState(new_x, new_lr.astype(state.lr.dtype), state.x_prev, state.layout)
+
+    def step(i, g, state):
+        new_x = state.x - 0.5 * state.lr * g
+        return lax.cond(
+            i % 2 == 0,
+            (new_x, state),
+            _update_even_step,
+            (new_x, state),
+            _update_odd_step
+        )
+
+    def get_params(state):
+        return unravel_tree(state.x, state.layout)
+    return init, step, get_params
+
+def _flat_update(step):
+    """ Wraps a step function on flat gradient vectors into an optimizer
+    update function taking the gradient as a jax tree. """
+    def update(i, g, state):
+        return step(i, ravel_leaves(tree_leaves(g)), state)
+    return update
+
+@_add_doc(flat_adadp)
+class FlatADADP(_NumPyroOptim):
+
+    def __init__(self,
+                 step_size=1e-3,
+                 tol=1.0,
+                 stability_check=True,
+                 alpha_min=0.9,
+                 alpha_max=1.1) -> None:
+
+        super(FlatADADP, self).__init__(
+            flat_adadp, step_size, tol, stability_check, alpha_min, alpha_max
+        )
+
+
+## differentially private optimizers with fused noise addition
+
+class DPOptimizer(_NumPyroOptim):
+    """ Base class for optimizers that add the noise of the Gaussian mechanism
+    to the (clipped) batch gradient themselves.
+
+    In addition to the usual `update`, these optimizers provide `dp_update`,
+    which perturbs the gradient with Gaussian noise, rescales it and updates
+    the optimizer state in a single elementwise pass over a flat parameter
+    buffer. `DPSVI` uses `dp_update` if it is given a `DPOptimizer` instead of
+    perturbing each gradient site separately.
+
+    :param optim_fn: Function returning a (init_fun, step_fun, get_params)
+        triple, where step_fun takes the gradient as a flat vector.
+    """
+
+    def __init__(self, optim_fn, *args, **kwargs) -> None:
+        init_fn, step_fn, get_params_fn = optim_fn(*args, **kwargs)
+        super(DPOptimizer, self).__init__(
+            lambda: (init_fn, _flat_update(step_fn), get_params_fn)
+        )
+        self.step_fn = step_fn
+
+    def dp_update(self, g, state, rng, noise_std, grad_scale=1.):
+        """ Perturbs a gradient with Gaussian noise and updates the optimizer
+        state with it.
+
+        The gradient used in the update is (g + noise) * grad_scale, where
+        noise has standard deviation `noise_std` in every dimension.
+
+        :param g: Jax tree of the (clipped) batch gradient.
+        :param state: The current optimizer state.
+        :param rng: jax.random.PRNGKey for sampling the noise.
+        :param noise_std: Standard deviation of the noise.
+        :param grad_scale: Factor to scale the perturbed gradient with.
+        :return: The updated optimizer state.
+        """
+        i, opt_state = state
+        g = ravel_leaves(tree_leaves(g))
+        noise = jax.random.normal(rng, jnp.shape(g), dtype=g.dtype)
+        g = (g + noise_std * noise) * grad_scale
+        return i + 1, self.step_fn(i, g, opt_state)
+
+class FlatState(object):
+    """ State of the flat-vector SGD optimizer.
+
+    :param x: The current parameters as a flat vector.
+    :param layout: Static layout to restore the parameter tree from `x`.
+    """
+
+    def __init__(self, x, layout):
+        self.x = x
+        self.layout = layout
+
+register_pytree_node(
+    FlatState,
+    lambda state: ((state.x,), state.layout),
+    lambda layout, children: FlatState(*children, layout)
+)
+
+class FlatAdamState(object):
+    """ State of the flat-vector Adam optimizer.
+
+    :param x: The current parameters as a flat vector.
+    :param m: The first moment estimate as a flat vector.
+    :param v: The second moment estimate as a flat vector.
+    :param layout: Static layout to restore the parameter tree from `x`.
+    """
+
+    def __init__(self, x, m, v, layout):
+        self.x = x
+        self.m = m
+        self.v = v
+        self.layout = layout
+
+register_pytree_node(
+    FlatAdamState,
+    lambda state: ((state.x, state.m, state.v), state.layout),
+    lambda layout, children: FlatAdamState(*children, layout)
+)
+
+def _flat_sgd_fns(step_size):
+    """ Returns init, step and get_params functions of stochastic gradient
+    descent on a flat parameter vector. """
+    step_size = make_schedule(step_size)
+    def init(x0):
+        x, layout = ravel_tree(x0)
+        return FlatState(x, layout)
+
+    def step(i, g, state):
+        return FlatState(state.x - step_size(i) * g, state.layout)
+
+    def get_params(state):
+        return unravel_tree(state.x, state.layout)
+    return init, step, get_params
+
+def _flat_adam_fns(step_size, b1=0.9, b2=0.999, eps=1e-8):
+    """ Returns init, step and get_params functions of Adam on a flat
+    parameter vector. """
+    step_size = make_schedule(step_size)
+    def init(x0):
+        x, layout = ravel_tree(x0)
+        return FlatAdamState(x, jnp.zeros_like(x), jnp.zeros_like(x), layout)
+
+    def step(i, g, state):
+        m = (1 - b1) * g + b1 * state.m
+        v = (1 - b2) * jnp.square(g) + b2 * state.v
+        m_hat = m / (1 - b1 ** (i + 1))
+        v_hat = v / (1 - b2 ** (i + 1))
+        x = state.x - step_size(i) * m_hat / (jnp.sqrt(v_hat) + eps)
+        return FlatAdamState(x, m, v, state.layout)
+
+    def get_params(state):
+        return unravel_tree(state.x, state.layout)
+    return init, step, get_params
+
+class DPSGD(DPOptimizer):
+    """ Stochastic gradient descent on a flat parameter vector with fused
+    noise addition for differential privacy (see `DPOptimizer`).
+
+    :param step_size: The step size or a schedule.
+    """
+
+    def __init__(self, step_size) -> None:
+        super(DPSGD, self).__init__(_flat_sgd_fns, step_size)
+
+class DPAdam(DPOptimizer):
+    """ Adam on a flat parameter vector with fused noise addition for
+    differential privacy (see `DPOptimizer`).
+
+    :param step_size: The step size or a schedule.
+    :param b1: Exponential decay rate of the first moment estimates.
+    :param b2: Exponential decay rate of the second moment estimates.
+    :param eps: Constant for numerical stability.
+    """
+
+    def __init__(self, step_size, b1=0.9, b2=0.999, eps=1e-8) -> None:
+        super(DPAdam, self).__init__(_flat_adam_fns, step_size, b1, b2, eps)
+
+class DPADADP(DPOptimizer):
+    """ The flat-vector ADADP optimizer (see `FlatADADP`) with fused noise
+    addition for differential privacy (see `DPOptimizer`).
+
+    :param step_size: The initial step size.
+    :param tol: Error tolerance for the discretized gradient steps.
+    :param stability_check: If True, rejects some updates in favor of a more
+        stable algorithm.
+    :param alpha_min: Lower multiplicative bound of the learning rate update
+        per step.
+    :param alpha_max: Upper multiplicative bound of the learning rate update
+        per step.
+    """
+
+    def __init__(self,
+                 step_size=1e-3,
+                 tol=1.0,
+                 stability_check=True,
+                 alpha_min=0.9,
+                 alpha_max=1.1) -> None:
+
+        super(DPADADP, self).__init__(
+            _flat_adadp_fns, step_size, tol, stability_check, alpha_min, alpha_max
+        )
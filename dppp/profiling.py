@@ -0,0 +1,382 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Profiling utilities for the update step of `TunableSVI` (and `DPSVI`).
+
+Once jitted, the four stages of an update
+1) `_compute_per_example_gradients`,
+2) `_apply_per_example_gradient_transformations`,
+3) `_combine_and_transform_gradient`,
+4) `_apply_gradient`
+are fused into a single XLA computation, which hides how much each of them
+contributes. `profile_update` compiles and times each stage separately and
+reports the sizes of the buffers passed between stages, e.g.,
+
+>>> profile = profile_update(svi, svi_state, batch_X, batch_y, num_steps=20)
+>>> print_profile(profile)
+
+Stage timings are measured in isolation and thus miss optimizations across
+stage boundaries; the time of the fused update is reported for comparison.
+
+`plan_batch_size` estimates the peak memory of the update stages for
+candidate batch sizes without running them and recommends the largest batch
+size that fits a memory budget, e.g.,
+
+>>> plan = plan_batch_size(svi, svi_state, (batch_X, batch_y), [64, 256, 1024], 2**30)
+>>> plan.recommended_batch_size
+"""
+
+import sys
+import time
+import warnings
+from collections import namedtuple, OrderedDict
+
+import jax
+from jax import core
+import numpy as np
+
+__all__ = [
+    'StageProfile', 'UpdateProfile', 'profile_update', 'print_profile',
+    'MemoryEstimate', 'BatchSizePlan', 'estimate_update_memory', 'plan_batch_size'
+]
+
+StageProfile = namedtuple(
+    'StageProfile',
+    ['name', 'compile_time', 'step_time', 'output_bytes', 'temp_bytes']
+)
+StageProfile.__doc__ = """ Measurements for a single stage of the update.
+
+:param name: Name of the stage.
+:param compile_time: Time of the first call in seconds, including tracing and
+    compilation.
+:param step_time: Median time of a call after compilation in seconds.
+:param output_bytes: Total size of the buffers output by the stage in bytes.
+:param temp_bytes: Size of temporary buffers XLA allocates for the stage in
+    bytes, or None if the jax version does not expose it.
+"""
+
+UpdateProfile = namedtuple('UpdateProfile', ['stages', 'update'])
+UpdateProfile.__doc__ = """ Profile of an update step.
+
+:param stages: List of `StageProfile` for the four update stages.
+:param update: `StageProfile` of the complete (fused) update.
+"""
+
+def _tree_bytes(tree):
+    return int(sum(
+        np.size(leaf) * np.dtype(leaf.dtype).itemsize
+        for leaf in jax.tree_leaves(tree) if hasattr(leaf, 'dtype')
+    ))
+
+def _block_until_ready(tree):
+    for leaf in jax.tree_leaves(tree):
+        if hasattr(leaf, 'block_until_ready'):
+            leaf.block_until_ready()
+    return tree
+
+def _temp_bytes(jitted_fn, args):
+    # ahead-of-time lowering and the compiled memory analysis are only
+    #   available in newer jax versions
+    if not hasattr(jitted_fn, 'lower'):
+        return None
+    try:
+        analysis = jitted_fn.lower(*args).compile().memory_analysis()
+    except NotImplementedError:
+        return None
+    return getattr(analysis, 'temp_size_in_bytes', None)
+
+def _profile_stage(name, jitted_fn, args, num_steps):
+    start = time.perf_counter()
+    outputs = _block_until_ready(jitted_fn(*args))
+    compile_time = time.perf_counter() - start
+
+    times = []
+    for _ in range(num_steps):
+        start = time.perf_counter()
+        _block_until_ready(jitted_fn(*args))
+        times.append(time.perf_counter() - start)
+
+    profile = StageProfile(
+        name, compile_time, float(np.median(times)), _tree_bytes(outputs),
+        _temp_bytes(jitted_fn, args)
+    )
+    return outputs, profile
+
+def _start_trace(trace_dir):
+    if hasattr(jax.profiler, 'start_trace'):
+        jax.profiler.start_trace(trace_dir)
+        return True
+    warnings.warn(
+        "Capturing profiler traces requires a jax version providing "
+        "jax.profiler.start_trace; skipping the trace."
+    )
+    return False
+
+def profile_update(svi, svi_state, *args, num_steps=10, trace_dir=None, **kwargs):
+    """ Profiles the stages of the update step of a `TunableSVI` instance.
+
+    Note that stages are timed on the same inputs repeatedly and that the
+    optimizer state is not advanced.
+
+    :param svi: The `TunableSVI` (or `DPSVI`) instance.
+    :param svi_state: The current state of the SVI algorithm.
+    :param args: Arguments to the model / guide, i.e., a batch of data.
+    :param num_steps: Number of timed calls per stage after compilation.
+    :param trace_dir: Optional directory. If given, a profiler trace of
+        `num_steps` fused update steps is written to it, which can be viewed,
+        e.g., in TensorBoard. Stages are identified in the trace by the named
+        scopes set in `TunableSVI.update`.
+    :param kwargs: Keyword arguments to the model / guide.
+    :return: `UpdateProfile` of the update step.
+    """
+    compute_px_grads = jax.jit(
+        lambda svi_state, args: svi._compute_per_example_gradients(svi_state, *args, **kwargs)
+    )
+    (svi_state, px_loss, px_grads), compute_profile = _profile_stage(
+        'compute_per_example_gradients', compute_px_grads, (svi_state, args), num_steps
+    )
+
+    # the tree definition is not an array and cannot be passed through
+    #   a jitted function; it is the same as that of the raw gradients
+    tree_def = jax.tree_structure(px_grads)
+    transform_px_grads = jax.jit(
+        lambda svi_state, px_grads: svi._apply_per_example_gradient_transformations(svi_state, px_grads)[:2]
+    )
+    (svi_state, px_grads_list), transform_profile = _profile_stage(
+        'apply_per_example_gradient_transformations', transform_px_grads,
+        (svi_state, px_grads), num_steps
+    )
+
+    combine_grads = jax.jit(
+        lambda svi_state, px_grads_list, px_loss: svi._combine_and_transform_gradient(
+            svi_state, px_grads_list, px_loss, tree_def
+        )
+    )
+    (svi_state, _, gradient), combine_profile = _profile_stage(
+        'combine_and_transform_gradient', combine_grads,
+        (svi_state, px_grads_list, px_loss), num_steps
+    )
+
+    apply_gradient = jax.jit(svi._apply_gradient)
+    _, apply_profile = _profile_stage(
+        'apply_gradient', apply_gradient, (svi_state, gradient), num_steps
+    )
+
+    update = jax.jit(lambda svi_state, args: svi.update(svi_state, *args, **kwargs))
+    _, update_profile = _profile_stage('update', update, (svi_state, args), num_steps)
+
+    if trace_dir is not None and _start_trace(trace_dir):
+        try:
+            for _ in range(num_steps):
+                svi_state, _ = _block_until_ready(update(svi_state, args))
+        finally:
+            jax.profiler.stop_trace()
+
+    stages = [compute_profile, transform_profile, combine_profile, apply_profile]
+    return UpdateProfile(stages, update_profile)
+
+def print_profile(profile, file=sys.stdout):
+    """ Prints a per-stage breakdown of an `UpdateProfile`.
+
+    :param profile: The `UpdateProfile` as returned by `profile_update`.
+    :param file: The stream to print to.
+    """
+    def format_bytes(num_bytes):
+        return "n/a" if num_bytes is None else "{:.2f}".format(num_bytes / 2**20)
+
+    total_stage_time = sum(stage.step_time for stage in profile.stages)
+    print("{:<44} {:>10} {:>7} {:>12} {:>11} {:>11}".format(
+        'stage', 'step [ms]', 'share', 'compile [s]', 'output [MB]', 'temp [MB]'
+    ), file=file)
+    for stage in profile.stages + [profile.update]:
+        share = stage.step_time / total_stage_time if total_stage_time > 0 else 0.
+        print("{:<44} {:>10.3f} {:>7} {:>12.2f} {:>11} {:>11}".format(
+            stage.name, stage.step_time * 1e3,
+            "{:.1%}".format(share) if stage is not profile.update else "",
+            stage.compile_time, format_bytes(stage.output_bytes),
+            format_bytes(stage.temp_bytes)
+        ), file=file)
+
+
+MemoryEstimate = namedtuple('MemoryEstimate', ['batch_size', 'stages', 'peak_bytes'])
+MemoryEstimate.__doc__ = """ Estimated peak memory of an update step.
+
+:param batch_size: The batch size of the estimate.
+:param stages: Dictionary of estimated peak memory in bytes per update stage,
+    including the stage inputs.
+:param peak_bytes: Estimated peak memory in bytes over all stages.
+"""
+
+BatchSizePlan = namedtuple('BatchSizePlan', ['estimates', 'memory_budget', 'recommended_batch_size'])
+BatchSizePlan.__doc__ = """ Memory estimates for candidate batch sizes.
+
+:param estimates: List of `MemoryEstimate`, one per candidate batch size.
+:param memory_budget: The memory budget in bytes.
+:param recommended_batch_size: The largest candidate batch size whose
+    estimated peak memory fits within the budget, or None if none does.
+"""
+
+def _var_bytes(var):
+    if isinstance(var, core.Literal):
+        return 0
+    aval = var.aval
+    if not hasattr(aval, 'shape'):
+        return 0
+    return int(np.prod(aval.shape, dtype=np.int64)) * np.dtype(aval.dtype).itemsize
+
+def _sub_jaxprs(params):
+    for value in params.values():
+        values = value if isinstance(value, (tuple, list)) else (value,)
+        for v in values:
+            if isinstance(v, core.Jaxpr):
+                yield v
+            elif isinstance(getattr(v, 'jaxpr', None), core.Jaxpr):
+                yield v.jaxpr
+
+def _jaxpr_peak_bytes(jaxpr):
+    """ Estimates the peak memory required to evaluate a jaxpr by a liveness
+    analysis of its variables.
+
+    Each variable is assumed to occupy a buffer from the equation that
+    produces it up to its last use; inputs and constants are live
+    throughout. Sub-computations (e.g., of `scan` or nested `jit`) contribute
+    their own peak minus their inputs and outputs while they are running.
+    This ignores buffer reuse and fusion by XLA, so the estimate tends to be
+    conservative.
+    """
+    last_use = dict()
+    for i, eqn in enumerate(jaxpr.eqns):
+        for var in eqn.invars:
+            if not isinstance(var, core.Literal):
+                last_use[var] = i
+    for var in jaxpr.outvars:
+        if not isinstance(var, core.Literal):
+            last_use[var] = len(jaxpr.eqns)
+
+    # inputs and constants are owned by the caller and never freed
+    inputs = list(jaxpr.constvars) + list(jaxpr.invars)
+    current = sum(_var_bytes(var) for var in inputs)
+    live = dict()
+    peak = current
+    for i, eqn in enumerate(jaxpr.eqns):
+        out_bytes = sum(_var_bytes(var) for var in eqn.outvars)
+        transient = 0
+        for sub_jaxpr in _sub_jaxprs(eqn.params):
+            sub_io_bytes = sum(_var_bytes(var) for var in list(sub_jaxpr.invars) + list(sub_jaxpr.outvars))
+            transient = max(transient, _jaxpr_peak_bytes(sub_jaxpr) - sub_io_bytes)
+        peak = max(peak, current + out_bytes + transient)
+
+        for var in eqn.outvars:
+            live[var] = _var_bytes(var)
+            current += live[var]
+        for var in list(eqn.invars) + list(eqn.outvars):
+            if isinstance(var, core.Literal):
+                continue
+            if var in live and last_use.get(var, -1) <= i:
+                current -= live.pop(var)
+    return peak
+
+def _abstract_like(value):
+    """ Returns an array of the same shape and dtype as `value` that occupies
+    no memory, for use in tracing. """
+    dtype = value.dtype if hasattr(value, 'dtype') else np.result_type(value)
+    shape = value.shape if hasattr(value, 'shape') else np.shape(value)
+    return np.broadcast_to(np.zeros((), dtype=dtype), shape)
+
+def _traced_peak_bytes(fn, args):
+    return _jaxpr_peak_bytes(jax.make_jaxpr(fn)(*args).jaxpr)
+
+def estimate_update_memory(svi, svi_state, *args, **kwargs):
+    """ Estimates the peak memory of the stages of the update step of a
+    `TunableSVI` instance from the traced computations, without running them.
+
+    Only the shapes and dtypes of `args` matter; see `plan_batch_size` to
+    evaluate several batch sizes.
+
+    :param svi: The `TunableSVI` (or `DPSVI`) instance.
+    :param svi_state: The current state of the SVI algorithm.
+    :param args: Arguments to the model / guide, i.e., a batch of data.
+    :param kwargs: Keyword arguments to the model / guide.
+    :return: `MemoryEstimate`; its batch size is the leading dimension of the
+        first argument.
+    """
+    svi_state = jax.tree_map(_abstract_like, svi_state)
+    args = jax.tree_map(_abstract_like, args)
+
+    def compute_px_grads(svi_state, args):
+        return svi._compute_per_example_gradients(svi_state, *args, **kwargs)
+    compute_peak = _traced_peak_bytes(compute_px_grads, (svi_state, args))
+    _, px_loss, px_grads = jax.eval_shape(compute_px_grads, svi_state, args)
+    px_loss, px_grads = jax.tree_map(_abstract_like, (px_loss, px_grads))
+
+    def transform_px_grads(svi_state, px_grads):
+        return svi._apply_per_example_gradient_transformations(svi_state, px_grads)[:2]
+    transform_peak = _traced_peak_bytes(transform_px_grads, (svi_state, px_grads))
+    px_grads_list = jax.tree_leaves(px_grads)
+
+    tree_def = jax.tree_structure(px_grads)
+    def combine_grads(svi_state, px_grads_list, px_loss):
+        return svi._combine_and_transform_gradient(svi_state, px_grads_list, px_loss, tree_def)
+    combine_peak = _traced_peak_bytes(combine_grads, (svi_state, px_grads_list, px_loss))
+
+    stages = OrderedDict([
+        ('compute_per_example_gradients', compute_peak),
+        ('apply_per_example_gradient_transformations', transform_peak),
+        ('combine_and_transform_gradient', combine_peak),
+    ])
+    batch_size = np.shape(jax.tree_leaves(args)[0])[0]
+    return MemoryEstimate(int(batch_size), stages, max(stages.values()))
+
+def _device_memory_limit():
+    device = jax.devices()[0]
+    if hasattr(device, 'memory_stats'):
+        stats = device.memory_stats()
+        if stats is not None and 'bytes_limit' in stats:
+            return int(stats['bytes_limit'])
+    return None
+
+def plan_batch_size(svi, svi_state, example_batch, batch_sizes, memory_budget=None, **kwargs):
+    """ Estimates peak memory of the update step for candidate batch sizes and
+    recommends the largest one that fits into a memory budget.
+
+    Estimation is based on abstract evaluation only; no arrays of the
+    candidate batch sizes are allocated.
+
+    :param svi: The `TunableSVI` (or `DPSVI`) instance.
+    :param svi_state: The current state of the SVI algorithm, e.g., as
+        returned by `svi.init` for a small batch.
+    :param example_batch: Tuple of arguments to the model / guide for a batch
+        of data of any size; all arrays must share the leading batch dimension.
+    :param batch_sizes: Sequence of candidate batch sizes.
+    :param memory_budget: Memory budget in bytes. Defaults to the memory
+        limit of the default device, if the backend reports it.
+    :param kwargs: Keyword arguments to the model / guide.
+    :return: `BatchSizePlan` with the estimates and the recommended batch size.
+    """
+    if memory_budget is None:
+        memory_budget = _device_memory_limit()
+        if memory_budget is None:
+            raise ValueError("The device does not report a memory limit; memory_budget must be given")
+
+    estimates = []
+    for batch_size in sorted(batch_sizes):
+        batch = tuple(
+            np.broadcast_to(np.zeros((), dtype=a.dtype), (batch_size,) + np.shape(a)[1:])
+            for a in example_batch
+        )
+        estimates.append(estimate_update_memory(svi, svi_state, *batch, **kwargs))
+
+    fitting = [e.batch_size for e in estimates if e.peak_bytes <= memory_budget]
+    recommended = max(fitting) if len(fitting) > 0 else None
+    return BatchSizePlan(estimates, memory_budget, recommended)
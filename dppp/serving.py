@@ -0,0 +1,324 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Serving of posterior predictive draws from a fitted model.
+
+`PredictiveServer` queues requests for (typically few) draws and coalesces
+requests arriving within a short time window into a single call of a
+compiled, vectorized sampler. Each request receives exactly the draws that
+`sample_multi_posterior_predictive` would return for its key, regardless of
+which other requests it was batched with.
+
+Example (within a running asyncio event loop):
+
+>>> server = PredictiveServer(model, (1,), guide, (1,), params)
+>>> async with server:
+...     samples = await server.sample(10, rng_key)
+
+For synchronous consumers, `LocalClient` runs a server on an event loop in
+a background thread.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from dppp.svi import sample_posterior_predictive
+
+__all__ = ['PredictiveServer', 'LocalClient']
+
+_Request = collections.namedtuple('_Request', ['n', 'rng_key', 'future', 'arrival_time'])
+
+class PredictiveServer(object):
+    """ Asynchronous micro-batching server for posterior predictive draws.
+
+    Batches are padded to the next power of two draws, so that the sampler is
+    compiled at most once per power of two up to `max_batch_size` (see
+    `warmup`).
+
+    :param model: Function representing the model using numpyro distributions
+        and the `sample` primitive
+    :param model_args: Arguments to the model function
+    :param guide: Function representing the variational distribution (the guide)
+        using numpyro distributions as well as the `sample` and `param` primitives
+    :param guide_args: Arguments to the guide function
+    :param params: A dictionary providing values for the parameters
+        designated by call to `param` in the guide
+    :param rng_key: Jax PRNG key from which keys for requests without a key
+        are derived.
+    :param max_batch_size: Maximum number of draws per batch. Larger requests
+        are served in a batch of their own.
+    :param max_delay: Maximum time in seconds to wait for further requests
+        after the first request of a batch arrived.
+    :param max_latency_samples: Number of most recent request latencies kept
+        for metrics.
+    """
+
+    def __init__(self, model, model_args, guide, guide_args, params,
+            rng_key=None, max_batch_size=1024, max_delay=1e-3,
+            max_latency_samples=10000):
+        def sample_one(rng_key, params):
+            return sample_posterior_predictive(
+                rng_key, model, model_args, guide, guide_args, params
+            )
+        self._sample_batch = jax.jit(jax.vmap(sample_one, in_axes=(0, None)))
+
+        self._params = params
+        self._rng_key = rng_key if rng_key is not None else jax.random.PRNGKey(0)
+        self._num_unkeyed_requests = 0
+        self.max_batch_size = int(max_batch_size)
+        self.max_delay = max_delay
+
+        self._queue = None
+        self._task = None
+        # a single worker thread serializes all calls to jax
+        self._executor = None
+
+        self._num_requests = 0
+        self._num_batches = 0
+        self._num_draws = 0
+        self._busy_time = 0.
+        self._start_time = None
+        self._latencies = collections.deque(maxlen=max_latency_samples)
+
+    @property
+    def is_running(self):
+        return self._task is not None
+
+    def update_params(self, params):
+        """ Replaces the parameters that draws are sampled with. Parameters
+        of the same shapes do not require recompilation. """
+        self._params = params
+
+    @staticmethod
+    def _padded_size(n):
+        size = 1
+        while size < n:
+            size *= 2
+        return size
+
+    def warmup(self):
+        """ Compiles the sampler for all batch sizes up to `max_batch_size`
+        so that no compilation happens while serving. """
+        size = 1
+        while True:
+            self._run_batch([(self._rng_key, size)])
+            if size >= self.max_batch_size:
+                break
+            size *= 2
+
+    def _run_batch(self, keys_and_sizes):
+        """ Samples draws for all requests in a single vectorized call.
+
+        :param keys_and_sizes: List of rng key and number of draws per request.
+        :return: List of dictionaries of sampled values per request.
+        """
+        total = sum(n for _, n in keys_and_sizes)
+        keys = jnp.concatenate([jax.random.split(key, n) for key, n in keys_and_sizes])
+        padded_size = self._padded_size(total)
+        if padded_size > total:
+            keys = jnp.concatenate((keys, jnp.tile(keys[:1], (padded_size - total, 1))))
+        samples = jax.device_get(self._sample_batch(keys, self._params))
+
+        results = []
+        start = 0
+        for _, n in keys_and_sizes:
+            results.append({site: values[start : start + n] for site, values in samples.items()})
+            start += n
+        return results
+
+    async def start(self):
+        """ Starts processing requests on the running event loop. """
+        if self.is_running:
+            raise RuntimeError("The server is already running")
+        self._queue = asyncio.Queue()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._start_time = time.perf_counter()
+        self._task = asyncio.ensure_future(self._batch_loop())
+
+    async def stop(self):
+        """ Serves all queued requests and stops the server. """
+        if not self.is_running:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        self._queue = None
+        self._executor.shutdown()
+        self._executor = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def sample(self, n, rng_key=None):
+        """ Requests n draws from the posterior predictive distribution.
+
+        :param n: Number of draws.
+        :param rng_key: Jax PRNG key for the draws. If None, a key is derived
+            from the key of the server.
+        :return: Dictionary of sampled values (as numpy arrays) equal to
+            `sample_multi_posterior_predictive` for the same key.
+        """
+        if not self.is_running:
+            raise RuntimeError("The server is not running")
+        if n < 1:
+            raise ValueError("The number of draws must be positive")
+        if rng_key is None:
+            rng_key = jax.random.fold_in(self._rng_key, self._num_unkeyed_requests)
+            self._num_unkeyed_requests += 1
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put(_Request(int(n), rng_key, future, time.perf_counter()))
+        return await future
+
+    async def _batch_loop(self):
+        loop = asyncio.get_event_loop()
+        pending = None
+        stopping = False
+        while not stopping:
+            request = pending if pending is not None else await self._queue.get()
+            pending = None
+            if request is None:
+                break
+
+            batch = [request]
+            num_draws = request.n
+            deadline = loop.time() + self.max_delay
+            while num_draws < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                if num_draws + request.n > self.max_batch_size:
+                    pending = request
+                    break
+                batch.append(request)
+                num_draws += request.n
+
+            await self._process(loop, batch, num_draws)
+
+    async def _process(self, loop, batch, num_draws):
+        start = time.perf_counter()
+        try:
+            results = await loop.run_in_executor(
+                self._executor, self._run_batch,
+                [(request.rng_key, request.n) for request in batch]
+            )
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+        end = time.perf_counter()
+
+        self._num_batches += 1
+        self._num_requests += len(batch)
+        self._num_draws += num_draws
+        self._busy_time += end - start
+        for request, samples in zip(batch, results):
+            self._latencies.append(end - request.arrival_time)
+            if not request.future.done():
+                request.future.set_result(samples)
+
+    def get_metrics(self, quantiles=(.5, .9, .99)):
+        """ Returns throughput and latency metrics of the server.
+
+        :param quantiles: Quantiles of the request latency to report.
+        :return: dictionary with entries
+            - 'num_requests', 'num_batches', 'num_draws': totals of served
+                requests, sampler calls and draws
+            - 'mean_requests_per_batch', 'mean_draws_per_batch': the degree
+                of coalescing
+            - 'draws_per_second': draws served per second since the start
+            - 'busy_fraction': fraction of time spent sampling
+            - 'latency_s': dictionary of latency quantiles (in seconds) over
+                the most recent requests, from arrival to result
+        """
+        elapsed = time.perf_counter() - self._start_time if self._start_time is not None else 0.
+        latencies = np.array(self._latencies)
+        return {
+            'num_requests': self._num_requests,
+            'num_batches': self._num_batches,
+            'num_draws': self._num_draws,
+            'mean_requests_per_batch': self._num_requests / max(self._num_batches, 1),
+            'mean_draws_per_batch': self._num_draws / max(self._num_batches, 1),
+            'draws_per_second': self._num_draws / elapsed if elapsed > 0 else 0.,
+            'busy_fraction': self._busy_time / elapsed if elapsed > 0 else 0.,
+            'latency_s': {
+                q: float(np.quantile(latencies, q)) if len(latencies) > 0 else np.nan
+                for q in quantiles
+            },
+        }
+
+class LocalClient(object):
+    """ Blocking in-process client for a `PredictiveServer`.
+
+    Runs the server on an event loop in a background thread, so that it can
+    be used from synchronous code, e.g., several consumer threads.
+
+    :param server: The `PredictiveServer` to run.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._run(server.start()).result()
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def sample_async(self, n, rng_key=None):
+        """ Requests n draws without waiting for the result.
+
+        :return: `concurrent.futures.Future` of the sampled values.
+        """
+        return self._run(self.server.sample(n, rng_key))
+
+    def sample(self, n, rng_key=None, timeout=None):
+        """ Requests n draws and waits for the result (see
+        `PredictiveServer.sample`). """
+        return self.sample_async(n, rng_key).result(timeout)
+
+    def get_metrics(self):
+        return self.server.get_metrics()
+
+    def close(self):
+        """ Stops the server and the event loop thread. """
+        self._run(self.server.stop()).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
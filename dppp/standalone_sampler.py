@@ -0,0 +1,164 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Numpy-only sampler for posterior predictive distributions exported with
+`dppp.export`.
+
+This module depends only on numpy so that consumers of a fitted model can
+draw samples without importing (or compiling with) jax and numpyro. It can
+also be copied and used on its own.
+
+>>> from dppp.standalone_sampler import ExportedSampler
+>>> sampler = ExportedSampler.load('posterior.npz')
+>>> samples = sampler.sample(1000, seed=0)
+
+Draws follow the same distribution as `sample_multi_posterior_predictive`
+for the exported model and parameters, but use numpy's random number
+generators and thus differ from those of jax for the same seed.
+"""
+
+import json
+
+import numpy as np
+
+__all__ = ['FORMAT_VERSION', 'SUPPORTED_FAMILIES', 'ExportedSampler']
+
+FORMAT_VERSION = 1
+SPEC_KEY = '__spec__'
+
+def _align_param(value, is_reference, sample_shape, param_shape):
+    """ Aligns a distribution parameter with values of shape
+    (n, *sample_shape, *dist_shape).
+
+    Parameters referring to other sites carry a leading axis of n draws,
+    constant parameters are shared by all draws. Either is right-aligned
+    with `param_shape`, the shape of the parameter for a single draw, and
+    broadcast over the sample shape.
+    """
+    value = np.asarray(value)
+    if not is_reference:
+        value = value[np.newaxis]
+    num_missing = len(param_shape) - (value.ndim - 1)
+    return np.reshape(
+        value, value.shape[:1] + (1,) * (len(sample_shape) + num_missing) + value.shape[1:]
+    )
+
+def _sample_delta(rng, shape, value):
+    return np.broadcast_to(value, shape).copy()
+
+def _sample_normal(rng, shape, loc, scale):
+    return loc + scale * rng.standard_normal(shape)
+
+def _sample_dirichlet(rng, shape, concentration):
+    gammas = rng.standard_gamma(np.broadcast_to(concentration, shape))
+    return gammas / np.sum(gammas, axis=-1, keepdims=True)
+
+def _sample_gaussian_mixture(rng, shape, locs, scales, pis, event_ndim):
+    # locs and scales have the component axis in front of the event axes
+    component_axis = -(event_ndim + 1)
+    batch_shape = shape[:len(shape) - event_ndim]
+
+    pis = np.broadcast_to(pis, batch_shape + np.shape(pis)[-1:])
+    cumulative = np.cumsum(pis, axis=-1)
+    u = rng.uniform(size=batch_shape)[..., np.newaxis] * cumulative[..., -1:]
+    z = np.minimum(np.sum(u >= cumulative, axis=-1), np.shape(pis)[-1] - 1)
+
+    num_components = np.shape(locs)[component_axis]
+    component_shape = batch_shape + (num_components,) + shape[len(batch_shape):]
+    index = np.reshape(z, batch_shape + (1,) * (event_ndim + 1))
+    loc = np.take_along_axis(
+        np.broadcast_to(locs, component_shape), index, axis=component_axis
+    )
+    scale = np.take_along_axis(
+        np.broadcast_to(scales, component_shape), index, axis=component_axis
+    )
+    loc = np.squeeze(loc, axis=component_axis)
+    scale = np.squeeze(scale, axis=component_axis)
+    return loc + scale * rng.standard_normal(shape)
+
+_FAMILIES = {
+    'delta': (_sample_delta, ('value',)),
+    'normal': (_sample_normal, ('loc', 'scale')),
+    'dirichlet': (_sample_dirichlet, ('concentration',)),
+    'gaussian_mixture': (_sample_gaussian_mixture, ('locs', 'scales', 'pis')),
+}
+
+SUPPORTED_FAMILIES = tuple(_FAMILIES)
+
+class ExportedSampler(object):
+    """ Samples from an exported posterior predictive distribution.
+
+    :param spec: The specification of the sample sites, as written by
+        `dppp.export.export_posterior_predictive`.
+    :param arrays: Dictionary of the constant parameter arrays referred to
+        by the specification.
+    """
+
+    def __init__(self, spec, arrays):
+        if spec.get('format_version') != FORMAT_VERSION:
+            raise ValueError("Unsupported format version {}".format(spec.get('format_version')))
+        for site in spec['sites']:
+            if site['family'] not in _FAMILIES:
+                raise ValueError("Unsupported distribution family '{}' at site '{}'".format(
+                    site['family'], site['name']
+                ))
+        self.spec = spec
+        self._arrays = arrays
+
+    @classmethod
+    def load(cls, path):
+        """ Loads an exported sampler from a file written by
+        `dppp.export.export_posterior_predictive`. """
+        with np.load(path, allow_pickle=False) as contents:
+            arrays = {key: contents[key] for key in contents.files if key != SPEC_KEY}
+            spec = json.loads(str(contents[SPEC_KEY]))
+        return cls(spec, arrays)
+
+    @property
+    def sites(self):
+        """ Names of the sample sites in sampling order. """
+        return [site['name'] for site in self.spec['sites']]
+
+    def sample(self, n, seed=None, sites=None):
+        """ Draws n samples from the posterior predictive distribution.
+
+        :param n: Number of draws.
+        :param seed: Seed or `numpy.random.Generator` for the draws.
+        :param sites: Names of the sites to return; all sites if None.
+        :return: Dictionary of sampled values per site, each with a leading
+            axis of n draws.
+        """
+        rng = np.random.default_rng(seed)
+        samples = dict()
+        for site in self.spec['sites']:
+            sample_fn, param_names = _FAMILIES[site['family']]
+            sample_shape = tuple(site['sample_shape'])
+            shape = (n,) + sample_shape + tuple(site['shape'])
+
+            params = []
+            for param_name in param_names:
+                param = site['params'][param_name]
+                if 'site' in param:
+                    value, is_reference = samples[param['site']], True
+                else:
+                    value, is_reference = self._arrays[param['array']], False
+                params.append(
+                    _align_param(value, is_reference, sample_shape, param['shape'])
+                )
+            kwargs = {'event_ndim': site['event_ndim']} if site['family'] == 'gaussian_mixture' else {}
+            samples[site['name']] = sample_fn(rng, shape, *params, **kwargs)
+
+        if sites is not None:
+            samples = {name: samples[name] for name in sites}
+        return samples
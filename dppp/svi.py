@@ -20,12 +20,20 @@ import functools
 import jax
 from jax import random
 import jax.numpy as jnp
+import numpy as np
+from collections import namedtuple
 
 from numpyro.infer.svi import SVI, SVIState
 import numpyro.distributions as dist
 from numpyro.handlers import seed, trace, substitute
 
-from dppp.util import map_over_secondary_dims, example_count
+from dppp.util import map_over_secondary_dims, example_count, named_scope, \
+    ravel_tree, unravel_tree, checkpoint
+from dppp.tracing import count_traces
+from dppp.modelling import _sample_a_lot, _stream_a_lot
+from dppp.optimizers import DPOptimizer
+from dppp.dputil import get_epsilon_for_phases, PrivacyPhase, \
+    get_epsilon_at_step, AccountingService
 
 from fourier_accountant.compute_eps import get_epsilon_S, get_epsilon_R
 from fourier_accountant.compute_delta import get_delta_S, get_delta_R
@@ -34,7 +42,7 @@ def per_example_value_and_grad(fun, argnums=0, has_aux=False, holomorphic=False)
     # vmap removes leading dimensions, we re-add those in a wrapper for fun so
     # that fun can be oblivious of this
     def fun_for_vmap(params, args):
-        new_args = (jnp.reshape(arg, (1, *jnp.shape(arg))) for arg in args)
+        new_args = tuple(jnp.reshape(arg, (1, *jnp.shape(arg))) for arg in args)
         return fun(params, new_args)
     value_and_grad_fun = jax.value_and_grad(fun_for_vmap, argnums, has_aux, holomorphic)
     return jax.vmap(value_and_grad_fun, in_axes=(None, 0))
@@ -52,6 +60,33 @@ class CombinedLoss(object):
         ))
 
 
+TunableSVIState = namedtuple(
+    'TunableSVIState', ['optim_state', 'rng_key', 'gradient_statistics']
+)
+TunableSVIState.__doc__ = """ State of `TunableSVI` when gradient statistics
+are collected. Extends numpyro's `SVIState` by the accumulated
+`GradientStatistics`.
+"""
+
+GradientStatistics = namedtuple(
+    'GradientStatistics',
+    ['norm_histogram', 'num_examples', 'num_clipped', 'noise_to_signal_sum', 'num_steps']
+)
+GradientStatistics.__doc__ = """ Gradient statistics accumulated on the device
+during the updates of `TunableSVI`.
+
+:param norm_histogram: Counts of per-example gradient norms per bin, where
+    the first and last bins count norms below the first and above the last
+    bin edge.
+:param num_examples: Total number of per-example gradients.
+:param num_clipped: Number of per-example gradients whose norm was reduced
+    by the per-example gradient transformation (e.g., by clipping).
+:param noise_to_signal_sum: Sum over steps of the ratio between the norm of
+    the change made by the batch gradient transformation (e.g., DP noise)
+    and the norm of the combined gradient.
+:param num_steps: Number of update steps.
+"""
+
 class TunableSVI(SVI):
     """
     Tunable Stochastic Variational Inference given a per-example loss objective
@@ -89,21 +124,169 @@ class TunableSVI(SVI):
     :param batch_grad_manipulation_fn: An optional function that allows to modify
         the total gradient. This gets called after applying the
         per_example_grad_manipulation_fn and loss_combiner_fn.
+    :param gradient_statistics_bins: If given, gradient statistics are
+        accumulated on the device during updates and can be read out with
+        `get_gradient_statistics`. Either a sequence of increasing bin edges
+        for the histogram of per-example gradient norms or the number of
+        logarithmically spaced edges in [1e-4, 1e4].
+    :param per_example_grad_dtype: If given, per-example gradients are stored
+        in this (floating point) dtype, e.g., `jnp.bfloat16`, to reduce memory
+        requirements for large models. Norms and the combined batch gradient
+        are still computed in (at least) float32.
+    :param remat_policy: If given, the per-example loss is rematerialized
+        (see `jax.checkpoint`): intermediate values such as network
+        activations are recomputed in the backward pass instead of being
+        kept in memory for all examples in the batch. Either 'full' to
+        recompute all intermediate values or a rematerialization policy (see
+        `dppp.util.checkpoint`).
+    :param flat_parameters: If True, all parameters are kept in a single
+        contiguous vector. Per-example gradients are then a single array of
+        shape (batch_size, num_params), so per-example and batch gradient
+        manipulations as well as the optimizer operate on one array instead
+        of one per parameter site. `get_params` still returns the parameters
+        per site.
     :param static_kwargs: static arguments for the model / guide, i.e. arguments
         that remain constant during fitting.
     """
 
+    # factor applied to per-example gradient norms in gradient statistics
+    _gradient_norm_scale = 1.
+
     def __init__(self, model, guide, optim, per_example_loss,
             per_example_grad_manipulation_fn=None,
-            batch_grad_manipulation_fn=None, **static_kwargs):
+            batch_grad_manipulation_fn=None, gradient_statistics_bins=None,
+            per_example_grad_dtype=None, remat_policy=None, flat_parameters=False,
+            **static_kwargs):
+
+        if per_example_grad_dtype is not None and \
+                not jnp.issubdtype(per_example_grad_dtype, jnp.floating):
+            raise ValueError("per_example_grad_dtype must be a floating point type")
+        self.per_example_grad_dtype = per_example_grad_dtype
+        self.remat_policy = remat_policy
+        if remat_policy is not None:
+            checkpoint(lambda x: x, remat_policy) # fail early on invalid policies
 
         self.px_grad_manipulation_fn = per_example_grad_manipulation_fn
         self.batch_grad_manipulation_fn = batch_grad_manipulation_fn
+        self.flat_parameters = flat_parameters
+        self._param_layout = None # set in init if flat_parameters
+
+        if gradient_statistics_bins is None:
+            self._gradient_norm_bin_edges = None
+        elif np.ndim(gradient_statistics_bins) == 0:
+            self._gradient_norm_bin_edges = np.geomspace(1e-4, 1e4, int(gradient_statistics_bins))
+        else:
+            self._gradient_norm_bin_edges = np.asarray(gradient_statistics_bins, dtype=np.float32)
+            if np.any(np.diff(self._gradient_norm_bin_edges) <= 0):
+                raise ValueError("Bin edges for gradient statistics must be increasing")
 
         total_loss = CombinedLoss(per_example_loss, combiner_fn = jnp.mean)
 
         super().__init__(model, guide, optim, total_loss, **static_kwargs)
 
+    @property
+    def collects_gradient_statistics(self):
+        return self._gradient_norm_bin_edges is not None
+
+    def init(self, rng_key, *args, **kwargs):
+        svi_state = super().init(rng_key, *args, **kwargs)
+        if self.flat_parameters:
+            params, self._param_layout = ravel_tree(
+                self.optim.get_params(svi_state.optim_state)
+            )
+            svi_state = svi_state._replace(optim_state=self.optim.init(params))
+        if self.collects_gradient_statistics:
+            svi_state = TunableSVIState(
+                svi_state.optim_state, svi_state.rng_key,
+                self._init_gradient_statistics()
+            )
+        return svi_state
+
+    def _as_param_tree(self, params):
+        """ Returns the unconstrained parameters per site for parameters as
+        held by the optimizer. """
+        if self.flat_parameters:
+            return unravel_tree(params, self._param_layout)
+        return params
+
+    def get_params(self, svi_state):
+        """ Returns the (constrained) parameters per site.
+
+        :param svi_state: The current state of the SVI algorithm.
+        """
+        return self.constrain_fn(
+            self._as_param_tree(self.optim.get_params(svi_state.optim_state))
+        )
+
+    def _init_gradient_statistics(self):
+        return GradientStatistics(
+            norm_histogram=jnp.zeros(len(self._gradient_norm_bin_edges) + 1, dtype=jnp.int32),
+            num_examples=jnp.array(0, dtype=jnp.int32),
+            num_clipped=jnp.array(0, dtype=jnp.int32),
+            noise_to_signal_sum=jnp.array(0.),
+            num_steps=jnp.array(0, dtype=jnp.int32)
+        )
+
+    def reset_gradient_statistics(self, svi_state):
+        """ Returns the given state with all gradient statistics set to zero. """
+        return svi_state._replace(gradient_statistics=self._init_gradient_statistics())
+
+    def get_gradient_statistics(self, svi_state, quantiles=(.5, .9, .99)):
+        """ Reads out the gradient statistics accumulated in the state.
+
+        This transfers the statistics to the host and should thus be called
+        only occasionally, not within the training loop.
+
+        :param svi_state: The current state of the SVI algorithm.
+        :param quantiles: Quantiles of the per-example gradient norm to
+            estimate from the histogram.
+        :return: dictionary with entries
+            - 'num_steps': the number of updates
+            - 'num_examples': the number of per-example gradients
+            - 'clipped_fraction': the fraction of per-example gradients whose
+                norm was reduced by the per-example gradient transformation
+            - 'mean_noise_to_signal': the mean over steps of the noise to
+                signal ratio of the batch gradient transformation
+            - 'bin_edges', 'norm_histogram': the histogram of per-example
+                gradient norms (see `GradientStatistics`)
+            - 'norm_quantiles': dictionary of estimated norm quantiles,
+                linearly interpolated within bins; quantiles beyond the last
+                bin edge are reported as inf
+        """
+        if not self.collects_gradient_statistics:
+            raise ValueError("Gradient statistics are not collected; set gradient_statistics_bins")
+        stats = jax.device_get(svi_state.gradient_statistics)
+        edges = self._gradient_norm_bin_edges
+        counts = np.asarray(stats.norm_histogram)
+        num_examples = int(stats.num_examples)
+        num_steps = int(stats.num_steps)
+
+        lower = np.concatenate(([0.], edges))
+        upper = np.concatenate((edges, [np.inf]))
+        cumulative = np.cumsum(counts)
+        norm_quantiles = dict()
+        for q in quantiles:
+            target = q * num_examples
+            i = min(int(np.searchsorted(cumulative, target)), len(counts) - 1)
+            if num_examples == 0:
+                norm_quantiles[q] = np.nan
+            elif np.isinf(upper[i]):
+                norm_quantiles[q] = np.inf
+            else:
+                below = cumulative[i] - counts[i]
+                fraction = (target - below) / counts[i] if counts[i] > 0 else 0.
+                norm_quantiles[q] = float(lower[i] + fraction * (upper[i] - lower[i]))
+
+        return {
+            'num_steps': num_steps,
+            'num_examples': num_examples,
+            'clipped_fraction': int(stats.num_clipped) / max(num_examples, 1),
+            'mean_noise_to_signal': float(stats.noise_to_signal_sum) / max(num_steps, 1),
+            'bin_edges': edges,
+            'norm_histogram': counts,
+            'norm_quantiles': norm_quantiles,
+        }
+
     def _compute_per_example_gradients(self, svi_state, *args, **kwargs):
         """ Computes the raw per-example gradients of the model.
 
@@ -114,21 +297,31 @@ class TunableSVI(SVI):
         :param kwargs: All keyword arguments to model or guide.
         :returns: tuple consisting of the updated svi state, an array of loss
             values per example, and a jax tuple tree of per-example gradients
-            per parameter site (each site's gradients have shape (batch_size, *parameter_shape))
+            per parameter site (each site's gradients have shape (batch_size, *parameter_shape)),
+            or a single array of shape (batch_size, num_params) if
+            `flat_parameters` is set
         """
         rng_key, rng_key_step = random.split(svi_state.rng_key, 2)
         params = self.optim.get_params(svi_state.optim_state)
 
         def wrapped_px_loss(x, loss_args):
             return self.loss.px_loss.loss(
-                rng_key_step, self.constrain_fn(x), self.model, self.guide,
+                rng_key_step, self.constrain_fn(self._as_param_tree(x)),
+                self.model, self.guide,
                 *loss_args, **kwargs, **self.static_kwargs
             )
+        if self.remat_policy is not None:
+            wrapped_px_loss = checkpoint(wrapped_px_loss, self.remat_policy)
 
         per_example_loss, per_example_grads = per_example_value_and_grad(
             wrapped_px_loss
         )(params, args)
-        return SVIState(svi_state.optim_state, rng_key), per_example_loss, per_example_grads
+        if self.per_example_grad_dtype is not None:
+            per_example_grads = jax.tree_map(
+                lambda grad: grad.astype(self.per_example_grad_dtype),
+                per_example_grads
+            )
+        return svi_state._replace(rng_key=rng_key), per_example_loss, per_example_grads
 
     def _apply_per_example_gradient_transformations(self, svi_state, px_gradients):
         """ Applies per-example gradient transformations by applying
@@ -153,6 +346,7 @@ class TunableSVI(SVI):
 
         # if per-sample gradient manipulation is present, we apply it to
         #   each gradient site in the tree
+        raw_px_grads_list = px_grads_list
         if self.px_grad_manipulation_fn:
             # apply per-sample gradient manipulation, if present
             px_grads_list = jax.vmap(
@@ -168,8 +362,38 @@ class TunableSVI(SVI):
             #   should just get the whole tree per sample to get all available
             #   information
 
+        if self.collects_gradient_statistics:
+            svi_state = self._update_norm_statistics(
+                svi_state, raw_px_grads_list, px_grads_list
+            )
+
         return svi_state, px_grads_list, px_grads_tree_def
 
+    def _update_norm_statistics(self, svi_state, raw_px_grads_list, px_grads_list):
+        """ Accumulates the histogram of per-example gradient norms and the
+        number of per-example gradients reduced in norm by the per-example
+        gradient transformation.
+        """
+        raw_norms = jax.vmap(full_norm)(raw_px_grads_list) * self._gradient_norm_scale
+        transformed_norms = jax.vmap(full_norm)(px_grads_list)
+        # norms are compared with a relative tolerance to not count examples
+        #   that were merely rescaled by _gradient_norm_scale
+        is_clipped = transformed_norms < raw_norms * (1. - 1e-5)
+
+        # bin index of each norm is the number of edges it exceeds
+        edges = jnp.asarray(self._gradient_norm_bin_edges, dtype=raw_norms.dtype)
+        bin_idxs = jnp.sum(raw_norms[:, jnp.newaxis] >= edges, axis=1)
+        bins = jnp.arange(len(self._gradient_norm_bin_edges) + 1)
+        counts = jnp.sum(bin_idxs[:, jnp.newaxis] == bins, axis=0)
+
+        stats = svi_state.gradient_statistics
+        stats = stats._replace(
+            norm_histogram=stats.norm_histogram + counts.astype(jnp.int32),
+            num_examples=stats.num_examples + jnp.shape(raw_norms)[0],
+            num_clipped=stats.num_clipped + jnp.sum(is_clipped, dtype=jnp.int32)
+        )
+        return svi_state._replace(gradient_statistics=stats)
+
     def _combine_and_transform_gradient(self, svi_state, px_grads_list, px_loss, px_grads_tree_def):
         """ Combines the per-example gradients into the batch gradient and
             applies the batch gradient transformation given as
@@ -197,6 +421,8 @@ class TunableSVI(SVI):
         #   to get the final combined gradient
         loss_jacobian = jnp.reshape(loss_combine_vjp(jnp.array(1.))[0], (1, -1))
         # loss_vjp = lambda px_grads: jnp.sum(jnp.multiply(loss_jacobian, px_grads))
+        # note: per-example gradients stored in reduced precision are promoted
+        #   to the (float32) dtype of loss_jacobian, i.e., summed in float32
         loss_vjp = lambda px_grads: jnp.matmul(loss_jacobian, px_grads)
 
         # we map the loss combination vjp func over all secondary dimensions
@@ -214,10 +440,30 @@ class TunableSVI(SVI):
         # apply batch gradient modification (e.g., DP noise perturbation) (if any)
         if self.batch_grad_manipulation_fn:
             rng_key, rng_key_step = random.split(svi_state.rng_key, 2)
-            svi_state = SVIState(svi_state.optim_state, rng_key)
-            grads_list = self.batch_grad_manipulation_fn(
+            svi_state = svi_state._replace(rng_key=rng_key)
+            transformed_grads_list = self.batch_grad_manipulation_fn(
                 grads_list, rng=rng_key_step
             )
+            if self.collects_gradient_statistics:
+                # the transformation may rescale the gradient in addition to
+                #   perturbing it; _gradient_norm_scale reverts the scaling
+                change = [
+                    self._gradient_norm_scale * transformed - grad
+                    for transformed, grad in zip(transformed_grads_list, grads_list)
+                ]
+                noise_to_signal = full_norm(change) / full_norm(grads_list)
+                stats = svi_state.gradient_statistics
+                stats = stats._replace(
+                    noise_to_signal_sum=stats.noise_to_signal_sum + noise_to_signal
+                )
+                svi_state = svi_state._replace(gradient_statistics=stats)
+            grads_list = transformed_grads_list
+
+        if self.collects_gradient_statistics:
+            stats = svi_state.gradient_statistics
+            svi_state = svi_state._replace(
+                gradient_statistics=stats._replace(num_steps=stats.num_steps + 1)
+            )
 
         # reassemble the jax tree used by optimizer for the final gradients
         grads = jax.tree_unflatten(
@@ -238,27 +484,51 @@ class TunableSVI(SVI):
         :returns: tuple consisting of the updated svi state.
         """
         optim_state = self.optim.update(batch_gradient, svi_state.optim_state)
-        return SVIState(optim_state, svi_state.rng_key)
+        return svi_state._replace(optim_state=optim_state)
 
+    @count_traces('TunableSVI.update')
     def update(self, svi_state, *args, **kwargs):
-        svi_state, per_example_loss, per_example_grads = \
-            self._compute_per_example_gradients(svi_state, *args, **kwargs)
+        # named scopes identify the stages in profiles of the jitted update,
+        #   see `dppp.profiling`
+        with named_scope('compute_per_example_gradients'):
+            svi_state, per_example_loss, per_example_grads = \
+                self._compute_per_example_gradients(svi_state, *args, **kwargs)
+
+        with named_scope('apply_per_example_gradient_transformations'):
+            svi_state, per_example_grads, tree_def = \
+                self._apply_per_example_gradient_transformations(
+                    svi_state, per_example_grads
+                )
 
-        svi_state, per_example_grads, tree_def = \
-            self._apply_per_example_gradient_transformations(
-                svi_state, per_example_grads
+        with named_scope('combine_and_transform_gradient'):
+            svi_state, loss, gradient = self._combine_and_transform_gradient(
+                svi_state, per_example_grads, per_example_loss, tree_def
             )
 
-        svi_state, loss, gradient = self._combine_and_transform_gradient(
-            svi_state, per_example_grads, per_example_loss, tree_def
-        )
+        with named_scope('apply_gradient'):
+            svi_state = self._apply_gradient(svi_state, gradient)
+
+        return svi_state, loss
+
+    @count_traces('TunableSVI.evaluate')
+    def evaluate(self, svi_state, *args, **kwargs):
+        return super().evaluate(svi_state, *args, **kwargs)
 
-        return self._apply_gradient(svi_state, gradient), loss
 
+def _norm_dtype(dtype):
+    # norms of reduced precision values are computed in float32 to avoid
+    #   overflow and loss of precision when summing many squares
+    return jnp.promote_types(dtype, jnp.float32)
+
+# relative margin (in multiples of the machine epsilon of the norm) by which
+#   clipped gradients stay below the threshold so that their norm does not
+#   exceed it after rounding
+_CLIPPING_MARGIN_EPS = 8
 
 def full_norm(list_of_parts_or_tree, ord=2):
     """Computes the total norm over a list of values (of any shape) or a jax
-    tree by treating them as a single large vector.
+    tree by treating them as a single large vector. Values with less than
+    single precision are converted to float32 first.
 
     :param list_of_parts_or_tree: The list or jax tree of values that make up
         the vector to compute the norm over.
@@ -274,7 +544,7 @@ def full_norm(list_of_parts_or_tree, ord=2):
     if list_of_parts is None or len(list_of_parts) == 0:
         return 0.
 
-    ravelled = [g.ravel() for g in list_of_parts]
+    ravelled = [g.ravel().astype(_norm_dtype(g.dtype)) for g in list_of_parts]
     gradients = jnp.concatenate(ravelled)
     assert(len(gradients.shape) == 1)
     norm = jnp.linalg.norm(gradients, ord=ord)
@@ -301,21 +571,25 @@ def clip_gradient(list_of_gradient_parts, c, rescale_factor = 1.):
     The norm is computed by interpreting the given list of parts as a single
     vector (see `full_norm`). Each entry is then scaled by the factor
     (1/max(1, norm/C)) which effectively clips the norm to C. Additionally,
-    the gradient can be scaled by a given factor before clipping.
+    the gradient can be scaled by a given factor before clipping. Norm and
+    clipped gradients are computed in at least single precision, and clipped
+    gradients are scaled slightly below C so that their norm does not exceed
+    C after rounding.
 
     :param list_of_gradient_parts: A list of values (of any shape) that make up
         the overall gradient vector.
     :param c: The clipping threshold C.
     :param rescale_factor: Factor to scale the gradient by before clipping.
     :return: Clipped gradients given in the same format/layout/shape as
-        list_of_gradient_parts.
+        list_of_gradient_parts, with at least single precision.
     """
     if c == 0.:
         raise ValueError("The clipping threshold must be greater than 0.")
     norm = full_norm(list_of_gradient_parts) * rescale_factor # norm of rescale_factor * grad
-    normalization_constant = 1./jnp.maximum(1., norm/c)
+    margin = _CLIPPING_MARGIN_EPS * jnp.finfo(jnp.result_type(norm)).eps
+    normalization_constant = 1./jnp.maximum(1., norm/c * (1. + margin))
     f = rescale_factor * normalization_constant # to scale grad to max(rescale_factor * grad, C)
-    clipped_grads = [f * g for g in list_of_gradient_parts]
+    clipped_grads = [f * g.astype(_norm_dtype(g.dtype)) for g in list_of_gradient_parts]
     # assert(jnp.all(full_gradient_norm(clipped_grads)<c)) # jax doesn't like this
     return clipped_grads
 
@@ -361,7 +635,10 @@ class DPSVI(TunableSVI):
         (recognition network).
     :param per_example_loss_fn: ELBo loss, i.e. negative Evidence Lower Bound,
         to minimize, per example.
-    :param optim: an instance of :class:`~numpyro.optim._NumPyroOptim`.
+    :param optim: an instance of :class:`~numpyro.optim._NumPyroOptim`. If it
+        is a :class:`~dppp.optimizers.DPOptimizer`, the optimizer adds the
+        noise and rescales the gradient in its update instead of perturbing
+        the gradient for each parameter site separately.
     :param clipping_threshold: The clipping threshold C to which the norm
         of each per-example gradient is clipped.
     :param dp_scale: Scale parameter for the Gaussian mechanism applied to
@@ -369,12 +646,29 @@ class DPSVI(TunableSVI):
     :param num_obs_total: The total number of examples/observations in the
         full data set. To be used iff examples are scaled in a minibatch
         `guide`. See `make_observed_model` for details.
+    :param gradient_statistics_bins: If given, gradient statistics are
+        accumulated during updates (see `TunableSVI`). Gradient norms are
+        reported relative to the unscaled per-example likelihood, i.e., on
+        the same scale as `clipping_threshold`.
+    :param per_example_grad_dtype: If given, per-example gradients are stored
+        in this reduced precision floating point dtype, e.g., `jnp.bfloat16`,
+        while their norms, the clipped per-example gradients and their sum
+        are computed in float32 (see `TunableSVI`), so that clipped
+        gradients do not exceed the clipping threshold due to rounding.
+    :param remat_policy: If given, activations of the per-example loss are
+        recomputed in the backward pass instead of being stored (see
+        `TunableSVI`).
+    :param flat_parameters: If True, all parameters are kept in a single
+        contiguous vector (see `TunableSVI`), so that clipping and noise are
+        applied to one array.
     :param static_kwargs: static arguments for the model / guide, i.e. arguments
         that remain constant during fitting.
     """
 
     def __init__(self, model, guide, optim, per_example_loss,
-            clipping_threshold, dp_scale, num_obs_total = 1, **static_kwargs):
+            clipping_threshold, dp_scale, num_obs_total = 1,
+            gradient_statistics_bins=None, per_example_grad_dtype=None,
+            remat_policy=None, flat_parameters=False, **static_kwargs):
 
 
         # Using a minibatch environment will scale up the log likelihood contribution
@@ -386,6 +680,9 @@ class DPSVI(TunableSVI):
         )
         self._dp_scale = dp_scale
         self._clipping_threshold = clipping_threshold
+        self._num_obs_total = num_obs_total
+        self._gradient_norm_scale = 1./num_obs_total
+        self._fused_perturbation = isinstance(optim, DPOptimizer)
 
         @jax.jit
         def grad_perturbation_fn(list_of_grads, rng):
@@ -407,11 +704,51 @@ class DPSVI(TunableSVI):
             # as expected without DP
             return list_of_grads
 
+        if self._fused_perturbation:
+            # noise is added by the optimizer in _apply_gradient
+            grad_perturbation_fn = None
+
         super().__init__(
             model, guide, optim, per_example_loss,
             gradients_clipping_fn, grad_perturbation_fn,
-            num_obs_total=num_obs_total, **static_kwargs
+            gradient_statistics_bins=gradient_statistics_bins,
+            per_example_grad_dtype=per_example_grad_dtype,
+            remat_policy=remat_policy, flat_parameters=flat_parameters, num_obs_total=num_obs_total,
+            **static_kwargs
+        )
+
+    def _apply_gradient(self, svi_state, batch_gradient):
+        """ Takes a (batch) gradient step in parameter space. If the optimizer
+            is a `DPOptimizer`, it perturbs the gradient for privacy in the
+            same pass.
+
+        :param svi_state: The current state of the SVI algorithm.
+        :param batch_gradient: Jax tree of batch gradients per parameter site,
+            as returned by `_combine_and_transform_gradient`.
+        :returns: tuple consisting of the updated svi state.
+        """
+        if not self._fused_perturbation:
+            return super()._apply_gradient(svi_state, batch_gradient)
+
+        noise_std = self._dp_scale * self._clipping_threshold
+        rng_key, rng_key_step = random.split(svi_state.rng_key, 2)
+        optim_state = self.optim.dp_update(
+            batch_gradient, svi_state.optim_state, rng_key_step,
+            noise_std, self._num_obs_total
         )
+        svi_state = svi_state._replace(optim_state=optim_state, rng_key=rng_key)
+
+        if self.collects_gradient_statistics:
+            # the noise is not materialized separately; use its expected norm
+            num_params = sum(jnp.size(grad) for grad in jax.tree_leaves(batch_gradient))
+            noise_to_signal = noise_std * jnp.sqrt(num_params) / full_norm(batch_gradient)
+            stats = svi_state.gradient_statistics
+            stats = stats._replace(
+                noise_to_signal_sum=stats.noise_to_signal_sum + noise_to_signal
+            )
+            svi_state = svi_state._replace(gradient_statistics=stats)
+
+        return svi_state
 
     def _validate_epochs_and_iter(self, num_epochs, num_iter, q):
         if num_epochs is not None:
@@ -420,11 +757,57 @@ class DPSVI(TunableSVI):
             raise ValueError("A value must be supplied for either num_iter or num_epochs")
         return num_iter
 
-    def get_epsilon(self, target_delta, q, num_epochs=None, num_iter=None):
+    def phase(self, q, num_epochs=None, num_iter=None):
+        """ Describes a phase of training with this instance as a `PrivacyPhase`.
+
+        Phases of several `DPSVI` instances (e.g., with different `dp_scale`)
+        or batch sizes can be combined in `get_epsilon` via `previous_phases`.
+
+        :param q: The subsampling ratio.
+        :param num_epochs: The number of training epochs. Mutually exclusive with num_iter.
+        :param num_iter: The number of batch iterations. Mutually exclusive with num_epochs.
+        """
+        num_iter = self._validate_epochs_and_iter(num_epochs, num_iter, q)
+        return PrivacyPhase(self._dp_scale, q, int(num_iter))
+
+    def get_epsilon(self, target_delta, q, num_epochs=None, num_iter=None, method='fourier', previous_phases=()):
+        """ Computes the privacy epsilon for the add/remove relation.
+
+        :param target_delta: The delta privacy parameter.
+        :param q: The subsampling ratio.
+        :param num_epochs: The number of training epochs. Mutually exclusive with num_iter.
+        :param num_iter: The number of batch iterations. Mutually exclusive with num_epochs.
+        :param method: The privacy accountant to use: 'fourier' for the (tight)
+            Fourier Accountant or 'rdp' for the (fast but looser) Rényi DP accountant.
+        :param previous_phases: Sequence of `PrivacyPhase` instances (see
+            `phase`) for training that preceded this phase, e.g., with a
+            different subsampling ratio or noise scale. The returned epsilon
+            then accounts for the complete schedule.
+        """
         num_iter = self._validate_epochs_and_iter(num_epochs, num_iter, q)
 
-        eps = get_epsilon_R(target_delta, self._dp_scale, q, ncomp=num_iter)
-        return eps
+        # a single phase goes through the same (adaptive) accountant as a
+        #   schedule of several, so that both give consistent results
+        phases = tuple(previous_phases) + (self.phase(q, num_iter=num_iter),)
+        return get_epsilon_for_phases(target_delta, phases, method=method)
+
+    def accounting_service(self, target_delta, q, method='fourier', previous_phases=(), **kwargs):
+        """ Creates an `AccountingService` that computes the privacy epsilon
+        for the add/remove relation after a given number of iterations in the
+        background.
+
+        :param target_delta: The delta privacy parameter.
+        :param q: The subsampling ratio.
+        :param method: The privacy accountant to use, 'fourier' or 'rdp'.
+        :param previous_phases: Sequence of `PrivacyPhase` instances for
+            training that preceded this phase.
+        :param kwargs: Further arguments for `AccountingService`.
+        """
+        compute_eps_fn = functools.partial(get_epsilon_at_step,
+            target_delta=target_delta, sigma=self._dp_scale, q=q,
+            previous_phases=tuple(previous_phases), method=method
+        )
+        return AccountingService(compute_eps_fn, **kwargs)
 
     def get_delta(self, target_epsilon, q, num_epochs=None, num_iter=None):
         num_iter = self._validate_epochs_and_iter(num_epochs, num_iter, q)
@@ -449,6 +832,7 @@ def get_samples_from_trace(trace, with_intermediates=False):
     }
     return samples
 
+@count_traces('svi.sample_prior_predictive')
 def sample_prior_predictive(rng_key, model, model_args, substitutes=None, with_intermediates=False):
     """ Samples once from the prior predictive distribution.
 
@@ -479,6 +863,7 @@ def sample_prior_predictive(rng_key, model, model_args, substitutes=None, with_i
     t = trace(model).get_trace(*model_args)
     return get_samples_from_trace(t, with_intermediates)
 
+@count_traces('svi.sample_posterior_predictive')
 def sample_posterior_predictive(rng_key, model, model_args, guide, guide_args, params, with_intermediates=False):
     """ Samples once from the posterior predictive distribution.
 
@@ -519,11 +904,8 @@ def sample_posterior_predictive(rng_key, model, model_args, guide, guide_args, p
     guide_samples.update(model_samples)
     return guide_samples
 
-def _sample_a_lot(rng_key, n, single_sample_fn):
-    rng_keys = jax.random.split(rng_key, n)
-    return jax.vmap(single_sample_fn)(rng_keys)
-
-def sample_multi_prior_predictive(rng_key, n, model, model_args, substitutes=None, with_intermediates=False):
+@count_traces('svi.sample_multi_prior_predictive')
+def sample_multi_prior_predictive(rng_key, n, model, model_args, substitutes=None, with_intermediates=False, chunk_size=None):
     """ Samples n times from the prior predictive distribution.
 
     Individual sample sites, as designated by `sample`, can be frozen to
@@ -545,6 +927,9 @@ def sample_multi_prior_predictive(rng_key, n, model, model_args, substitutes=Non
         sample sites.
     :param with_intermediates: If True, intermediate(/latent) samples from
         sample site distributions are included in the result.
+    :param chunk_size: If given, samples are drawn in chunks of `chunk_size`
+        draws at a time, which bounds the memory required for intermediate
+        values of the model. Draws are the same as without chunking.
     :return: Dictionary of sampled values associated with the names given
         via `sample()` in the model. If with_intermediates is True,
         dictionary values are tuples where the first element is the final
@@ -553,9 +938,36 @@ def sample_multi_prior_predictive(rng_key, n, model, model_args, substitutes=Non
     single_sample_fn = lambda rng: sample_prior_predictive(
         rng, model, model_args, substitutes=substitutes, with_intermediates=with_intermediates
     )
-    return _sample_a_lot(rng_key, n, single_sample_fn)
+    return _sample_a_lot(rng_key, n, single_sample_fn, chunk_size)
+
+def stream_multi_prior_predictive(rng_key, n, model, model_args, chunk_size, substitutes=None, with_intermediates=False):
+    """ Samples n times from the prior predictive distribution and yields
+    the samples in chunks.
+
+    Only a single chunk is kept in memory at a time. The concatenated chunks
+    are identical to the result of `sample_multi_prior_predictive` for the
+    same arguments.
 
-def sample_multi_posterior_predictive(rng_key, n, model, model_args, guide, guide_args, params, with_intermediates=False):
+    :param rng_key: Jax PRNG key
+    :param n: Number of draws from the prior predictive.
+    :param model: Function representing the model using numpyro distributions
+        and the `sample` primitive
+    :param model_args: Arguments to the model function
+    :param chunk_size: Number of draws per chunk. The last chunk may be smaller.
+    :param substitutes: An optional dictionary of frozen substitutes for
+        sample sites.
+    :param with_intermediates: If True, intermediate(/latent) samples from
+        sample site distributions are included in the result.
+    :return: Generator of dictionaries of sampled values for each chunk, as
+        returned by `sample_multi_prior_predictive`.
+    """
+    single_sample_fn = lambda rng: sample_prior_predictive(
+        rng, model, model_args, substitutes=substitutes, with_intermediates=with_intermediates
+    )
+    return _stream_a_lot(rng_key, n, single_sample_fn, chunk_size)
+
+@count_traces('svi.sample_multi_posterior_predictive')
+def sample_multi_posterior_predictive(rng_key, n, model, model_args, guide, guide_args, params, with_intermediates=False, chunk_size=None):
     """ Samples n times from the posterior predictive distribution.
 
     Note that if the model function is written in such a way that it returns, e.g.,
@@ -574,6 +986,9 @@ def sample_multi_posterior_predictive(rng_key, n, model, model_args, guide, guid
         designated by call to `param` in the guide
     :param with_intermediates: If True, intermediate(/latent) samples from
         sample site distributions are included in the result.
+    :param chunk_size: If given, samples are drawn in chunks of `chunk_size`
+        draws at a time, which bounds the memory required for intermediate
+        values of model and guide. Draws are the same as without chunking.
     :return: Dictionary of sampled values associated with the names given
         via `sample()` in the model. If with_intermediates is True,
         dictionary values are tuples where the first element is the final
@@ -582,7 +997,158 @@ def sample_multi_posterior_predictive(rng_key, n, model, model_args, guide, guid
     single_sample_fn = lambda rng: sample_posterior_predictive(
         rng, model, model_args, guide, guide_args, params, with_intermediates=with_intermediates
     )
-    return _sample_a_lot(rng_key, n, single_sample_fn)
+    return _sample_a_lot(rng_key, n, single_sample_fn, chunk_size)
+
+def stream_multi_posterior_predictive(rng_key, n, model, model_args, guide, guide_args, params, chunk_size, with_intermediates=False):
+    """ Samples n times from the posterior predictive distribution and yields
+    the samples in chunks.
+
+    Only a single chunk is kept in memory at a time. The concatenated chunks
+    are identical to the result of `sample_multi_posterior_predictive` for
+    the same arguments.
+
+    :param rng_key: Jax PRNG key
+    :param n: Number of draws from the posterior predictive.
+    :param model: Function representing the model using numpyro distributions
+        and the `sample` primitive
+    :param model_args: Arguments to the model function
+    :param guide: Function representing the variational distribution (the guide)
+        using numpyro distributions as well as the `sample` and `param` primitives
+    :param guide_args: Arguments to the guide function
+    :param params: A dictionary providing values for the parameters
+        designated by call to `param` in the guide
+    :param chunk_size: Number of draws per chunk. The last chunk may be smaller.
+    :param with_intermediates: If True, intermediate(/latent) samples from
+        sample site distributions are included in the result.
+    :return: Generator of dictionaries of sampled values for each chunk, as
+        returned by `sample_multi_posterior_predictive`.
+    """
+    single_sample_fn = lambda rng: sample_posterior_predictive(
+        rng, model, model_args, guide, guide_args, params, with_intermediates=with_intermediates
+    )
+    return _stream_a_lot(rng_key, n, single_sample_fn, chunk_size)
+
+class _CachedSampler(object):
+    """ Base class for jit-compiled predictive samplers.
+
+    Compiled sampling functions are cached per number of draws and tree
+    structure, shapes and dtypes of the array arguments, so that repeated
+    sampling with arguments of the same shapes only costs execution.
+
+    :param sample_fn: Function `(rng_key, values, n) -> samples`, where values
+        is a jax tree of arrays.
+    """
+
+    def __init__(self, sample_fn):
+        self._sample_fn = sample_fn
+        self._cache = dict()
+
+    @property
+    def cache_size(self):
+        """ The number of compiled sampling functions in the cache. """
+        return len(self._cache)
+
+    def clear_cache(self):
+        """ Removes all compiled sampling functions from the cache. """
+        self._cache.clear()
+
+    def _sample(self, rng_key, values, n):
+        n = int(n)
+        leaves, tree_def = jax.tree_flatten(values)
+        key = (n, tree_def, tuple(
+            (jnp.shape(leaf), jnp.result_type(leaf)) for leaf in leaves
+        ))
+        compiled = self._cache.get(key)
+        if compiled is None:
+            compiled = jax.jit(functools.partial(self._sample_fn, n=n))
+            self._cache[key] = compiled
+        return compiled(rng_key, values)
+
+class PriorPredictiveSampler(_CachedSampler):
+    """ Jit-compiled sampler from the prior predictive distribution, see
+    `make_prior_predictive_sampler`. """
+
+    def __call__(self, rng_key, n, substitutes=None):
+        """ Samples n times from the prior predictive distribution.
+
+        :param rng_key: Jax PRNG key
+        :param n: Number of draws from the prior predictive.
+        :param substitutes: An optional dictionary of frozen substitutes for
+            sample sites.
+        :return: Dictionary of sampled values as returned by
+            `sample_multi_prior_predictive`.
+        """
+        if substitutes is None: substitutes = dict()
+        return self._sample(rng_key, substitutes, n)
+
+class PosteriorPredictiveSampler(_CachedSampler):
+    """ Jit-compiled sampler from the posterior predictive distribution, see
+    `make_posterior_predictive_sampler`. """
+
+    def __call__(self, rng_key, params, n):
+        """ Samples n times from the posterior predictive distribution.
+
+        :param rng_key: Jax PRNG key
+        :param params: A dictionary providing values for the parameters
+            designated by call to `param` in the guide
+        :param n: Number of draws from the posterior predictive.
+        :return: Dictionary of sampled values as returned by
+            `sample_multi_posterior_predictive`.
+        """
+        return self._sample(rng_key, params, n)
+
+def make_prior_predictive_sampler(model, model_args, with_intermediates=False, chunk_size=None):
+    """ Creates a jit-compiled sampler from the prior predictive distribution.
+
+    The model is traced and compiled once per number of draws and shapes of
+    substitutes, avoiding the cost of tracing for repeated sampling.
+
+    :param model: Function representing the model using numpyro distributions
+        and the `sample` primitive
+    :param model_args: Arguments to the model function. These are fixed for
+        the sampler and may include non-array values such as sizes.
+    :param with_intermediates: If True, intermediate(/latent) samples from
+        sample site distributions are included in the result.
+    :param chunk_size: If given, samples are drawn in chunks of `chunk_size`
+        draws at a time (see `sample_multi_prior_predictive`).
+    :return: `PriorPredictiveSampler` callable as
+        `sampler(rng_key, n, substitutes=None)`.
+    """
+    def sample_fn(rng_key, substitutes, n):
+        return sample_multi_prior_predictive(
+            rng_key, n, model, model_args, substitutes=substitutes,
+            with_intermediates=with_intermediates, chunk_size=chunk_size
+        )
+    return PriorPredictiveSampler(sample_fn)
+
+def make_posterior_predictive_sampler(model, model_args, guide, guide_args, with_intermediates=False, chunk_size=None):
+    """ Creates a jit-compiled sampler from the posterior predictive
+    distribution.
+
+    Model and guide are traced and compiled once per number of draws and
+    shapes of parameters, avoiding the cost of tracing for repeated sampling,
+    e.g., in evaluation loops.
+
+    :param model: Function representing the model using numpyro distributions
+        and the `sample` primitive
+    :param model_args: Arguments to the model function. These are fixed for
+        the sampler and may include non-array values such as sizes.
+    :param guide: Function representing the variational distribution (the guide)
+        using numpyro distributions as well as the `sample` and `param` primitives
+    :param guide_args: Arguments to the guide function, fixed for the sampler.
+    :param with_intermediates: If True, intermediate(/latent) samples from
+        sample site distributions are included in the result.
+    :param chunk_size: If given, samples are drawn in chunks of `chunk_size`
+        draws at a time (see `sample_multi_posterior_predictive`).
+    :return: `PosteriorPredictiveSampler` callable as
+        `sampler(rng_key, params, n)`.
+    """
+    def sample_fn(rng_key, params, n):
+        return sample_multi_posterior_predictive(
+            rng_key, n, model, model_args, guide, guide_args, params,
+            with_intermediates=with_intermediates, chunk_size=chunk_size
+        )
+    return PosteriorPredictiveSampler(sample_fn)
 
 def fix_observations(model, observations):
     """ Fixes observations in a model function for likelihood evaluation.
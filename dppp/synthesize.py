@@ -0,0 +1,314 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Generation of (differentially private) synthetic data sets by sampling
+from the posterior predictive distribution of a fitted model, written to disk
+in shards.
+
+Records are generated in chunks of a fixed size. Each chunk is sampled with
+its own key, derived from the given key and the chunk index by
+`jax.random.fold_in`. The output thus only depends on the key, the number of
+records and the chunk size, but not on how chunks are distributed over
+devices or processes. While the device samples a chunk, previously sampled
+chunks are written by a background thread.
+
+Example:
+
+>>> from dppp.synthesize import synthesize, load_synthetic_data
+>>> synthesize('synthetic/', rng_key, 10**6, model, (1,), guide, (1,), params,
+...     chunk_size=10**4, sites=['x'])
+>>> data = load_synthetic_data('synthetic/')['x']
+"""
+
+import functools
+import json
+import multiprocessing
+import os
+import queue
+import threading
+from collections import namedtuple
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from dppp.svi import sample_multi_posterior_predictive
+
+__all__ = ['SynthesisResult', 'synthesize', 'load_synthetic_data']
+
+MANIFEST_FILE = 'manifest.json'
+OUTPUT_FORMATS = ('npy', 'memmap')
+
+SynthesisResult = namedtuple('SynthesisResult', [
+    'output_dir', 'num_records', 'num_chunks', 'sites'
+])
+SynthesisResult.__doc__ = """ Summary of a synthetic data set written by
+`synthesize`.
+
+:param output_dir: The directory holding the data set.
+:param num_records: The number of records per site.
+:param num_chunks: The number of chunks the records were generated in.
+:param sites: Dictionary of the shape of a single record and dtype per site.
+"""
+
+def _sample_chunk(rng_key, params, chunk_size, model, model_args, guide, guide_args, sites):
+    samples = sample_multi_posterior_predictive(
+        rng_key, chunk_size, model, model_args, guide, guide_args, params
+    )
+    if sites is not None:
+        samples = {site: samples[site] for site in sites}
+    return samples
+
+def _chunk_key(rng_key, chunk_index):
+    return jax.random.fold_in(rng_key, chunk_index)
+
+def _shard_path(output_dir, site, chunk_index):
+    return os.path.join(output_dir, '{}-{:06d}.npy'.format(site, chunk_index))
+
+def _memmap_path(output_dir, site):
+    return os.path.join(output_dir, '{}.npy'.format(site))
+
+def _generate_chunks(sample_chunk, rng_key, params, chunk_indices, num_devices):
+    """ Yields tuples of chunk index and (not necessarily computed) samples
+    for all given chunk indices, sampling `num_devices` chunks in parallel. """
+    if num_devices <= 1:
+        sample = jax.jit(sample_chunk)
+        for chunk_index in chunk_indices:
+            yield chunk_index, sample(_chunk_key(rng_key, chunk_index), params)
+        return
+
+    sample = jax.pmap(sample_chunk, in_axes=(0, None))
+    for start in range(0, len(chunk_indices), num_devices):
+        group = list(chunk_indices[start : start + num_devices])
+        # pad the last group so that every device has a chunk to sample
+        padded_group = group + [group[-1]] * (num_devices - len(group))
+        keys = jnp.stack([_chunk_key(rng_key, i) for i in padded_group])
+        samples = sample(keys, params)
+        for j, chunk_index in enumerate(group):
+            yield chunk_index, jax.tree_map(lambda x: x[j], samples)
+
+class _ShardWriter(object):
+    """ Writes sampled chunks to disk on a background thread.
+
+    Chunks are passed to `write` as device arrays; waiting for their
+    computation and the transfer to the host happen on the background thread
+    so that the caller can dispatch sampling of the next chunk.
+    """
+
+    def __init__(self, output_dir, num_records, chunk_size, output_format, max_pending=2):
+        self._output_dir = output_dir
+        self._num_records = num_records
+        self._chunk_size = chunk_size
+        self._output_format = output_format
+        self._memmaps = dict()
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _write_chunk(self, chunk_index, samples):
+        start = chunk_index * self._chunk_size
+        num_valid = min(self._chunk_size, self._num_records - start)
+        for site, values in samples.items():
+            values = np.asarray(values)[:num_valid]
+            if self._output_format == 'npy':
+                np.save(_shard_path(self._output_dir, site, chunk_index), values)
+            else:
+                if site not in self._memmaps:
+                    self._memmaps[site] = np.load(
+                        _memmap_path(self._output_dir, site), mmap_mode='r+'
+                    )
+                self._memmaps[site][start : start + num_valid] = values
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is None:
+                try:
+                    self._write_chunk(*item)
+                except Exception as e:
+                    self._error = e
+
+    def write(self, chunk_index, samples):
+        if self._error is not None:
+            raise self._error
+        self._queue.put((chunk_index, samples))
+
+    def close(self):
+        """ Waits for all pending chunks to be written. """
+        self._queue.put(None)
+        self._thread.join()
+        for memmap in self._memmaps.values():
+            memmap.flush()
+        self._memmaps.clear()
+        if self._error is not None:
+            raise self._error
+
+def _write_chunks(sample_chunk, rng_key, params, chunk_indices, output_dir,
+        num_records, chunk_size, output_format, num_devices, max_pending):
+    writer = _ShardWriter(output_dir, num_records, chunk_size, output_format, max_pending)
+    try:
+        for chunk_index, samples in _generate_chunks(
+                sample_chunk, rng_key, params, chunk_indices, num_devices):
+            writer.write(chunk_index, samples)
+    finally:
+        writer.close()
+
+def _write_chunks_in_process(args):
+    sample_chunk, rng_key, params = args[:3]
+    _write_chunks(sample_chunk, jnp.asarray(rng_key), params, *args[3:])
+
+def _synthesize(sample_chunk, output_dir, rng_key, num_records, params,
+        chunk_size, output_format, num_devices, num_processes, max_pending):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("output_format must be one of {}".format(OUTPUT_FORMATS))
+    if num_records < 1 or chunk_size < 1:
+        raise ValueError("num_records and chunk_size must be positive")
+    if num_devices is None:
+        num_devices = jax.local_device_count()
+    num_devices = min(num_devices, jax.local_device_count())
+
+    os.makedirs(output_dir, exist_ok=True)
+    num_chunks = -(-num_records // chunk_size)
+
+    chunk_shapes = jax.eval_shape(sample_chunk, rng_key, params)
+    sites = {
+        site: (tuple(shape.shape[1:]), np.dtype(shape.dtype))
+        for site, shape in chunk_shapes.items()
+    }
+    if output_format == 'memmap':
+        for site, (shape, dtype) in sites.items():
+            np.lib.format.open_memmap(
+                _memmap_path(output_dir, site), mode='w+', dtype=dtype,
+                shape=(num_records,) + shape
+            ).flush()
+
+    chunk_indices = list(range(num_chunks))
+    if num_processes <= 1:
+        _write_chunks(
+            sample_chunk, rng_key, params, chunk_indices, output_dir,
+            num_records, chunk_size, output_format, num_devices, max_pending
+        )
+    else:
+        # spawned processes do not inherit jax state of this process; every
+        #   process writes the chunks assigned to it
+        host_params = jax.device_get(params)
+        host_rng_key = np.asarray(rng_key)
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes=num_processes) as pool:
+            pool.map(_write_chunks_in_process, [
+                (
+                    sample_chunk, host_rng_key, host_params,
+                    chunk_indices[rank::num_processes], output_dir, num_records,
+                    chunk_size, output_format, num_devices, max_pending
+                )
+                for rank in range(num_processes)
+            ])
+
+    manifest = {
+        'num_records': num_records,
+        'chunk_size': chunk_size,
+        'num_chunks': num_chunks,
+        'output_format': output_format,
+        'rng_key': np.asarray(rng_key).tolist(),
+        'sites': {
+            site: {'shape': list(shape), 'dtype': dtype.str}
+            for site, (shape, dtype) in sites.items()
+        },
+    }
+    with open(os.path.join(output_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return SynthesisResult(output_dir, num_records, num_chunks, sites)
+
+def synthesize(output_dir, rng_key, num_records, model, model_args, guide,
+        guide_args, params, chunk_size=10000, sites=None, output_format='npy',
+        num_devices=None, num_processes=1, max_pending=2):
+    """ Generates a synthetic data set from the posterior predictive
+    distribution and writes it to disk.
+
+    A record is a single draw from the posterior predictive distribution
+    (see `sample_multi_posterior_predictive`); if the model generates
+    several observations per draw, each record holds all of them.
+
+    Records are sampled in chunks of `chunk_size`, each with the key
+    `jax.random.fold_in(rng_key, chunk_index)`, so that the output is
+    identical for any `num_devices` and `num_processes`.
+
+    :param output_dir: Directory to write the data set to. It is created if
+        necessary.
+    :param rng_key: Jax PRNG key
+    :param num_records: Number of records to generate.
+    :param model: Function representing the model using numpyro distributions
+        and the `sample` primitive
+    :param model_args: Arguments to the model function
+    :param guide: Function representing the variational distribution (the guide)
+        using numpyro distributions as well as the `sample` and `param` primitives
+    :param guide_args: Arguments to the guide function
+    :param params: A dictionary providing values for the parameters
+        designated by call to `param` in the guide
+    :param chunk_size: Number of records sampled at once. Bounds the memory
+        required for sampling.
+    :param sites: Names of the sample sites to write. All sample sites of
+        model and guide are written if None.
+    :param output_format: 'npy' to write a `.npy` file per site and chunk or
+        'memmap' to write a single memory-mapped `.npy` file per site.
+    :param num_devices: Number of local devices to sample chunks on in
+        parallel; all local devices if None. To use several CPU cores as
+        devices, set XLA_FLAGS=--xla_force_host_platform_device_count=<n>
+        before importing jax.
+    :param num_processes: Number of processes sampling and writing chunks in
+        parallel. Model and guide must be picklable (i.e., defined at the top
+        level of a module) if greater than 1.
+    :param max_pending: Maximum number of sampled chunks waiting to be
+        written, per process.
+    :return: `SynthesisResult` describing the data set.
+    """
+    sample_chunk = functools.partial(
+        _sample_chunk, chunk_size=chunk_size, model=model, model_args=model_args,
+        guide=guide, guide_args=guide_args,
+        sites=tuple(sites) if sites is not None else None
+    )
+    return _synthesize(
+        sample_chunk, output_dir, rng_key, num_records, params, chunk_size,
+        output_format, num_devices, num_processes, max_pending
+    )
+
+def load_synthetic_data(output_dir, sites=None, mmap_mode='r'):
+    """ Loads a synthetic data set written by `synthesize`.
+
+    :param output_dir: The directory holding the data set.
+    :param sites: Names of the sites to load; all sites if None.
+    :param mmap_mode: Memory-mapping mode for data sets in 'memmap' format
+        (see `numpy.load`). Shards of data sets in 'npy' format are
+        concatenated in memory.
+    :return: Dictionary of records per site.
+    """
+    with open(os.path.join(output_dir, MANIFEST_FILE), 'r') as f:
+        manifest = json.load(f)
+    if sites is None:
+        sites = list(manifest['sites'])
+
+    data = dict()
+    for site in sites:
+        if manifest['output_format'] == 'memmap':
+            data[site] = np.load(_memmap_path(output_dir, site), mmap_mode=mmap_mode)
+        else:
+            data[site] = np.concatenate([
+                np.load(_shard_path(output_dir, site, chunk_index))
+                for chunk_index in range(manifest['num_chunks'])
+            ])
+    return data
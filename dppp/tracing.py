@@ -0,0 +1,206 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Instrumentation to detect unintended retracing (and thus recompilation) of
+jitted dppp functions.
+
+Functions decorated with `count_traces` count how often they are staged out
+for compilation, i.e., called with abstract jax values while jax builds a
+computation for `jax.jit`, `jax.pmap` or control flow primitives such as
+`lax.scan`, which happens once per compilation. Changes in argument shapes, Python values
+passed as arguments or newly created objects (such as a fresh `DPSVI`
+instance) all cause retracing. With recompilation warnings enabled, a
+`RecompilationWarning` names the arguments that changed, e.g.,
+
+>>> from dppp.tracing import enable_recompilation_warnings, get_trace_counts
+>>> enable_recompilation_warnings()
+>>> # ... training ...
+>>> print(get_trace_counts())
+{'TunableSVI.update': 1, 'subsample_batchify_data.get_batch': 1}
+"""
+
+import functools
+import inspect
+import threading
+import warnings
+from collections import OrderedDict
+
+import jax
+from jax.interpreters import partial_eval as pe
+import numpy as np
+
+__all__ = [
+    'RecompilationWarning', 'count_traces', 'get_trace_counts',
+    'get_trace_count', 'reset_trace_counts', 'enable_recompilation_warnings',
+    'disable_recompilation_warnings'
+]
+
+class RecompilationWarning(UserWarning):
+    """ Warning issued when an instrumented function is traced again after
+    warm-up. """
+    pass
+
+_lock = threading.Lock()
+_trace_counts = dict()
+_last_signatures = dict()
+_warmup = None # recompilation warnings are disabled if None
+
+def enable_recompilation_warnings(warmup=1):
+    """ Enables warnings when an instrumented function is traced more than
+    `warmup` times.
+
+    :param warmup: The number of traces per function that are expected, e.g.,
+        1 for a single jitted training loop.
+    """
+    global _warmup
+    _warmup = int(warmup)
+
+def disable_recompilation_warnings():
+    """ Disables warnings about recompilation. """
+    global _warmup
+    _warmup = None
+
+def get_trace_counts():
+    """ Returns a dictionary of the number of traces per instrumented function. """
+    with _lock:
+        return dict(_trace_counts)
+
+def get_trace_count(name):
+    """ Returns the number of traces of the instrumented function `name`. """
+    with _lock:
+        return _trace_counts.get(name, 0)
+
+def reset_trace_counts():
+    """ Resets all trace counts and recorded signatures. """
+    with _lock:
+        _trace_counts.clear()
+        _last_signatures.clear()
+
+# tracers of computations that are staged out for compilation; tracers of
+#   transformations such as vmap and grad, which are evaluated right away, are
+#   not included
+_STAGING_TRACERS = tuple(
+    getattr(pe, name) for name in ('DynamicJaxprTracer',) if hasattr(pe, name)
+)
+
+def _is_tracer(value):
+    return isinstance(value, jax.core.Tracer)
+
+def _is_staging_tracer(value):
+    """ Checks whether value is traced for a staged-out computation, possibly
+    under further transformations such as `jax.vmap` within `jax.jit`. """
+    while _is_tracer(value):
+        if isinstance(value, _STAGING_TRACERS):
+            return True
+        # batching and differentiation tracers wrap the value they transform
+        value = getattr(value, 'val', getattr(value, 'primal', None))
+    return False
+
+def _describe_leaf(leaf):
+    if _is_tracer(leaf):
+        return ('array', tuple(leaf.aval.shape), str(leaf.aval.dtype))
+    if isinstance(leaf, (bool, int, float, complex, str)):
+        return ('value', type(leaf).__name__, leaf)
+    if hasattr(leaf, 'shape') and hasattr(leaf, 'dtype'):
+        return ('array', tuple(np.shape(leaf)), str(leaf.dtype))
+    return ('object', type(leaf).__name__, id(leaf))
+
+def _describe(value):
+    leaves, tree_def = jax.tree_flatten(value)
+    return str(tree_def), tuple(_describe_leaf(leaf) for leaf in leaves)
+
+def _signature(fn_signature, args, kwargs):
+    try:
+        bound = fn_signature.bind(*args, **kwargs)
+        arguments = bound.arguments
+    except TypeError:
+        arguments = OrderedDict(
+            [(str(i), arg) for i, arg in enumerate(args)] + list(kwargs.items())
+        )
+    return OrderedDict((name, _describe(value)) for name, value in arguments.items())
+
+def _format_leaf(leaf_description):
+    kind, a, b = leaf_description
+    if kind == 'array':
+        return "array of shape {} and dtype {}".format(a, b)
+    if kind == 'value':
+        return "{} {!r}".format(a, b)
+    return "{} object at {:#x}".format(a, b)
+
+def _describe_changes(old_signature, new_signature):
+    changes = []
+    for name in list(old_signature) + [n for n in new_signature if n not in old_signature]:
+        if name not in new_signature:
+            changes.append("argument '{}' was omitted".format(name))
+            continue
+        if name not in old_signature:
+            changes.append("argument '{}' was added".format(name))
+            continue
+        old_tree, old_leaves = old_signature[name]
+        new_tree, new_leaves = new_signature[name]
+        if old_tree != new_tree:
+            changes.append("argument '{}' changed structure from {} to {}".format(
+                name, old_tree, new_tree
+            ))
+            continue
+        for old_leaf, new_leaf in zip(old_leaves, new_leaves):
+            if old_leaf != new_leaf:
+                changes.append("argument '{}' changed from {} to {}".format(
+                    name, _format_leaf(old_leaf), _format_leaf(new_leaf)
+                ))
+    return changes
+
+def count_traces(name):
+    """ Decorator that counts how often a function is traced by jax.
+
+    A call counts as a trace if any of its arguments contains a tracer of a
+    computation that is staged out for compilation (e.g., by `jax.jit`).
+    Calls under transformations that are evaluated right away, such as
+    `jax.vmap` and `jax.grad` outside of `jax.jit`, are not counted.
+
+    :param name: The name under which traces are counted.
+    """
+    def decorator(fn):
+        fn_signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            leaves = jax.tree_leaves((args, kwargs))
+            if any(_is_staging_tracer(leaf) for leaf in leaves):
+                _record_trace(name, _signature(fn_signature, args, kwargs))
+            return fn(*args, **kwargs)
+
+        return wrapped
+    return decorator
+
+def _record_trace(name, signature):
+    with _lock:
+        count = _trace_counts.get(name, 0) + 1
+        _trace_counts[name] = count
+        old_signature = _last_signatures.get(name)
+        _last_signatures[name] = signature
+        warmup = _warmup
+
+    if warmup is not None and count > warmup:
+        if old_signature is not None:
+            changes = _describe_changes(old_signature, signature)
+        else:
+            changes = []
+        if len(changes) == 0:
+            changes = ["no argument changed; the calling function was likely re-jitted"]
+        warnings.warn(
+            "{} was traced {} times, which causes recompilation: {}".format(
+                name, count, "; ".join(changes)
+            ), RecompilationWarning, stacklevel=3
+        )
@@ -16,12 +16,13 @@ import jax
 import jax.numpy as jnp
 import numpy as np
 from functools import reduce, wraps, partial
+import contextlib
 
 __all__ = ["map_over_secondary_dims", "has_shape", "is_array", "is_scalar",
     "is_integer", "is_int_scalar", "example_count",
     "unvectorize_shape", "unvectorize_shape_1d", "unvectorize_shape_2d",
     "unvectorize_shape_3d", "expand_shape", "expand_shape_1d",
-    "expand_shape_2d", "expand_shape_3d"]
+    "expand_shape_2d", "expand_shape_3d", "named_scope"]
 
 def map_over_secondary_dims(f):
     """
@@ -291,6 +292,42 @@ def are_trees_close(a, b):
         for x, y, in zip(jax.tree_leaves(a), jax.tree_leaves(b))
     )
 
+def ravel_tree(tree):
+    """Concatenates all leaves of a jax tree into a single flat vector.
+
+    :param tree: The jax tree to flatten.
+    :return: tuple of the flat vector and the (hashable) layout required to
+        restore the tree with `unravel_tree`
+    """
+    leaves, tree_def = jax.tree_flatten(tree)
+    shapes = tuple(jnp.shape(leaf) for leaf in leaves)
+    dtypes = tuple(jnp.result_type(leaf) for leaf in leaves)
+    return ravel_leaves(leaves), (tree_def, shapes, dtypes)
+
+def ravel_leaves(leaves):
+    """Concatenates a list of arrays (of any shape) into a single flat vector.
+    """
+    if len(leaves) == 0:
+        return jnp.zeros(0)
+    return jnp.concatenate([jnp.ravel(leaf) for leaf in leaves])
+
+def unravel_tree(flat, layout):
+    """Restores a jax tree from a flat vector created by `ravel_tree`.
+
+    The leaves of the returned tree are views of consecutive parts of `flat`.
+
+    :param flat: The flat vector.
+    :param layout: The layout returned by `ravel_tree`.
+    """
+    tree_def, shapes, dtypes = layout
+    splits = np.cumsum([int(np.prod(shape)) for shape in shapes])[:-1]
+    parts = jnp.split(flat, splits) if len(shapes) > 0 else []
+    leaves = [
+        jnp.reshape(part, shape).astype(dtype)
+        for part, shape, dtype in zip(parts, shapes, dtypes)
+    ]
+    return jax.tree_unflatten(tree_def, leaves)
+
 @partial(jax.jit, static_argnums=(2,3))
 def sample_from_array(rng_key, x, n, axis):
     """ Samples n elements from a given array without replacement.
@@ -351,3 +388,48 @@ def sample_from_array(rng_key, x, n, axis):
     a = func(data)
 
     return jnp.take(x, a, axis=axis)
+
+@contextlib.contextmanager
+def _null_scope(name):
+    yield
+
+def named_scope(name):
+    """ Context manager that attaches `name` to all operations traced within
+    it, so that they can be identified in profiler traces and compiled XLA
+    computations.
+
+    Falls back to a no-op on jax versions that do not provide
+    `jax.named_scope`.
+
+    :param name: The name of the scope.
+    """
+    if hasattr(jax, 'named_scope'):
+        return jax.named_scope(name)
+    return _null_scope(name)
+
+def checkpoint(fun, policy='full'):
+    """ Wraps `fun` such that intermediate values of its computation are
+    recomputed when it is differentiated instead of being stored, trading
+    computation for memory (see `jax.checkpoint`).
+
+    :param fun: The function to rematerialize.
+    :param policy: Which intermediate values may be stored instead of
+        recomputed. Either 'full' to recompute all of them, the name of a
+        policy in `jax.checkpoint_policies` (e.g., 'dots_saveable') or a
+        policy function. Policies other than 'full' require a jax version
+        that supports them.
+    """
+    if policy == 'full':
+        return jax.checkpoint(fun)
+    if isinstance(policy, str):
+        policies = getattr(jax, 'checkpoint_policies', None)
+        if policies is None or not hasattr(policies, policy):
+            raise ValueError("Unknown rematerialization policy '{}'".format(policy))
+        policy = getattr(policies, policy)
+    try:
+        return jax.checkpoint(fun, policy=policy)
+    except TypeError:
+        raise ValueError(
+            "Rematerialization policies other than 'full' are not supported "
+            "by jax {}".format(jax.__version__)
+        )
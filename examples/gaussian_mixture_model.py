@@ -27,6 +27,7 @@ sys.path.append(os.path.dirname(sys.path[0]))
 import argparse
 import time
 
+import numpy as np
 import jax
 import jax.numpy as jnp
 from jax import jit, lax, random
@@ -40,7 +41,7 @@ from numpyro.infer import Trace_ELBO as ELBO
 
 from dppp.svi import DPSVI, sample_prior_predictive
 from dppp.minibatch import minibatch, split_batchify_data, subsample_batchify_data
-from dppp.gmm import GaussianMixture
+from dppp.gmm import GaussianMixture, assign, confusion_matrix, log_likelihood
 
 
 try:
@@ -107,57 +108,34 @@ def create_toy_data(rng_key, N, d):
     latent_vals = (z_train, z_test, mus, sigs)
     return X_train, X_test, latent_vals
 
-## the following two functions are not relevant to the training but will
+## the following function is not relevant to the training but will
 #   assign test data to the learned posterior components of the model to
 #   check the quality of the learned model
-def compute_assignment_log_posterior(k, obs, mus, sigs, pis_prior):
-    """computes the unnormalized log-posterior for each value of assignment z
-       for each data point
-    """
-    N = jnp.atleast_1d(obs).shape[0]
-
-    def per_component_fun(j):
-        log_prob_x_zj = jnp.sum(dist.Normal(mus[j], sigs[j]).log_prob(obs), axis=1).flatten()
-        assert(jnp.atleast_1d(log_prob_x_zj).shape == (N,))
-        log_prob_zj = dist.Categorical(pis_prior).log_prob(j)
-        log_prob = log_prob_x_zj + log_prob_zj
-        assert(jnp.atleast_1d(log_prob).shape == (N,))
-        return log_prob
-
-    z_log_post = jax.vmap(per_component_fun)(jnp.arange(k))
-    return z_log_post.T
-
 def compute_assignment_accuracy(
     X_test, original_assignment, original_modes, posterior_modes, posterior_pis):
     """computes the accuracy score for attributing data to the mixture
     components based on the learned model
     """
     k, d = jnp.shape(original_modes)
-    # we first map our true modes to the ones learned in the model using the
-    # log posterior for z
-    mode_assignment_posterior = compute_assignment_log_posterior(
-        k, original_modes, posterior_modes, jnp.ones((k, d)), posterior_pis
-    )
-    mode_map = jnp.argmax(mode_assignment_posterior, axis=1)._value
+    posterior_mixture = GaussianMixture(posterior_modes, jnp.ones((k, d)), posterior_pis)
+    # we first map our true modes to the ones learned in the model by
+    # assigning them to the most probable learned component
+    mode_map = np.asarray(assign(posterior_mixture, original_modes))
     # a potential problem could be that mode_map might not be bijective, skewing
     # the results of the mapping. we build the inverse map and use identity
     # mapping as a base to counter that
-    inv_mode_map = {j:j for j in range(k)}
-    inv_mode_map.update({mode_map[j]:j for j in range(k)})
+    inv_mode_map = np.arange(k)
+    inv_mode_map[mode_map] = np.arange(k)
 
     # we next obtain the assignments for the data according to the model and
-    # pass them through the inverse map we just build
-    post_data_assignment = compute_assignment_log_posterior(
-        k, X_test, posterior_modes, jnp.ones((k, d)), posterior_pis
-    )
-    post_data_assignment = jnp.argmax(post_data_assignment, axis=1)
-    remapped_data_assignment = jnp.array(
-        [inv_mode_map[j] for j in post_data_assignment._value]
-    )
-
-    # finally, we can compare the results with the original assigments and compute
-    # the accuracy
-    acc = jnp.mean(original_assignment == remapped_data_assignment)
+    # count how often data of each original component is assigned to each
+    # learned one
+    post_data_assignment = assign(posterior_mixture, X_test)
+    counts = confusion_matrix(original_assignment, post_data_assignment, k)
+
+    # finally, we can compare the results with the original assigments under
+    # the inverse map and compute the accuracy
+    acc = jnp.sum(counts[inv_mode_map, np.arange(k)]) / jnp.sum(counts)
     return acc
 
 
@@ -257,6 +235,10 @@ def main(args):
     )
     print("assignment accuracy: {}".format(acc))
 
+    posterior_mixture = GaussianMixture(posterior_modes, jnp.ones((k, d)), posterior_pis)
+    test_log_likelihood = log_likelihood(posterior_mixture, X_test) / jnp.shape(X_test)[0]
+    print("held-out log-likelihood per data point: {}".format(test_log_likelihood))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="parse args")
@@ -0,0 +1,90 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" tests that the jax implementation of the Fourier accountant agrees with
+the reference implementation
+"""
+import unittest
+
+import jax.numpy as jnp
+import jax
+import numpy as np
+
+from fourier_accountant.compute_eps import get_epsilon_R as reference_get_epsilon_R
+from fourier_accountant.compute_delta import get_delta_R as reference_get_delta_R
+
+from dppp.accountant import get_epsilon_R, get_delta_R
+
+class JaxAccountantTests(unittest.TestCase):
+
+    def setUp(self):
+        self.delta = 1e-3
+        self.q = .01
+        self.num_iter = 1000
+        self.nx = int(1e5)
+
+    def test_get_epsilon_agrees_with_reference(self):
+        for sigma in (.8, 1., 2.):
+            expected = reference_get_epsilon_R(
+                self.delta, sigma, self.q, self.num_iter, nx=self.nx
+            )
+            actual = get_epsilon_R(self.delta, sigma, self.q, self.num_iter, nx=self.nx)
+            self.assertTrue(np.allclose(expected, actual, rtol=5e-2))
+
+    def test_get_delta_agrees_with_reference(self):
+        expected = reference_get_delta_R(1., 1., self.q, self.num_iter, nx=self.nx)
+        actual = get_delta_R(1., 1., self.q, self.num_iter, nx=self.nx)
+        self.assertTrue(np.allclose(expected, actual, rtol=5e-2))
+
+    def test_get_epsilon_vmapped_over_sigma_and_num_iter(self):
+        sigmas = jnp.array([.8, 1., 2.])
+        num_iters = jnp.array([100., 1000., 500.])
+
+        actual = jax.jit(jax.vmap(
+            lambda sigma, num_iter: get_epsilon_R(
+                self.delta, sigma, self.q, num_iter, nx=self.nx
+            )
+        ))(sigmas, num_iters)
+
+        self.assertEqual((3,), jnp.shape(actual))
+        for i in range(3):
+            expected = get_epsilon_R(
+                self.delta, sigmas[i], self.q, num_iters[i], nx=self.nx
+            )
+            self.assertTrue(jnp.allclose(expected, actual[i], rtol=1e-3))
+
+    def test_get_epsilon_decreases_with_sigma(self):
+        sigmas = jnp.linspace(.8, 4., 5)
+        eps = jax.vmap(
+            lambda sigma: get_epsilon_R(self.delta, sigma, self.q, self.num_iter, nx=self.nx)
+        )(sigmas)
+        self.assertTrue(jnp.all(eps[:-1] > eps[1:]))
+
+    def test_get_epsilon_for_phases_agrees_with_reference(self):
+        sigmas, qs, num_iters = np.array([2., 1.]), np.array([.05, .01]), np.array([200, 1000])
+        expected = reference_get_epsilon_R(self.delta, sigmas, qs, num_iters, nx=self.nx)
+        actual = get_epsilon_R(self.delta, sigmas, qs, num_iters, nx=self.nx)
+        self.assertTrue(np.allclose(expected, actual, rtol=5e-2))
+
+    def test_get_epsilon_outside_window_is_inf(self):
+        eps = get_epsilon_R(self.delta, .5, .1, self.num_iter, nx=int(1e4), L=5.)
+        self.assertTrue(jnp.isinf(eps))
+
+    def test_get_epsilon_rejects_odd_nx(self):
+        with self.assertRaises(ValueError):
+            get_epsilon_R(self.delta, 1., self.q, self.num_iter, nx=1001)
+
+
+if __name__ == '__main__':
+    unittest.main()
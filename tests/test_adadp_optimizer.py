@@ -19,7 +19,7 @@ import unittest
 import jax.numpy as jnp
 import jax
 
-from dppp.optimizers import ADADP
+from dppp.optimizers import ADADP, FlatADADP, FlatADADPState
 import dppp.util
 
 class ADADPTests(unittest.TestCase):
@@ -213,5 +213,126 @@ class ADADPTests(unittest.TestCase):
         self.assertTreeAllClose(value, x) # update rejected
         self.assertTrue(jnp.allclose(expected_lr, lr))
 
+
+class FlatADADPTests(unittest.TestCase):
+
+    def assertTreeAllClose(self, expected, actual):
+        self.assertTrue(dppp.util.are_trees_close(expected, actual))
+
+    def same_tree_with_value(self, tree, value):
+        return jax.tree_map(
+            lambda x: jnp.ones_like(x) * value, tree
+        )
+
+    def setUp(self):
+        self.template = (
+            jnp.ones(shape=(7, 10)),
+            jnp.ones(shape=(7,)),
+            (
+                jnp.ones(shape=(2, 7)),
+                jnp.ones(shape=(2,)),
+            )
+        )
+        self.num_params = 7 * 10 + 7 + 2 * 7 + 2
+
+    def make_state(self, adadp, x, lr, x_prev):
+        _, state = adadp.init(x)
+        _, x_prev_state = adadp.init(x_prev)
+        return FlatADADPState(state.x, jnp.array(lr), x_prev_state.x, state.layout)
+
+    def test_init(self):
+        learning_rate = 1.
+        adadp = FlatADADP(learning_rate, 1.)
+        i, state = adadp.init(self.template)
+
+        self.assertEqual(0, i)
+        self.assertEqual((self.num_params,), jnp.shape(state.x))
+        self.assertEqual((self.num_params,), jnp.shape(state.x_prev))
+        self.assertEqual(learning_rate, state.lr)
+        self.assertTreeAllClose(self.template, adadp.get_params((i, state)))
+
+    def test_update_step_1(self):
+        learning_rate = 1.
+        adadp = FlatADADP(learning_rate, 1.)
+        value = self.same_tree_with_value(self.template, 0.)
+        gradient = self.same_tree_with_value(self.template, 1.)
+
+        opt_state = (0, self.make_state(adadp, value, learning_rate, value))
+        i, state = jax.jit(adadp.update)(gradient, opt_state)
+
+        self.assertEqual(1, i)
+        self.assertTreeAllClose(
+            self.same_tree_with_value(self.template, -0.5),
+            adadp.get_params((i, state))
+        )
+        self.assertEqual(learning_rate, state.lr)
+        self.assertTrue(jnp.allclose(0., state.x_prev))
+
+    def test_update_step_2_no_stability_check(self):
+        learning_rate = 1.
+        adadp = FlatADADP(learning_rate, tol=5., stability_check=False)
+        value = self.same_tree_with_value(self.template, 0.)
+        gradient = self.same_tree_with_value(self.template, 2.)
+
+        opt_state = (1, self.make_state(
+            adadp, self.same_tree_with_value(value, -0.5), learning_rate, value
+        ))
+        i, state = jax.jit(adadp.update)(gradient, opt_state)
+
+        self.assertEqual(2, i)
+        self.assertTreeAllClose(
+            self.same_tree_with_value(self.template, -1.5),
+            adadp.get_params((i, state))
+        )
+        self.assertTrue(jnp.allclose(1.018308251, state.lr))
+
+    def test_update_step_2_with_stability_check(self):
+        learning_rate = 1.
+        adadp = FlatADADP(learning_rate, tol=5., stability_check=True)
+        value = self.same_tree_with_value(self.template, 0.)
+        gradient = self.same_tree_with_value(self.template, 3.)
+
+        opt_state = (1, self.make_state(
+            adadp, self.same_tree_with_value(value, -0.5), learning_rate, value
+        ))
+        i, state = jax.jit(adadp.update)(gradient, opt_state)
+
+        self.assertEqual(2, i)
+        self.assertTreeAllClose(value, adadp.get_params((i, state))) # update rejected
+        self.assertTrue(jnp.allclose(.9, state.lr)) # 0.72005267 clipped by alpha_min
+
+    def test_update_respects_alpha_min(self):
+        learning_rate = 1.
+        adadp = FlatADADP(learning_rate, tol=5., alpha_min=.5)
+        value = self.same_tree_with_value(self.template, 0.)
+        gradient = self.same_tree_with_value(self.template, 3.)
+
+        opt_state = (1, self.make_state(
+            adadp, self.same_tree_with_value(value, -0.5), learning_rate, value
+        ))
+        _, state = adadp.update(gradient, opt_state)
+        self.assertTrue(jnp.allclose(0.72005267, state.lr))
+
+    def test_agrees_with_adadp(self):
+        rng = jax.random.PRNGKey(1782)
+        adadp = ADADP(1., tol=5.)
+        flat_adadp = FlatADADP(1., tol=5.)
+        state = adadp.init(self.template)
+        flat_state = flat_adadp.init(self.template)
+        update = jax.jit(adadp.update)
+        flat_update = jax.jit(flat_adadp.update)
+
+        for _ in range(10):
+            rng, grad_rng = jax.random.split(rng)
+            gradient = jax.tree_map(
+                lambda x: 3. * jax.random.normal(grad_rng, jnp.shape(x)), self.template
+            )
+            state = update(gradient, state)
+            flat_state = flat_update(gradient, flat_state)
+
+        self.assertTreeAllClose(adadp.get_params(state), flat_adadp.get_params(flat_state))
+        self.assertTrue(jnp.allclose(state[1][1], flat_state[1].lr))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
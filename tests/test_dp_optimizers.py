@@ -0,0 +1,113 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" tests that the DP optimizers with fused noise addition work correctly
+"""
+import unittest
+
+import jax.numpy as jnp
+import jax
+from jax.experimental import optimizers
+
+from dppp.optimizers import DPSGD, DPAdam, DPADADP, FlatADADP
+import dppp.util
+
+class DPOptimizerTests(unittest.TestCase):
+
+    def assertTreeAllClose(self, expected, actual):
+        self.assertTrue(dppp.util.are_trees_close(expected, actual))
+
+    def setUp(self):
+        self.template = (
+            jnp.ones(shape=(7, 10)),
+            jnp.ones(shape=(7,)),
+            (
+                jnp.ones(shape=(2, 7)),
+                jnp.ones(shape=(2,)),
+            )
+        )
+        rng = jax.random.PRNGKey(8762)
+        self.gradients = []
+        for grad_rng in jax.random.split(rng, 6):
+            self.gradients.append(jax.tree_map(
+                lambda x: jax.random.normal(grad_rng, jnp.shape(x)), self.template
+            ))
+
+    def run_updates(self, init, update, get_params):
+        state = init(self.template)
+        for i, gradient in enumerate(self.gradients):
+            state = update(i, gradient, state)
+        return get_params(state)
+
+    def run_dp_updates(self, optimizer, noise_std=0., grad_scale=1.):
+        state = optimizer.init(self.template)
+        rng = jax.random.PRNGKey(0)
+        dp_update = jax.jit(optimizer.dp_update)
+        for gradient in self.gradients:
+            rng, update_rng = jax.random.split(rng)
+            state = dp_update(gradient, state, update_rng, noise_std, grad_scale)
+        return optimizer.get_params(state)
+
+    def test_dpsgd_agrees_with_sgd(self):
+        expected = self.run_updates(*optimizers.sgd(1e-1))
+        optimizer = DPSGD(1e-1)
+        self.assertTreeAllClose(expected, self.run_updates(
+            lambda x: optimizer.init(x),
+            lambda i, g, state: optimizer.update(g, state),
+            optimizer.get_params
+        ))
+        self.assertTreeAllClose(expected, self.run_dp_updates(optimizer))
+
+    def test_dpadam_agrees_with_adam(self):
+        expected = self.run_updates(*optimizers.adam(1e-1))
+        self.assertTreeAllClose(expected, self.run_dp_updates(DPAdam(1e-1)))
+
+    def test_dpadadp_agrees_with_flat_adadp(self):
+        optimizer = FlatADADP(1e-1, tol=5.)
+        state = optimizer.init(self.template)
+        for gradient in self.gradients:
+            state = optimizer.update(gradient, state)
+        expected = optimizer.get_params(state)
+        self.assertTreeAllClose(expected, self.run_dp_updates(DPADADP(1e-1, tol=5.)))
+
+    def test_dp_update_scales_gradient(self):
+        grad_scale = 2. # power of two to avoid differences in rounding
+        expected = self.run_updates(*optimizers.sgd(grad_scale * 1e-1))
+        self.assertTreeAllClose(
+            expected, self.run_dp_updates(DPSGD(1e-1), grad_scale=grad_scale)
+        )
+
+    def test_dp_update_adds_noise(self):
+        noise_std = 2.
+        grad_scale = 3.
+        x = jnp.zeros(10000)
+        optimizer = DPSGD(1.)
+        state = optimizer.init(x)
+        state = optimizer.dp_update(
+            jnp.zeros_like(x), state, jax.random.PRNGKey(0), noise_std, grad_scale
+        )
+        new_x = optimizer.get_params(state)
+
+        self.assertEqual(1, state[0])
+        self.assertTrue(jnp.allclose(noise_std * grad_scale, jnp.std(new_x), atol=1e-1))
+        self.assertTrue(jnp.allclose(0., jnp.mean(new_x), atol=1e-1))
+
+        other_state = optimizer.dp_update(
+            jnp.zeros_like(x), optimizer.init(x), jax.random.PRNGKey(1), noise_std, grad_scale
+        )
+        self.assertFalse(jnp.allclose(new_x, optimizer.get_params(other_state)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,7 +22,9 @@ import jax.numpy as jnp
 import jax
 from numpyro.infer.svi import SVIState
 
-from dppp.svi import DPSVI
+from dppp.svi import DPSVI, TunableSVIState, full_norm
+from dppp.optimizers import DPSGD
+from dppp.dputil import PrivacyPhase, get_epsilon_for_phases
 
 class DPSVITest(unittest.TestCase):
 
@@ -95,5 +97,127 @@ class DPSVITest(unittest.TestCase):
         self.assertFalse(jnp.allclose(noise_sites[0], noise_sites[1]))
 
 
+    def test_phase(self):
+        phase = self.svi.phase(.1, num_epochs=2)
+        self.assertEqual(PrivacyPhase(self.dp_scale, .1, 20), phase)
+
+    def test_get_epsilon_with_previous_phases(self):
+        previous = PrivacyPhase(2., .05, 200)
+        eps = self.svi.get_epsilon(1e-5, .01, num_iter=1000, previous_phases=[previous])
+        expected = get_epsilon_for_phases(1e-5, [previous, (self.dp_scale, .01, 1000)])
+        self.assertAlmostEqual(expected, eps)
+        self.assertGreater(eps, self.svi.get_epsilon(1e-5, .01, num_iter=1000))
+
+    def test_get_epsilon_uses_same_accountant_without_previous_phases(self):
+        for method in ('fourier', 'rdp'):
+            eps = self.svi.get_epsilon(1e-5, .01, num_iter=1000, method=method)
+            expected = get_epsilon_for_phases(
+                1e-5, [(self.dp_scale, .01, 1000)], method=method
+            )
+            self.assertEqual(expected, eps)
+
+
+    def test_gradient_statistics(self):
+        svi = DPSVI(None, None, None, None, self.clipping_threshold,
+            self.dp_scale, num_obs_total=self.num_obs_total,
+            gradient_statistics_bins=[1., 2.5]
+        )
+        svi_state = TunableSVIState(None, self.rng, svi._init_gradient_statistics())
+        # per-example gradient norms relative to the clipping threshold are
+        #   .5 and 3. after scaling by 1/num_obs_total; the latter is clipped
+        px_grads_list = [jnp.array([[.5], [3.]]) * self.num_obs_total]
+        px_loss = jnp.zeros(2)
+
+        svi_state, px_grads_list, _ = svi._apply_per_example_gradient_transformations(
+            svi_state, px_grads_list
+        )
+        svi_state, _, _ = svi._combine_and_transform_gradient(
+            svi_state, px_grads_list, px_loss, jax.tree_structure([0])
+        )
+        stats = svi.get_gradient_statistics(svi_state, quantiles=(.25,))
+
+        self.assertEqual(1, stats['num_steps'])
+        self.assertEqual(2, stats['num_examples'])
+        self.assertEqual(.5, stats['clipped_fraction'])
+        self.assertEqual([1, 0, 1], list(stats['norm_histogram']))
+        self.assertAlmostEqual(.5, stats['norm_quantiles'][.25])
+        # combined clipped gradient is (.5 + 2.)/2 and the noise std is 2.
+        self.assertGreater(stats['mean_noise_to_signal'], 0.)
+
+        svi_state = svi.reset_gradient_statistics(svi_state)
+        self.assertEqual(0, svi.get_gradient_statistics(svi_state)['num_examples'])
+
+    def test_dp_optimizer_adds_noise_in_update(self):
+        learning_rate = 1e-2
+        svi = DPSVI(None, None, DPSGD(learning_rate), None, self.clipping_threshold,
+            self.dp_scale, num_obs_total=self.num_obs_total
+        )
+        params = jax.tree_map(lambda px_grad: jnp.zeros(px_grad.shape[1:]), self.px_grads)
+        optim_state = svi.optim.init(params)
+        svi_state = SVIState(optim_state, self.rng)
+
+        svi_state, _, grads = svi._combine_and_transform_gradient(
+            svi_state, self.px_grads_list, self.px_loss, self.tree_def
+        )
+        # no noise in the gradient, it is left to the optimizer
+        for site in jax.tree_leaves(grads):
+            self.assertTrue(jnp.allclose(0., site))
+
+        new_svi_state = svi._apply_gradient(svi_state, grads)
+        self.assertFalse(jnp.allclose(svi_state.rng_key, new_svi_state.rng_key))
+
+        expected_std = self.dp_scale * self.clipping_threshold
+        for site in jax.tree_leaves(svi.optim.get_params(new_svi_state.optim_state)):
+            step = site / (learning_rate * self.num_obs_total)
+            self.assertTrue(jnp.allclose(expected_std, jnp.std(step), atol=1e-1))
+            self.assertTrue(jnp.allclose(0., jnp.mean(step), atol=1e-1))
+
+    def test_reduced_precision_per_example_gradients(self):
+        # DPSGD defers noise to the optimizer so that combined gradients are
+        #   the plain clipped sums
+        svi = DPSVI(None, None, DPSGD(1.), None, self.clipping_threshold,
+            self.dp_scale, num_obs_total=self.num_obs_total
+        )
+        reduced_svi = DPSVI(None, None, DPSGD(1.), None, self.clipping_threshold,
+            self.dp_scale, num_obs_total=self.num_obs_total,
+            per_example_grad_dtype=jnp.bfloat16
+        )
+        px_grads_list = [
+            jax.random.normal(rng, (self.batch_size, 1000)) * self.num_obs_total / 10.
+            for rng in jax.random.split(self.rng, 2)
+        ]
+        svi_state = SVIState(None, self.rng)
+
+        def clipped_sum(svi, px_grads_list):
+            _, px_grads_list, tree_def = svi._apply_per_example_gradient_transformations(
+                svi_state, px_grads_list
+            )
+            _, _, grads = svi._combine_and_transform_gradient(
+                svi_state, px_grads_list, self.px_loss, tree_def
+            )
+            return px_grads_list, grads
+
+        clipped, grads = clipped_sum(svi, px_grads_list)
+        reduced_clipped, reduced_grads = clipped_sum(
+            reduced_svi, [grad.astype(jnp.bfloat16) for grad in px_grads_list]
+        )
+
+        for site in reduced_clipped:
+            self.assertEqual(jnp.float32, site.dtype)
+        for site in reduced_grads:
+            self.assertEqual(jnp.float32, site.dtype)
+        self.assertTrue(jnp.all(
+            jax.vmap(full_norm)(reduced_clipped) <= self.clipping_threshold
+        ))
+        deviation = full_norm([a - b for a, b in zip(grads, reduced_grads)])
+        self.assertLess(deviation / full_norm(list(grads)), 1e-2)
+
+    def test_rejects_non_float_per_example_grad_dtype(self):
+        with self.assertRaises(ValueError):
+            DPSVI(None, None, None, None, self.clipping_threshold, self.dp_scale,
+                per_example_grad_dtype=jnp.int32
+            )
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
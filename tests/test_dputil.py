@@ -0,0 +1,321 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" tests the privacy accounting utilities in dppp.dputil
+"""
+import unittest
+import threading
+import time
+import warnings
+import functools
+
+import numpy as np
+from fourier_accountant.compute_eps import get_epsilon_R
+
+from dppp.dputil import compute_rdp_subsampled_gaussian, rdp_to_epsilon, \
+    get_epsilon_rdp, approximate_sigma_rdp, approximate_sigma_remove_relation, \
+    approximate_sigma, get_epsilon_adaptive, get_truncation_limit, \
+    get_max_grid_size, get_epsilon_for_phases, PrivacyPhase, \
+    get_epsilon_at_step, AccountingService, get_bracketing_bounds, \
+    DEFAULT_RDP_ORDERS, DEFAULT_ACCOUNTANT_MEMORY
+
+class RDPAccountantTests(unittest.TestCase):
+
+    def test_rdp_without_subsampling_is_gaussian_mechanism(self):
+        orders = np.array([2, 4, 8, 32])
+        sigma = 2.
+        rdp = compute_rdp_subsampled_gaussian(1., sigma, 1, orders)
+        self.assertTrue(np.allclose(orders / (2 * sigma**2), rdp))
+
+    def test_rdp_composes_linearly(self):
+        orders = np.array([2, 4, 8, 32])
+        rdp_1 = compute_rdp_subsampled_gaussian(.01, 1.5, 1, orders)
+        rdp_100 = compute_rdp_subsampled_gaussian(.01, 1.5, 100, orders)
+        self.assertTrue(np.allclose(100 * rdp_1, rdp_100))
+
+    def test_rdp_vectorized_over_sigma(self):
+        sigmas = np.array([[.8, 1.], [2., 4.]])
+        rdp = compute_rdp_subsampled_gaussian(.01, sigmas, 10)
+        self.assertEqual((2, 2, len(DEFAULT_RDP_ORDERS)), np.shape(rdp))
+        for i in range(2):
+            for j in range(2):
+                expected = compute_rdp_subsampled_gaussian(.01, sigmas[i, j], 10)
+                self.assertTrue(np.allclose(expected, rdp[i, j]))
+
+    def test_rdp_rejects_fractional_orders(self):
+        with self.assertRaises(ValueError):
+            compute_rdp_subsampled_gaussian(.01, 1., 10, np.array([1.5, 2.]))
+
+    def test_rdp_to_epsilon_picks_best_order(self):
+        orders = np.array([2, 4, 8])
+        rdp = np.array([1., .1, 5.])
+        eps, order = rdp_to_epsilon(orders, rdp, 1e-5)
+        self.assertEqual(4, order)
+        expected = .1 + np.log(3/4) - (np.log(1e-5) + np.log(4)) / 3
+        self.assertAlmostEqual(expected, eps)
+
+    def test_rdp_epsilon_upper_bounds_fourier_accountant(self):
+        delta, q, num_iter = 1e-5, .01, 1000
+        for sigma in (.8, 1., 2.):
+            eps_rdp = get_epsilon_rdp(delta, sigma, q, num_iter)
+            eps_fourier = get_epsilon_R(delta, sigma, q, num_iter, nx=int(1e5))
+            self.assertGreaterEqual(eps_rdp, eps_fourier)
+            self.assertLess(eps_rdp, 2 * eps_fourier)
+
+    def test_approximate_sigma_rdp(self):
+        target_eps, delta, q, num_iter = 1., 1e-5, .01, 1000
+        sigma, eps = approximate_sigma_rdp(target_eps, delta, q, num_iter)
+        self.assertLessEqual(eps, target_eps)
+        self.assertGreater(get_epsilon_rdp(delta, .99 * sigma, q, num_iter), target_eps)
+
+    def test_approximate_sigma_with_rdp_method_confirms_with_fourier_accountant(self):
+        target_eps, delta, q, num_iter = 1., 1e-5, .01, 1000
+        sigma, eps, num_evals = approximate_sigma_remove_relation(
+            target_eps, delta, q, num_iter, method='rdp'
+        )
+        self.assertEqual(1, num_evals)
+        self.assertLessEqual(eps, target_eps)
+        self.assertAlmostEqual(get_epsilon_adaptive(delta, sigma, q, num_iter, eps_tol=1e-5)[0], eps)
+        # the default fixed grid of get_epsilon_R has a discretisation error
+        #   of its own, so it only agrees within the accountant tolerance
+        self.assertAlmostEqual(get_epsilon_R(delta, sigma, q, num_iter), eps, delta=1e-5)
+
+    def test_approximate_sigma_rejects_unknown_method(self):
+        with self.assertRaises(ValueError):
+            approximate_sigma_remove_relation(1., 1e-5, .01, 1000, method='unknown')
+
+
+class BracketingBoundsTests(unittest.TestCase):
+
+    @staticmethod
+    def compute_eps(sigma, precision=1.):
+        # fails for small sigma, as the Fourier Accountant does
+        if sigma < .3:
+            raise ValueError("sigma too small")
+        return 1. / sigma
+
+    def test_bounds_below_initial_sigma_recover_from_failed_evaluation(self):
+        bounds, bound_eps, num_evals = get_bracketing_bounds(
+            self.compute_eps, 1.5, 10, initial_sigma=1., check_stability=False
+        )
+        self.assertTrue(np.allclose([.625, 1.], bounds))
+        self.assertTrue(np.allclose([1.6, 1.], bound_eps))
+        self.assertEqual(3, num_evals)
+
+    def test_bounds_above_initial_sigma_recover_from_failed_evaluation(self):
+        bounds, bound_eps, num_evals = get_bracketing_bounds(
+            self.compute_eps, .5, 10, initial_sigma=.1, check_stability=False
+        )
+        self.assertGreaterEqual(bound_eps[0], .5)
+        self.assertLessEqual(bound_eps[1], .5)
+        self.assertTrue(np.allclose(1. / bounds, bound_eps))
+
+
+class AdaptiveGridTests(unittest.TestCase):
+
+    def test_truncation_limit_is_rdp_epsilon(self):
+        L = get_truncation_limit(1e-8, 1., .01, 1000)
+        # the tolerated mass is split between both tails
+        self.assertAlmostEqual(get_epsilon_rdp(.5e-8, 1., .01, 1000), L, delta=.5)
+        rdp = compute_rdp_subsampled_gaussian(.01, 1., 1000, DEFAULT_RDP_ORDERS)
+        expected = np.min(rdp + np.log(2 / 1e-8) / (DEFAULT_RDP_ORDERS - 1))
+        self.assertAlmostEqual(expected, L)
+        self.assertGreater(L, get_epsilon_rdp(1e-5, 1., .01, 1000))
+
+    def test_max_grid_size_respects_memory(self):
+        nx = get_max_grid_size(2**20)
+        self.assertEqual(0, nx & (nx - 1)) # power of two
+        self.assertLessEqual(nx * 128, 2**20)
+        self.assertGreater(2 * nx * 128, 2**20)
+
+    def test_get_epsilon_adaptive_agrees_with_fine_grid(self):
+        delta, sigma, q, num_iter = 1e-5, 1., .01, 1000
+        eps, grid = get_epsilon_adaptive(delta, sigma, q, num_iter, eps_tol=1e-4)
+        expected = get_epsilon_R(delta, sigma, q, num_iter, nx=int(4e6))
+        self.assertLessEqual(grid.discretization_error, 1e-4)
+        self.assertLess(grid.nx, 4e6)
+        self.assertAlmostEqual(expected, eps, delta=1e-3)
+        self.assertLessEqual(eps, get_epsilon_rdp(delta, sigma, q, num_iter))
+
+    def test_get_epsilon_adaptive_stays_within_memory(self):
+        max_memory = 2**24
+        with self.assertWarns(UserWarning):
+            _, grid = get_epsilon_adaptive(1e-5, 1., .01, 10000, eps_tol=1e-3, max_memory=max_memory)
+        self.assertLessEqual(grid.nx * 128, max_memory)
+
+    def test_get_epsilon_adaptive_fails_fast_if_grid_cannot_resolve_tolerance(self):
+        with self.assertRaises(ValueError):
+            get_epsilon_adaptive(1e-5, 1., .01, 10000, eps_tol=1e-12, max_memory=2**24)
+
+    def test_get_epsilon_adaptive_fails_fast_for_small_sigma(self):
+        start = time.perf_counter()
+        for sigma in (.1, .25):
+            with self.assertRaises(ValueError):
+                get_epsilon_adaptive(1e-5, sigma, .001, 10000)
+        self.assertLess(time.perf_counter() - start, 1.)
+
+    def test_get_epsilon_adaptive_stops_once_side_of_target_is_known(self):
+        # epsilon is about .78 and is not resolved to eps_tol within the
+        #   default memory budget
+        delta, sigma, q, num_iter = 1e-5, .8, .001, 10000
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', UserWarning)
+            eps, grid = get_epsilon_adaptive(
+                delta, sigma, q, num_iter, eps_tol=1e-5, target_eps=.5
+            )
+        self.assertLess(grid.nx, get_max_grid_size(DEFAULT_ACCOUNTANT_MEMORY))
+        self.assertGreater(grid.discretization_error, 1e-5)
+        self.assertGreater(eps - .5, grid.discretization_error)
+
+    def test_get_epsilon_adaptive_rejects_unknown_relation(self):
+        with self.assertRaises(ValueError):
+            get_epsilon_adaptive(1e-5, 1., .01, 1000, relation='X')
+
+    def test_approximate_sigma_meets_tolerance(self):
+        target_eps, tol = 1., 1e-3
+        sigma, eps, _ = approximate_sigma(target_eps, 1e-5, .01, 1000, tol=tol, maxeval=20)
+        self.assertAlmostEqual(target_eps, eps, delta=tol)
+
+    def test_typical_calibration_is_fast(self):
+        start = time.perf_counter()
+        sigma, eps, _ = approximate_sigma(1., 1e-5, .01, 1000, maxeval=20)
+        self.assertLess(time.perf_counter() - start, 10.)
+        self.assertAlmostEqual(1., eps, delta=1e-4)
+
+    def test_approximate_sigma_recovers_from_small_initial_sigma(self):
+        # the initial guess 100*q has a privacy loss distribution too wide
+        #   for the accountant
+        target_eps, delta, q, num_iter = .5, 1e-5, .001, 10000
+        sigma, eps, _ = approximate_sigma_remove_relation(target_eps, delta, q, num_iter)
+        self.assertAlmostEqual(target_eps, eps, delta=1e-3)
+        self.assertAlmostEqual(1., sigma, delta=.1)
+
+
+class PhaseCompositionTests(unittest.TestCase):
+
+    def test_single_phase_agrees_with_adaptive_accountant(self):
+        delta, sigma, q, num_iter = 1e-5, 1., .01, 1000
+        expected, _ = get_epsilon_adaptive(delta, sigma, q, num_iter)
+        eps = get_epsilon_for_phases(delta, [PrivacyPhase(sigma, q, num_iter)])
+        self.assertAlmostEqual(expected, eps)
+
+    def test_splitting_a_phase_does_not_change_epsilon(self):
+        delta, sigma, q = 1e-5, 1., .01
+        expected = get_epsilon_for_phases(delta, [(sigma, q, 1000)])
+        eps = get_epsilon_for_phases(delta, [(sigma, q, 400), (sigma, q, 600)])
+        self.assertAlmostEqual(expected, eps, places=3)
+
+    def test_heterogeneous_phases_are_tighter_than_rdp(self):
+        delta = 1e-5
+        phases = [PrivacyPhase(2., .05, 200), PrivacyPhase(1., .01, 1000)]
+        eps = get_epsilon_for_phases(delta, phases)
+        eps_rdp = get_epsilon_for_phases(delta, phases, method='rdp')
+        self.assertLessEqual(eps, eps_rdp)
+        self.assertGreater(eps, get_epsilon_for_phases(delta, phases[1:]))
+
+    def test_rdp_phases_sum_rdp(self):
+        delta = 1e-5
+        phases = [PrivacyPhase(2., .05, 200), PrivacyPhase(1., .01, 1000)]
+        rdp = sum(compute_rdp_subsampled_gaussian(q, sigma, num_iter)
+            for sigma, q, num_iter in phases)
+        expected, _ = rdp_to_epsilon(DEFAULT_RDP_ORDERS, rdp, delta)
+        self.assertAlmostEqual(expected, get_epsilon_for_phases(delta, phases, method='rdp'))
+
+    def test_rejects_empty_phases(self):
+        with self.assertRaises(ValueError):
+            get_epsilon_for_phases(1e-5, [])
+
+
+class AccountingServiceTests(unittest.TestCase):
+
+    def test_requests_are_coalesced(self):
+        calls = []
+        release = threading.Event()
+        def compute_eps(num_iter):
+            release.wait()
+            calls.append(num_iter)
+            return num_iter / 10.
+
+        with AccountingService(compute_eps) as service:
+            first = service.request(10)
+            second = service.request(10)
+            self.assertIs(first, second)
+            self.assertIsNone(service.get_latest())
+            release.set()
+            self.assertEqual(1., first.result())
+            self.assertEqual(2., service.get_epsilon(20))
+        self.assertEqual([10, 20], calls)
+
+    def test_get_latest_returns_largest_completed_step(self):
+        with AccountingService(lambda num_iter: num_iter / 10.) as service:
+            service.get_epsilon(30)
+            service.get_epsilon(10)
+            self.assertEqual((30, 3.), service.get_latest())
+
+    def test_failed_requests_are_recomputed(self):
+        calls = []
+        def compute_eps(num_iter):
+            calls.append(num_iter)
+            if len(calls) == 1:
+                raise RuntimeError("transient failure")
+            return num_iter / 10.
+
+        with AccountingService(compute_eps) as service:
+            with self.assertRaises(RuntimeError):
+                service.get_epsilon(10)
+            self.assertIsNone(service.get_latest())
+            self.assertEqual(1., service.get_epsilon(10))
+            self.assertEqual((10, 1.), service.get_latest())
+        self.assertEqual([10, 10], calls)
+
+    def test_superseded_pending_requests_are_cancelled(self):
+        calls = []
+        started, release = threading.Event(), threading.Event()
+        def compute_eps(num_iter):
+            started.set()
+            release.wait()
+            calls.append(num_iter)
+            return num_iter / 10.
+
+        with AccountingService(compute_eps) as service:
+            running = service.request(10)
+            started.wait()
+            pending = service.request(20)
+            latest = service.request(30)
+            self.assertTrue(pending.cancelled())
+            self.assertFalse(running.cancelled())
+            release.set()
+            self.assertEqual(3., latest.result())
+            self.assertEqual(1., running.result())
+            self.assertEqual((30, 3.), service.get_latest())
+            # a cancelled step is computed again when requested again
+            self.assertEqual(2., service.get_epsilon(20))
+        self.assertEqual([10, 30, 20], calls)
+
+    def test_get_epsilon_at_step(self):
+        delta, sigma, q = 1e-5, 1., .01
+        self.assertEqual(0., get_epsilon_at_step(0, delta, sigma, q))
+        expected = get_epsilon_for_phases(delta, [(sigma, q, 1000)], method='rdp')
+        self.assertAlmostEqual(expected, get_epsilon_at_step(1000, delta, sigma, q, method='rdp'))
+
+    def test_service_in_processes(self):
+        compute_eps = functools.partial(get_epsilon_at_step,
+            target_delta=1e-5, sigma=1., q=.01, method='rdp'
+        )
+        with AccountingService(compute_eps, use_processes=True) as service:
+            self.assertAlmostEqual(compute_eps(1000), service.get_epsilon(1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
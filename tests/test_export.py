@@ -0,0 +1,143 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" tests the export of posterior predictive distributions in dppp.export
+and sampling from them in dppp.standalone_sampler
+"""
+import unittest
+import tempfile
+import shutil
+import os
+import subprocess
+import sys
+
+import numpy as np
+import jax.numpy as jnp
+
+import numpyro.distributions as dist
+from numpyro.primitives import sample, param
+
+from dppp.export import export_posterior_predictive
+from dppp.standalone_sampler import ExportedSampler
+from dppp.gmm import GaussianMixture
+
+def model(N, d):
+    mu = sample("mu", dist.Normal(jnp.zeros(d)))
+    x = sample("x", dist.Normal(mu), sample_shape=(N,))
+
+def guide(d):
+    mu_loc = param('mu_loc', jnp.zeros(d))
+    mu = sample('mu', dist.Normal(mu_loc, .1))
+
+def mixture_model(k, d, N):
+    pis = sample('pis', dist.Dirichlet(jnp.ones(k)))
+    mus = sample('mus', dist.Normal(jnp.zeros((k, d)), 10.))
+    sigs = sample('sigs', dist.InverseGamma(1., 1.), sample_shape=jnp.shape(mus))
+    sample('obs', GaussianMixture(mus, sigs, pis), sample_shape=(N,))
+
+def mixture_guide(k, d):
+    alpha_log = param('alpha_log', jnp.zeros(k))
+    pis = sample('pis', dist.Dirichlet(jnp.exp(alpha_log)))
+    mus_loc = param('mus_loc', jnp.zeros((k, d)))
+    mus = sample('mus', dist.Normal(mus_loc, .1))
+    sample('sigs', dist.InverseGamma(1., 1.), obs=.01 * jnp.ones_like(mus))
+
+def transforming_model(N):
+    mu = sample("mu", dist.Normal(0.))
+    sample("x", dist.Normal(jnp.exp(mu)), sample_shape=(N,))
+
+def transforming_guide():
+    sample('mu', dist.Normal(param('mu_loc', 0.), 1.))
+
+class ExportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.output_dir, 'posterior.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_export_normal(self):
+        params = {'mu_loc': jnp.array([7., 2.12])}
+        spec = export_posterior_predictive(self.path, model, (3, 2), guide, (2,), params)
+        self.assertEqual(['mu', 'x'], [site['name'] for site in spec['sites']])
+        self.assertEqual({'site': 'mu', 'shape': [2]}, spec['sites'][1]['params']['loc'])
+
+        sampler = ExportedSampler.load(self.path)
+        samples = sampler.sample(10000, seed=0)
+        self.assertEqual((10000, 2), samples['mu'].shape)
+        self.assertEqual((10000, 3, 2), samples['x'].shape)
+        self.assertTrue(np.allclose(params['mu_loc'], np.mean(samples['mu'], axis=0), atol=.01))
+        self.assertTrue(np.allclose(.1, np.std(samples['mu'], axis=0), atol=.01))
+        self.assertTrue(np.allclose(params['mu_loc'], np.mean(samples['x'], axis=(0, 1)), atol=.05))
+        self.assertTrue(np.allclose(np.sqrt(1.01), np.std(samples['x'], axis=(0, 1)), atol=.05))
+
+    def test_export_gaussian_mixture(self):
+        params = {
+            'alpha_log': jnp.log(jnp.array([10., 20., 30.])),
+            'mus_loc': jnp.array([[-5., 0.], [0., 5.], [5., 5.]])
+        }
+        export_posterior_predictive(
+            self.path, mixture_model, (3, 2, 50), mixture_guide, (3, 2), params
+        )
+
+        samples = ExportedSampler.load(self.path).sample(2000, seed=0)
+        self.assertEqual((2000, 3), samples['pis'].shape)
+        self.assertEqual((2000, 3, 2), samples['sigs'].shape)
+        self.assertEqual((2000, 50, 2), samples['obs'].shape)
+        self.assertTrue(np.allclose([1/6, 1/3, 1/2], np.mean(samples['pis'], axis=0), atol=.01))
+
+        # every observation lies close to the component location of its draw
+        distances = np.linalg.norm(
+            samples['obs'][:, :, np.newaxis] - samples['mus'][:, np.newaxis], axis=-1
+        )
+        self.assertLess(np.max(np.min(distances, axis=-1)), .1)
+
+        components = np.argmin(np.linalg.norm(
+            samples['obs'][:, :, np.newaxis] - params['mus_loc'], axis=-1
+        ), axis=-1)
+        self.assertTrue(np.allclose(
+            [1/6, 1/3, 1/2], np.bincount(components.ravel()) / components.size, atol=.01
+        ))
+
+    def test_export_rejects_transformed_samples(self):
+        with self.assertRaises(ValueError):
+            export_posterior_predictive(
+                self.path, transforming_model, (3,), transforming_guide, (), {'mu_loc': 0.}
+            )
+
+    def test_sample_selected_sites(self):
+        params = {'mu_loc': jnp.array([7., 2.12])}
+        export_posterior_predictive(self.path, model, (3, 2), guide, (2,), params)
+        sampler = ExportedSampler.load(self.path)
+        self.assertEqual(['mu', 'x'], sampler.sites)
+        samples = sampler.sample(5, seed=0, sites=['x'])
+        self.assertEqual(['x'], list(samples))
+        self.assertTrue(np.all(samples['x'] == sampler.sample(5, seed=0)['x']))
+
+    def test_standalone_sampler_does_not_import_jax(self):
+        params = {'mu_loc': jnp.array([7., 2.12])}
+        export_posterior_predictive(self.path, model, (3, 2), guide, (2,), params)
+        code = (
+            "import sys\n"
+            "from dppp.standalone_sampler import ExportedSampler\n"
+            "ExportedSampler.load({!r}).sample(10)\n"
+            "assert 'jax' not in sys.modules and 'numpyro' not in sys.modules\n"
+        ).format(self.path)
+        subprocess.run([sys.executable, '-c', code], check=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
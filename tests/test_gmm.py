@@ -18,9 +18,10 @@ import jax
 import jax.numpy as jnp
 from jax.scipy.special import logsumexp
 import numpy as np
-from numpyro.distributions import Normal
+from numpyro.distributions import Normal, MultivariateNormal, Categorical
 
-from dppp.gmm import GaussianMixture
+from dppp.gmm import GaussianMixture, MultivariateGaussianMixture, LowRankGaussianMixture, \
+    responsibilities, assign, log_likelihood, confusion_matrix, CATEGORICAL_SAMPLING, _alias_table
 
 class GaussianMixtureTests(unittest.TestCase):
 
@@ -30,6 +31,10 @@ class GaussianMixtureTests(unittest.TestCase):
         pis = jnp.ones(3)
         with self.assertRaises(ValueError):
             GaussianMixture(locs, scales, pis, validate_args=True)
+        # validate_args keeps its position from before the chunking and
+        #   sampling options were added
+        with self.assertRaises(ValueError):
+            GaussianMixture(locs, scales, pis, True)
 
     def test_sample_shape_correct(self):
         locs = jnp.array([[-5., -5.], [0., 0.], [5., 5.]])
@@ -99,6 +104,262 @@ class GaussianMixtureTests(unittest.TestCase):
         self.assertEqual((2,), jnp.shape(expected))
         self.assertTrue(jnp.allclose(expected, actual), "expected {}, actual {}".format(expected, actual))
 
+    def test_log_prob_scalar_event(self):
+        locs = jnp.array([-5., 0., 5.])
+        scales = jnp.array([1., .1, 2.])
+        pis = jnp.array([.5, .3, .2])
+        mix = GaussianMixture(locs, scales, pis)
+
+        x = np.array([-4., 0.1, 3.])
+        expected = logsumexp(
+            jnp.log(pis) + Normal(locs, scales).log_prob(x[:, np.newaxis]), axis=-1
+        )
+        actual = mix.log_prob(x)
+
+        self.assertEqual((3,), jnp.shape(actual))
+        self.assertTrue(jnp.allclose(expected, actual), "expected {}, actual {}".format(expected, actual))
+
+    def test_log_prob_trace_independent_of_num_components(self):
+        def num_eqns(k):
+            locs = jnp.zeros((k, 2))
+            mix = GaussianMixture(locs, jnp.ones_like(locs), jnp.ones(k) / k)
+            return len(jax.make_jaxpr(mix.log_prob)(jnp.zeros((4, 2))).jaxpr.eqns)
+
+        self.assertEqual(num_eqns(2), num_eqns(100))
+
+    def test_log_prob_component_chunks(self):
+        rngs = jax.random.split(jax.random.PRNGKey(9273), 4)
+        locs = 3. * jax.random.normal(rngs[0], (37, 5))
+        scales = jnp.exp(.3 * jax.random.normal(rngs[1], (37, 5)))
+        pis = jax.nn.softmax(jax.random.normal(rngs[2], (37,)))
+        x = 3. * jax.random.normal(rngs[3], (8, 5))
+
+        def log_likelihood(locs, component_chunk_size):
+            mix = GaussianMixture(locs, scales, pis, component_chunk_size=component_chunk_size)
+            return jnp.sum(mix.log_prob(x)), mix.log_prob(x)
+
+        (_, expected), expected_grad = jax.value_and_grad(log_likelihood, has_aux=True)(locs, None)
+        for component_chunk_size in (1, 4, 36, 37, 100):
+            (_, actual), actual_grad = jax.value_and_grad(log_likelihood, has_aux=True)(
+                locs, component_chunk_size
+            )
+            self.assertEqual((8,), jnp.shape(actual))
+            self.assertTrue(jnp.allclose(expected, actual, atol=1e-5), "expected {}, actual {}".format(expected, actual))
+            self.assertTrue(jnp.allclose(expected_grad, actual_grad, atol=1e-5))
+
+    def test_log_prob_component_chunks_with_zero_weight_leading_chunk(self):
+        locs = jnp.array([[0.], [1.], [2.], [3.]])
+        scales = jnp.ones_like(locs)
+        pis = jnp.array([0., 0., .5, .5])
+        x = jnp.array([[2.5], [100.]])
+
+        expected = GaussianMixture(locs, scales, pis).log_prob(x)
+        actual = GaussianMixture(locs, scales, pis, component_chunk_size=2).log_prob(x)
+        self.assertTrue(jnp.all(jnp.isfinite(actual)))
+        self.assertTrue(jnp.allclose(expected, actual), "expected {}, actual {}".format(expected, actual))
+
+        grad = jax.grad(lambda locs: jnp.sum(
+            GaussianMixture(locs, scales, pis, component_chunk_size=2).log_prob(x)
+        ))(locs)
+        self.assertTrue(jnp.all(jnp.isfinite(grad)))
+
+    def test_rejects_invalid_component_chunk_size(self):
+        locs = jnp.zeros((3, 2))
+        with self.assertRaises(ValueError):
+            GaussianMixture(locs, jnp.ones_like(locs), jnp.ones(3) / 3, component_chunk_size=0)
+
+class BatchedGaussianMixtureTests(unittest.TestCase):
+
+    def setUp(self):
+        locs = jnp.array([[-5., -5.], [0., 0.], [5., 5.]])
+        self.locs = locs + 100. * jnp.arange(4)[:, np.newaxis, np.newaxis]
+        self.scales = jnp.ones((3, 2)) * 0.1
+        self.pis = jnp.array([[.5, .3, .2], [.2, .3, .5], [1/3, 1/3, 1/3], [1., 0., 0.]])
+
+    def test_shapes(self):
+        mix = GaussianMixture(self.locs, self.scales, self.pis)
+        self.assertEqual((4,), mix.batch_shape)
+        self.assertEqual((2,), mix.event_shape)
+        self.assertEqual((5, 4), jnp.shape(mix.log_prob(jnp.zeros((5, 4, 2)))))
+
+        mix = GaussianMixture(jnp.zeros((4, 3)), jnp.ones((4, 3)), self.pis)
+        self.assertEqual((4,), mix.batch_shape)
+        self.assertEqual((), mix.event_shape)
+
+    def test_log_prob(self):
+        mix = GaussianMixture(self.locs, self.scales, self.pis)
+        x = jax.random.normal(jax.random.PRNGKey(0), (5, 4, 2)) + self.locs[:, 1]
+        actual = mix.log_prob(x)
+        for i in range(4):
+            expected = GaussianMixture(self.locs[i], self.scales, self.pis[i]).log_prob(x[:, i])
+            self.assertTrue(jnp.allclose(expected, actual[:, i]))
+
+        chunked = GaussianMixture(self.locs, self.scales, self.pis, component_chunk_size=2)
+        self.assertTrue(jnp.allclose(actual, chunked.log_prob(x)))
+
+    def test_sample_unchanged_for_default_sampling(self):
+        locs = self.locs[0]
+        mix = GaussianMixture(locs, self.scales, self.pis[0])
+        rng = jax.random.PRNGKey(2963)
+        vals, (zs,) = mix.sample_with_intermediates(rng, sample_shape=(7,))
+
+        vals_rng, pis_rng = jax.random.split(rng, 2)
+        expected_zs = Categorical(self.pis[0]).sample(pis_rng, (7,))
+        expected_vals = Normal(locs[expected_zs], self.scales[expected_zs]).sample(vals_rng)
+        self.assertTrue(jnp.all(expected_zs == zs))
+        self.assertTrue(jnp.allclose(expected_vals, vals))
+
+    def test_sample_with_intermediates(self):
+        n = 50000
+        for categorical_sampling in CATEGORICAL_SAMPLING:
+            mix = GaussianMixture(
+                self.locs, self.scales, self.pis, categorical_sampling=categorical_sampling
+            )
+            vals, (zs,) = mix.sample_with_intermediates(jax.random.PRNGKey(3), sample_shape=(n,))
+            self.assertEqual((n, 4, 2), jnp.shape(vals))
+            self.assertEqual((n, 4), jnp.shape(zs))
+
+            for i in range(4):
+                counts = np.bincount(zs[:, i], minlength=3) / n
+                stddev = np.sqrt(self.pis[i] * (1 - self.pis[i]) / n)
+                self.assertTrue(
+                    np.allclose(self.pis[i], counts, atol=4 * stddev + 1e-6),
+                    "{}: expected {}, actual {}".format(categorical_sampling, self.pis[i], counts)
+                )
+                self.assertTrue(np.all(np.abs(vals[:, i] - self.locs[i][zs[:, i]]) < 1.))
+
+    def test_alias_table(self):
+        pis = jax.nn.softmax(2. * jax.random.normal(jax.random.PRNGKey(5), (50,)))
+        prob, alias = _alias_table(pis)
+        # each column is chosen with probability 1/K and yields itself with
+        #   probability prob and its alias otherwise
+        reconstructed = np.zeros(50)
+        np.add.at(reconstructed, np.arange(50), np.asarray(prob) / 50)
+        np.add.at(reconstructed, np.asarray(alias), (1 - np.asarray(prob)) / 50)
+        self.assertTrue(np.allclose(pis, reconstructed, atol=1e-6))
+
+    def test_rejects_unknown_categorical_sampling(self):
+        with self.assertRaises(ValueError):
+            GaussianMixture(self.locs, self.scales, self.pis, categorical_sampling='foo')
+
+class MultivariateGaussianMixtureTests(unittest.TestCase):
+
+    def setUp(self):
+        rngs = jax.random.split(jax.random.PRNGKey(1827), 4)
+        self.locs = 3. * jax.random.normal(rngs[0], (4, 3))
+        factors = jax.random.normal(rngs[1], (4, 3, 3))
+        self.covs = jnp.matmul(factors, jnp.swapaxes(factors, -1, -2)) + jnp.eye(3)
+        self.pis = jax.nn.softmax(jax.random.normal(rngs[2], (4,)))
+        self.x = jax.random.normal(rngs[3], (5, 2, 3))
+
+    def expected_log_prob(self, covs):
+        log_phis = jnp.stack([
+            MultivariateNormal(loc, covariance_matrix=cov).log_prob(self.x)
+            for loc, cov in zip(self.locs, covs)
+        ], axis=-1)
+        return logsumexp(jnp.log(self.pis) + log_phis, axis=-1)
+
+    def test_log_prob(self):
+        mix = MultivariateGaussianMixture(self.locs, pis=self.pis, covariance_matrices=self.covs)
+        expected = self.expected_log_prob(self.covs)
+        actual = mix.log_prob(self.x)
+        self.assertEqual((5, 2), jnp.shape(actual))
+        self.assertTrue(jnp.allclose(expected, actual, atol=1e-5), "expected {}, actual {}".format(expected, actual))
+
+    def test_log_prob_per_example_gradients(self):
+        scale_trils = jnp.linalg.cholesky(self.covs)
+        def log_prob(locs, x):
+            return MultivariateGaussianMixture(locs, scale_trils, self.pis).log_prob(x)
+
+        x = self.x[:, 0]
+        grads = jax.jit(jax.vmap(jax.grad(log_prob), in_axes=(None, 0)))(self.locs, x)
+        self.assertEqual((5, 4, 3), jnp.shape(grads))
+        self.assertTrue(jnp.allclose(jax.grad(log_prob)(self.locs, x[0]), grads[0], atol=1e-5))
+
+    def test_low_rank_log_prob(self):
+        cov_factors = jax.random.normal(jax.random.PRNGKey(3), (4, 3, 2))
+        cov_diags = jnp.ones((4, 3)) * .5
+        mix = LowRankGaussianMixture(self.locs, cov_factors, cov_diags, self.pis)
+        covs = jnp.matmul(cov_factors, jnp.swapaxes(cov_factors, -1, -2)) \
+            + jax.vmap(jnp.diag)(cov_diags)
+        expected = self.expected_log_prob(covs)
+        actual = mix.log_prob(self.x)
+        self.assertTrue(jnp.allclose(expected, actual, atol=1e-5), "expected {}, actual {}".format(expected, actual))
+
+    def test_sample_with_intermediates(self):
+        mix = MultivariateGaussianMixture(self.locs, pis=self.pis, covariance_matrices=self.covs)
+        vals, (zs,) = mix.sample_with_intermediates(jax.random.PRNGKey(2963), sample_shape=(20000,))
+        self.assertEqual((20000, 3), jnp.shape(vals))
+        self.assertEqual((20000,), jnp.shape(zs))
+        self.assertEqual((3,), jnp.shape(mix.sample(jax.random.PRNGKey(0))))
+
+        for i in range(4):
+            self.assertTrue(np.allclose(self.locs[i], np.mean(vals[zs == i], axis=0), atol=.2))
+            self.assertTrue(np.allclose(self.covs[i], np.cov(vals[zs == i].T), rtol=.1, atol=.3))
+
+    def test_requires_exactly_one_covariance_parameterization(self):
+        with self.assertRaises(ValueError):
+            MultivariateGaussianMixture(self.locs, pis=self.pis)
+        with self.assertRaises(ValueError):
+            MultivariateGaussianMixture(
+                self.locs, jnp.linalg.cholesky(self.covs), self.pis, covariance_matrices=self.covs
+            )
+
+class MixtureMetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        locs = jnp.array([[-5., -5.], [0., 0.], [5., 5.]])
+        self.mix = GaussianMixture(locs, jnp.ones_like(locs), jnp.array([.5, .3, .2]))
+        self.x, (self.zs,) = self.mix.sample_with_intermediates(
+            jax.random.PRNGKey(2963), sample_shape=(1003,)
+        )
+
+    def test_component_log_prob(self):
+        expected = jnp.log(self.mix._pis) + jnp.sum(
+            Normal(self.mix._locs, self.mix._scales).log_prob(self.x[:, np.newaxis]), axis=-1
+        )
+        actual = self.mix.component_log_prob(self.x)
+        self.assertEqual((1003, 3), jnp.shape(actual))
+        self.assertTrue(jnp.allclose(expected, actual, atol=1e-5))
+
+    def test_responsibilities(self):
+        expected = jax.nn.softmax(self.mix.component_log_prob(self.x), axis=-1)
+        actual = responsibilities(self.mix, self.x, chunk_size=100)
+        self.assertEqual((1003, 3), jnp.shape(actual))
+        self.assertTrue(jnp.allclose(expected, actual))
+
+    def test_assign(self):
+        expected = jnp.argmax(self.mix.component_log_prob(self.x), axis=-1)
+        actual = assign(self.mix, self.x, chunk_size=100)
+        self.assertEqual((1003,), jnp.shape(actual))
+        self.assertTrue(jnp.all(expected == actual))
+
+    def test_log_likelihood(self):
+        expected = jnp.sum(self.mix.log_prob(self.x))
+        for chunk_size in (100, 1003, 4096):
+            actual = log_likelihood(self.mix, self.x, chunk_size=chunk_size)
+            self.assertTrue(jnp.allclose(expected, actual), "expected {}, actual {}".format(expected, actual))
+
+    def test_log_likelihood_multivariate(self):
+        mix = MultivariateGaussianMixture(
+            self.mix._locs, pis=self.mix._pis,
+            covariance_matrices=jnp.broadcast_to(jnp.eye(2), (3, 2, 2))
+        )
+        expected = jnp.sum(self.mix.log_prob(self.x))
+        actual = log_likelihood(mix, self.x, chunk_size=100)
+        self.assertTrue(jnp.allclose(expected, actual), "expected {}, actual {}".format(expected, actual))
+
+    def test_confusion_matrix(self):
+        assignment = assign(self.mix, self.x)
+        counts = confusion_matrix(self.zs, assignment, 3, chunk_size=100)
+        self.assertEqual((3, 3), jnp.shape(counts))
+        self.assertEqual(1003, jnp.sum(counts))
+        for i in range(3):
+            for j in range(3):
+                self.assertEqual(
+                    np.sum((self.zs == i) & (assignment == j)), counts[i, j]
+                )
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -16,6 +16,7 @@
 """
 import unittest
 
+import jax
 import jax.numpy as jnp
 import numpy as np
 
@@ -101,6 +102,33 @@ class GradientManipulatorsTests(unittest.TestCase):
         with self.assertRaises(ValueError):
             clip_gradient(self.gradient_parts, 0.)
 
+    def test_full_norm_uses_single_precision_for_half_precision_inputs(self):
+        # the sum of squares overflows in float16
+        gradient_parts = [jnp.full((10,), 300., dtype=jnp.float16)]
+        norm = full_norm(gradient_parts)
+        self.assertEqual(jnp.float32, norm.dtype)
+        self.assertTrue(jnp.allclose(300. * jnp.sqrt(10.), norm))
+
+    def test_clip_gradient_of_reduced_precision_inputs_is_single_precision(self):
+        gradient_parts = [part.astype(jnp.bfloat16) for part in self.gradient_parts]
+        clip_threshold = 0.1 * full_norm(self.gradient_parts)
+        clipped_gradient_parts = clip_gradient(gradient_parts, clip_threshold)
+        for part in clipped_gradient_parts:
+            self.assertEqual(jnp.float32, part.dtype)
+        clipped_norm = full_norm(clipped_gradient_parts)
+        self.assertLessEqual(clipped_norm, clip_threshold)
+        self.assertTrue(jnp.allclose(clip_threshold, clipped_norm))
+
+    def test_clip_gradient_does_not_exceed_threshold_after_rounding(self):
+        rngs = jax.random.split(jax.random.PRNGKey(8217), 2)
+        gradient_parts = [30. * jax.random.normal(rng, (512, 1000)) for rng in rngs]
+        for dtype in (jnp.float32, jnp.bfloat16, jnp.float16):
+            for clip_threshold in (.3, 1., 2.5, 7.):
+                norms = jax.vmap(
+                    lambda *parts: full_norm(clip_gradient(list(parts), clip_threshold))
+                )(*[part.astype(dtype) for part in gradient_parts])
+                self.assertTrue(jnp.all(norms <= clip_threshold))
+
     def test_normalize_gradient(self):
         normalized_gradient_parts = normalize_gradient(self.gradient_parts)
         self.assert_gradient_direction(self.gradient_parts, normalized_gradient_parts)
@@ -0,0 +1,111 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" tests the profiling utilities in dppp.profiling
+"""
+import unittest
+import io
+
+import jax.numpy as jnp
+import jax
+
+import numpyro.distributions as dist
+import numpyro.optim as optimizers
+from numpyro.primitives import sample, param
+from numpyro.infer import Trace_ELBO as ELBO
+
+from dppp.svi import DPSVI
+from dppp.minibatch import minibatch
+from dppp.profiling import profile_update, print_profile, plan_batch_size, \
+    estimate_update_memory, _jaxpr_peak_bytes
+
+def model(X, num_obs_total=None):
+    mu = sample('mu', dist.Normal(jnp.zeros(3), 1.))
+    with minibatch(jnp.shape(X)[0], num_obs_total=num_obs_total):
+        sample('X', dist.Normal(mu, 1.).to_event(1), obs=X)
+
+def guide(X, num_obs_total=None):
+    mu_loc = param('mu_loc', jnp.zeros(3))
+    sample('mu', dist.Normal(mu_loc, 1.))
+
+class ProfilingTests(unittest.TestCase):
+
+    def setUp(self):
+        rng = jax.random.PRNGKey(2873)
+        data_rng, init_rng = jax.random.split(rng)
+        self.X = jax.random.normal(data_rng, (16, 3))
+        self.svi = DPSVI(model, guide, optimizers.SGD(1e-3), ELBO(),
+            clipping_threshold=1., dp_scale=1., num_obs_total=100
+        )
+        self.svi_state = self.svi.init(init_rng, self.X)
+
+    def test_profile_update(self):
+        profile = profile_update(self.svi, self.svi_state, self.X, num_steps=2)
+
+        self.assertEqual([
+                'compute_per_example_gradients',
+                'apply_per_example_gradient_transformations',
+                'combine_and_transform_gradient',
+                'apply_gradient'
+            ], [stage.name for stage in profile.stages]
+        )
+        self.assertEqual('update', profile.update.name)
+        for stage in profile.stages:
+            self.assertGreater(stage.step_time, 0.)
+            self.assertGreater(stage.output_bytes, 0)
+
+        # per-example gradients for 16 examples and 3 parameters in float32
+        #   plus per-example losses and the rng key
+        self.assertGreaterEqual(profile.stages[0].output_bytes, 16 * 3 * 4 + 16 * 4)
+
+    def test_print_profile(self):
+        profile = profile_update(self.svi, self.svi_state, self.X, num_steps=1)
+        out = io.StringIO()
+        print_profile(profile, file=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(6, len(lines))
+        self.assertTrue(lines[1].startswith('compute_per_example_gradients'))
+
+    def test_jaxpr_peak_bytes(self):
+        # x and 2*x are live at the same time, the result is a scalar
+        jaxpr = jax.make_jaxpr(lambda x: jnp.sum(x * 2))(jnp.ones(1000))
+        self.assertEqual(8004, _jaxpr_peak_bytes(jaxpr.jaxpr))
+
+    def test_jaxpr_peak_bytes_includes_nested_computations(self):
+        inner = jax.jit(lambda x: jnp.sin(x) * 2)
+        jaxpr = jax.make_jaxpr(lambda x: jnp.sum(inner(x)))(jnp.ones(1000))
+        self.assertEqual(12000, _jaxpr_peak_bytes(jaxpr.jaxpr))
+
+    def test_estimate_update_memory_grows_with_batch_size(self):
+        small = estimate_update_memory(self.svi, self.svi_state, jnp.ones((16, 3)))
+        large = estimate_update_memory(self.svi, self.svi_state, jnp.ones((1024, 3)))
+        self.assertEqual(16, small.batch_size)
+        self.assertEqual(3, len(small.stages))
+        self.assertGreater(large.peak_bytes, small.peak_bytes)
+        # at least the per-example gradients must be held in memory
+        self.assertGreater(large.peak_bytes, 1024 * 3 * 4)
+
+    def test_plan_batch_size(self):
+        batch_sizes = [16, 1024, 2**20]
+        budget = estimate_update_memory(self.svi, self.svi_state, jnp.ones((1024, 3))).peak_bytes
+        plan = plan_batch_size(self.svi, self.svi_state, (self.X,), batch_sizes, budget)
+        self.assertEqual(batch_sizes, [e.batch_size for e in plan.estimates])
+        self.assertEqual(1024, plan.recommended_batch_size)
+
+        plan = plan_batch_size(self.svi, self.svi_state, (self.X,), batch_sizes, 1)
+        self.assertIsNone(plan.recommended_batch_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" tests the batched predictive serving in dppp.serving
+"""
+import unittest
+import asyncio
+
+import numpy as np
+import jax.numpy as jnp
+import jax
+
+import numpyro.distributions as dist
+from numpyro.primitives import sample, param
+
+from dppp.serving import PredictiveServer, LocalClient
+from dppp.svi import sample_multi_posterior_predictive
+
+def model(N, d):
+    mu = sample("mu", dist.Normal(jnp.zeros(d)))
+    x = sample("x", dist.Normal(mu), sample_shape=(N,))
+
+def guide(d):
+    mu_loc = param('mu_loc', jnp.zeros(d))
+    mu = sample('mu', dist.Normal(mu_loc))
+
+class PredictiveServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {'mu_loc': jnp.array([7., 2.12])}
+        self.server = PredictiveServer(
+            model, (1, 2), guide, (2,), self.params, max_batch_size=16, max_delay=.05
+        )
+
+    def expected_samples(self, rng_key, n):
+        return sample_multi_posterior_predictive(
+            rng_key, n, model, (1, 2), guide, (2,), self.params
+        )
+
+    def test_coalesces_requests(self):
+        keys = [jax.random.PRNGKey(i) for i in range(8)]
+        sizes = [1, 2, 3, 1, 2, 3, 1, 2]
+
+        async def run():
+            async with self.server:
+                return await asyncio.gather(*[
+                    self.server.sample(n, key) for n, key in zip(sizes, keys)
+                ])
+
+        results = asyncio.get_event_loop().run_until_complete(run())
+
+        for n, key, samples in zip(sizes, keys, results):
+            expected = self.expected_samples(key, n)
+            self.assertEqual((n, 1, 2), samples['x'].shape)
+            self.assertTrue(np.allclose(expected['x'], samples['x'], atol=1e-5))
+            self.assertTrue(np.allclose(expected['mu'], samples['mu'], atol=1e-5))
+
+        metrics = self.server.get_metrics()
+        self.assertEqual(8, metrics['num_requests'])
+        self.assertEqual(sum(sizes), metrics['num_draws'])
+        self.assertLess(metrics['num_batches'], 8)
+        self.assertGreater(metrics['latency_s'][.5], 0.)
+
+    def test_serves_requests_larger_than_batch_size(self):
+        async def run():
+            async with self.server:
+                return await self.server.sample(40, jax.random.PRNGKey(3))
+
+        samples = asyncio.get_event_loop().run_until_complete(run())
+        expected = self.expected_samples(jax.random.PRNGKey(3), 40)
+        self.assertTrue(np.allclose(expected['x'], samples['x'], atol=1e-5))
+
+    def test_rejects_requests_when_not_running(self):
+        with self.assertRaises(RuntimeError):
+            asyncio.get_event_loop().run_until_complete(self.server.sample(1))
+
+    def test_local_client(self):
+        with LocalClient(self.server) as client:
+            futures = [client.sample_async(2) for _ in range(10)]
+            results = [future.result() for future in futures]
+            samples = client.sample(3, jax.random.PRNGKey(1))
+            metrics = client.get_metrics()
+
+        for result in results:
+            self.assertEqual((2, 1, 2), result['x'].shape)
+        # requests without key receive different draws
+        self.assertFalse(np.allclose(results[0]['x'], results[1]['x']))
+        self.assertTrue(np.allclose(
+            self.expected_samples(jax.random.PRNGKey(1), 3)['x'], samples['x'], atol=1e-5
+        ))
+        self.assertEqual(11, metrics['num_requests'])
+        self.assertFalse(self.server.is_running)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,10 +18,17 @@ import jax.numpy as jnp
 import jax
 
 import numpyro.distributions as dist
+import numpyro.optim as optimizers
 from numpyro.primitives import sample, param
+from numpyro.infer import Trace_ELBO as ELBO
 
 from dppp.svi import sample_prior_predictive, sample_multi_prior_predictive, \
-    sample_posterior_predictive, sample_multi_posterior_predictive
+    sample_posterior_predictive, sample_multi_posterior_predictive, TunableSVI, \
+    DPSVI, stream_multi_prior_predictive, stream_multi_posterior_predictive, \
+    make_prior_predictive_sampler, make_posterior_predictive_sampler
+from dppp.tracing import get_trace_count, reset_trace_counts
+from dppp.minibatch import minibatch
+import dppp.util
 
 class ModelSamplingTests(unittest.TestCase):
 
@@ -240,6 +247,177 @@ class ModelSamplingTests(unittest.TestCase):
         self.assertEqual(2, len(samples['mu']))
         self.assertEqual(1, len(samples['mu'][1]))
         self.assertEqual((N_total, 1, d, 2), jnp.shape(samples['mu'][1][0]))
+    def test_sample_multi_prior_predictive_in_chunks(self):
+        def model(N, d):
+            mu = sample("mu", dist.Normal(jnp.zeros(d)))
+            x = sample("x", dist.Normal(mu), sample_shape=(N,))
+
+        N, d = 5, 2
+        N_total = 10
+        rng_key = jax.random.PRNGKey(2397)
+        samples = sample_multi_prior_predictive(rng_key, N_total, model, (N, d))
+        chunked_samples = sample_multi_prior_predictive(rng_key, N_total, model, (N, d), chunk_size=3)
+        self.assertEqual((N_total, N, d), jnp.shape(chunked_samples['x']))
+        self.assertTrue(jnp.allclose(samples['x'], chunked_samples['x']))
+        self.assertTrue(jnp.allclose(samples['mu'], chunked_samples['mu']))
+
+    def test_stream_multi_posterior_predictive(self):
+        def model(N, d):
+            mu = sample("mu", dist.Normal(jnp.zeros(d)))
+            x = sample("x", dist.Normal(mu), sample_shape=(N,))
+
+        def guide(d):
+            mu_loc = param('mu_loc', jnp.zeros(d))
+            mu = sample('mu', dist.Normal(mu_loc))
+
+        N, d = 1, 2
+        N_total = 10
+        params = {'mu_loc': jnp.array([7., 2.12])}
+        rng_key = jax.random.PRNGKey(8723)
+        samples = sample_multi_posterior_predictive(rng_key, N_total, model, (N, d), guide, (d,), params)
+        chunks = list(stream_multi_posterior_predictive(rng_key, N_total, model, (N, d), guide, (d,), params, chunk_size=4))
+        self.assertEqual([4, 4, 2], [jnp.shape(chunk['x'])[0] for chunk in chunks])
+        self.assertTrue(jnp.allclose(samples['x'], jnp.concatenate([chunk['x'] for chunk in chunks])))
+        self.assertTrue(jnp.allclose(samples['mu'], jnp.concatenate([chunk['mu'] for chunk in chunks])))
+
+    def test_stream_multi_prior_predictive_with_single_chunk(self):
+        def model(N, d):
+            x = sample("x", dist.Normal(jnp.zeros(d)), sample_shape=(N,))
+
+        chunks = list(stream_multi_prior_predictive(jax.random.PRNGKey(2), 3, model, (4, 2), chunk_size=5))
+        self.assertEqual(1, len(chunks))
+        self.assertEqual((3, 4, 2), jnp.shape(chunks[0]['x']))
+
+    def test_make_posterior_predictive_sampler(self):
+        def model(N, d):
+            mu = sample("mu", dist.Normal(jnp.zeros(d)))
+            x = sample("x", dist.Normal(mu), sample_shape=(N,))
+
+        def guide(d):
+            mu_loc = param('mu_loc', jnp.zeros(d))
+            mu = sample('mu', dist.Normal(mu_loc))
+
+        N, d = 1, 2
+        N_total = 10
+        rng_key = jax.random.PRNGKey(9173)
+        params = {'mu_loc': jnp.array([7., 2.12])}
+        sampler = make_posterior_predictive_sampler(model, (N, d), guide, (d,))
+        reset_trace_counts()
+
+        samples = sampler(rng_key, params, N_total)
+        expected = sample_multi_posterior_predictive(rng_key, N_total, model, (N, d), guide, (d,), params)
+        self.assertTrue(jnp.allclose(expected['x'], samples['x']))
+        self.assertTrue(jnp.allclose(expected['mu'], samples['mu']))
+
+        # same shapes reuse the compiled sampler
+        sampler(rng_key, {'mu_loc': jnp.array([1., 2.])}, N_total)
+        self.assertEqual(1, sampler.cache_size)
+        self.assertEqual(1, get_trace_count('svi.sample_multi_posterior_predictive'))
+
+        samples = sampler(rng_key, params, 2 * N_total)
+        self.assertEqual((2 * N_total, N, d), jnp.shape(samples['x']))
+        self.assertEqual(2, sampler.cache_size)
+
+        sampler.clear_cache()
+        self.assertEqual(0, sampler.cache_size)
+
+    def test_make_prior_predictive_sampler(self):
+        def model(N, d):
+            mu = sample("mu", dist.Normal(jnp.zeros(d)))
+            x = sample("x", dist.Normal(mu), sample_shape=(N,))
+
+        N, d = 5, 2
+        rng_key = jax.random.PRNGKey(723)
+        sampler = make_prior_predictive_sampler(model, (N, d), chunk_size=4)
+        samples = sampler(rng_key, 10)
+        expected = sample_multi_prior_predictive(rng_key, 10, model, (N, d))
+        self.assertTrue(jnp.allclose(expected['x'], samples['x']))
+
+        mu_fixed = jnp.array([1., -.5])
+        samples = sampler(rng_key, 10, substitutes={'mu': mu_fixed})
+        self.assertTrue(jnp.allclose(samples['mu'], mu_fixed))
+        self.assertEqual(2, sampler.cache_size)
+
+
+class FlatParametersTests(unittest.TestCase):
+
+    @staticmethod
+    def model(X, num_obs_total=None):
+        mu = sample('mu', dist.Normal(jnp.zeros(3), 1.))
+        with minibatch(jnp.shape(X)[0], num_obs_total=num_obs_total):
+            sample('X', dist.Normal(mu, 1.).to_event(1), obs=X)
+
+    @staticmethod
+    def guide(X, num_obs_total=None):
+        mu_loc = param('mu_loc', jnp.zeros(3))
+        mu_scale = param('mu_scale', jnp.ones((1, 3)), constraint=dist.constraints.positive)
+        sample('mu', dist.Normal(mu_loc, mu_scale[0]))
+
+    def setUp(self):
+        rng = jax.random.PRNGKey(9273)
+        data_rng, self.init_rng = jax.random.split(rng)
+        self.X = jax.random.normal(data_rng, (16, 3)) + 2.
+
+    def run_updates(self, svi):
+        svi_state = svi.init(self.init_rng, self.X)
+        update = jax.jit(svi.update)
+        for _ in range(5):
+            svi_state, loss = update(svi_state, self.X)
+        return svi_state, loss
+
+    def test_flat_parameters_agree_with_tree(self):
+        svi = TunableSVI(self.model, self.guide, optimizers.SGD(1e-3), ELBO(),
+            num_obs_total=100
+        )
+        flat_svi = TunableSVI(self.model, self.guide, optimizers.SGD(1e-3), ELBO(),
+            num_obs_total=100, flat_parameters=True
+        )
+        svi_state, loss = self.run_updates(svi)
+        flat_svi_state, flat_loss = self.run_updates(flat_svi)
+
+        self.assertEqual((6,), jnp.shape(flat_svi.optim.get_params(flat_svi_state.optim_state)))
+        self.assertTrue(dppp.util.are_trees_close(
+            svi.get_params(svi_state), flat_svi.get_params(flat_svi_state)
+        ))
+        self.assertTrue(jnp.allclose(loss, flat_loss))
+        self.assertTrue(jnp.allclose(
+            svi.evaluate(svi_state, self.X), flat_svi.evaluate(flat_svi_state, self.X)
+        ))
+
+    def test_flat_parameters_per_example_gradients_are_single_array(self):
+        svi = DPSVI(self.model, self.guide, optimizers.SGD(1e-3), ELBO(),
+            clipping_threshold=1., dp_scale=1., num_obs_total=100, flat_parameters=True
+        )
+        svi_state = svi.init(self.init_rng, self.X)
+        _, _, px_grads = svi._compute_per_example_gradients(svi_state, self.X)
+        self.assertEqual((16, 6), jnp.shape(px_grads))
+
+        svi_state, _ = svi.update(svi_state, self.X)
+        self.assertEqual((1, 3), jnp.shape(svi.get_params(svi_state)['mu_scale']))
+
+
+    def test_remat_policy_gives_same_updates(self):
+        svi = DPSVI(self.model, self.guide, optimizers.SGD(1e-3), ELBO(),
+            clipping_threshold=1., dp_scale=1., num_obs_total=100
+        )
+        remat_svi = DPSVI(self.model, self.guide, optimizers.SGD(1e-3), ELBO(),
+            clipping_threshold=1., dp_scale=1., num_obs_total=100,
+            remat_policy='full'
+        )
+        svi_state, loss = self.run_updates(svi)
+        remat_svi_state, remat_loss = self.run_updates(remat_svi)
+
+        self.assertTrue(dppp.util.are_trees_close(
+            svi.get_params(svi_state), remat_svi.get_params(remat_svi_state)
+        ))
+        self.assertTrue(jnp.allclose(loss, remat_loss))
+
+    def test_rejects_unknown_remat_policy(self):
+        with self.assertRaises(ValueError):
+            TunableSVI(self.model, self.guide, optimizers.SGD(1e-3), ELBO(),
+                remat_policy='not_a_policy'
+            )
+
 
 if __name__ == '__main__':
     unittest.main()
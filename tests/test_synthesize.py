@@ -0,0 +1,104 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" tests the synthetic data generation in dppp.synthesize
+"""
+import unittest
+import tempfile
+import shutil
+
+import numpy as np
+import jax.numpy as jnp
+import jax
+
+import numpyro.distributions as dist
+from numpyro.primitives import sample, param
+
+from dppp.synthesize import synthesize, load_synthetic_data
+from dppp.svi import sample_multi_posterior_predictive
+
+def model(N, d):
+    mu = sample("mu", dist.Normal(jnp.zeros(d)))
+    x = sample("x", dist.Normal(mu), sample_shape=(N,))
+
+def guide(d):
+    mu_loc = param('mu_loc', jnp.zeros(d))
+    mu = sample('mu', dist.Normal(mu_loc))
+
+class SynthesizeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.rng_key = jax.random.PRNGKey(2389)
+        self.params = {'mu_loc': jnp.array([7., 2.12])}
+        self.num_records = 25
+        self.chunk_size = 10
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def synthesize(self, output_dir, **kwargs):
+        return synthesize(
+            output_dir, self.rng_key, self.num_records, model, (1, 2), guide, (2,),
+            self.params, chunk_size=self.chunk_size, **kwargs
+        )
+
+    def test_synthesize(self):
+        result = self.synthesize(self.output_dir)
+        self.assertEqual(3, result.num_chunks)
+        self.assertEqual(((1, 2), np.float32), result.sites['x'])
+
+        data = load_synthetic_data(self.output_dir)
+        self.assertEqual({'mu', 'x'}, set(data))
+        self.assertEqual((self.num_records, 1, 2), data['x'].shape)
+
+        # chunks are sampled with keys folded from the chunk index
+        expected = sample_multi_posterior_predictive(
+            jax.random.fold_in(self.rng_key, 1), self.chunk_size, model, (1, 2),
+            guide, (2,), self.params
+        )
+        self.assertTrue(np.allclose(expected['x'], data['x'][10:20]))
+
+    def test_synthesize_selected_sites_to_memmap(self):
+        self.synthesize(self.output_dir, sites=['x'])
+        memmap_dir = tempfile.mkdtemp()
+        try:
+            self.synthesize(memmap_dir, sites=['x'], output_format='memmap')
+            data = load_synthetic_data(self.output_dir)
+            memmap_data = load_synthetic_data(memmap_dir)
+            self.assertEqual(['x'], list(memmap_data))
+            self.assertIsInstance(memmap_data['x'], np.memmap)
+            self.assertTrue(np.array_equal(data['x'], memmap_data['x']))
+        finally:
+            shutil.rmtree(memmap_dir)
+
+    def test_output_does_not_depend_on_parallelism(self):
+        self.synthesize(self.output_dir)
+        parallel_dir = tempfile.mkdtemp()
+        try:
+            self.synthesize(parallel_dir, num_processes=2)
+            data = load_synthetic_data(self.output_dir)
+            parallel_data = load_synthetic_data(parallel_dir)
+            for site in data:
+                self.assertTrue(np.array_equal(data[site], parallel_data[site]))
+        finally:
+            shutil.rmtree(parallel_dir)
+
+    def test_rejects_unknown_output_format(self):
+        with self.assertRaises(ValueError):
+            self.synthesize(self.output_dir, output_format='csv')
+
+
+if __name__ == '__main__':
+    unittest.main()
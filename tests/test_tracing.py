@@ -0,0 +1,100 @@
+# Copyright 2019- d3p Developers and their Assignees
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" tests the trace counting instrumentation in dppp.tracing
+"""
+import unittest
+import warnings
+
+import jax.numpy as jnp
+import jax
+
+from dppp.tracing import count_traces, get_trace_count, get_trace_counts, \
+    reset_trace_counts, enable_recompilation_warnings, \
+    disable_recompilation_warnings, RecompilationWarning
+from dppp.minibatch import split_batchify_data
+
+def make_f():
+    # a fresh function for each test to avoid hitting jax's trace cache
+    @count_traces('test.f')
+    def f(x, n):
+        return x * n
+    return f
+
+class TracingTests(unittest.TestCase):
+
+    def setUp(self):
+        reset_trace_counts()
+
+    def tearDown(self):
+        disable_recompilation_warnings()
+        reset_trace_counts()
+
+    def test_counts_only_traces(self):
+        f = make_f()
+        f(jnp.ones(3), 2)
+        self.assertEqual(0, get_trace_count('test.f'))
+
+        jitted_f = jax.jit(f, static_argnums=(1,))
+        jitted_f(jnp.ones(3), 2)
+        jitted_f(jnp.zeros(3), 2)
+        self.assertEqual(1, get_trace_count('test.f'))
+
+        jitted_f(jnp.ones(4), 2)
+        self.assertEqual(2, get_trace_count('test.f'))
+        self.assertEqual({'test.f': 2}, get_trace_counts())
+
+    def test_does_not_count_eager_transformations(self):
+        f = make_f()
+        jax.vmap(f, in_axes=(0, None))(jnp.ones(3), 2)
+        jax.grad(f)(1., 2)
+        self.assertEqual(0, get_trace_count('test.f'))
+
+        jax.jit(jax.vmap(f, in_axes=(0, None)), static_argnums=(1,))(jnp.ones(3), 2)
+        self.assertEqual(1, get_trace_count('test.f'))
+
+    def test_warns_with_changed_shape(self):
+        enable_recompilation_warnings(warmup=1)
+        jitted_f = jax.jit(make_f(), static_argnums=(1,))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            jitted_f(jnp.ones(3), 2)
+            self.assertEqual(0, len(caught))
+            jitted_f(jnp.ones(4), 2)
+        self.assertEqual(1, len(caught))
+        self.assertTrue(issubclass(caught[0].category, RecompilationWarning))
+        self.assertIn("argument 'x'", str(caught[0].message))
+        self.assertIn("(3,)", str(caught[0].message))
+        self.assertIn("(4,)", str(caught[0].message))
+
+    def test_warns_with_changed_static_value(self):
+        enable_recompilation_warnings(warmup=1)
+        jitted_f = jax.jit(make_f(), static_argnums=(1,))
+        jitted_f(jnp.ones(3), 2)
+        with self.assertWarns(RecompilationWarning) as caught:
+            jitted_f(jnp.ones(3), 3)
+        self.assertIn("argument 'n' changed from int 2 to int 3", str(caught.warning))
+
+    def test_batchifier_is_instrumented(self):
+        data = jnp.arange(20).reshape(10, 2)
+        init, fetch = split_batchify_data((data,), batch_size=2)
+        _, state = init(jax.random.PRNGKey(0))
+        for i in range(3):
+            fetch(i, state)
+        self.assertEqual(1, get_trace_count('split_batchify_data.init'))
+        self.assertEqual(1, get_trace_count('split_batchify_data.get_batch'))
+
+
+if __name__ == '__main__':
+    unittest.main()